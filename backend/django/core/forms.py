@@ -197,7 +197,9 @@ class ProjectWizardForm(forms.ModelForm):
 class AdvancedWizardForm(forms.ModelForm):
     class Meta:
         model = Project
-        fields = ['learning_method', 'percentage_irr', 'num_users_irr', 'batch_size', 'classifier']
+        fields = ['learning_method', 'percentage_irr', 'num_users_irr', 'batch_size', 'classifier',
+                  'feature_extractor', 'reduction', 'near_duplicates', 'cv_folds', 'holdout',
+                  'fold_ensemble', 'hyperparameter_search']
 
     use_active_learning = forms.BooleanField(initial=True, required=False)
     active_l_choices = copy.deepcopy(Project.ACTIVE_L_CHOICES)
@@ -218,6 +220,22 @@ class AdvancedWizardForm(forms.ModelForm):
         widget=RadioSelect(), choices=Project.CLASSIFIER_CHOICES,
         initial="logistic regression", required=False
     )
+    feature_extractor = forms.ChoiceField(
+        widget=RadioSelect(), choices=Project.FEATURE_CHOICES,
+        initial="tfidf", required=False
+    )
+    reduction = forms.ChoiceField(
+        widget=RadioSelect(), choices=Project.REDUCTION_CHOICES,
+        initial="none", required=False
+    )
+    near_duplicates = forms.ChoiceField(
+        widget=RadioSelect(), choices=Project.NEAR_DUPLICATE_CHOICES,
+        initial="none", required=False
+    )
+    cv_folds = forms.IntegerField(initial=5, min_value=2, max_value=10)
+    holdout = forms.FloatField(initial=0.0, min_value=0.0, max_value=0.5)
+    fold_ensemble = forms.BooleanField(initial=False, required=False)
+    hyperparameter_search = forms.BooleanField(initial=False, required=False)
 
     def clean(self):
         use_active_learning = self.cleaned_data.get("use_active_learning")
@@ -234,6 +252,17 @@ class AdvancedWizardForm(forms.ModelForm):
             self.cleaned_data['classifier'] = None
             self.cleaned_data['learning_method'] = 'random'
 
+        if not self.cleaned_data.get('feature_extractor'):
+            self.cleaned_data['feature_extractor'] = 'tfidf'
+        # Multinomial Naive Bayes needs counts or weights that are never negative
+        if (self.cleaned_data.get('classifier') == 'mnb'
+                and self.cleaned_data['feature_extractor'] == 'embeddings'):
+            self.add_error('classifier', 'Multinomial Naive Bayes cannot be used with uploaded embeddings.')
+        if not self.cleaned_data.get('reduction'):
+            self.cleaned_data['reduction'] = 'none'
+        if not self.cleaned_data.get('near_duplicates'):
+            self.cleaned_data['near_duplicates'] = 'none'
+
         if use_default_batch_size:
             self.cleaned_data['batch_size'] = 0
         if not use_irr:
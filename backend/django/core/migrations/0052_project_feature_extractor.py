@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-16 20:53
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0051_adminprogress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='feature_extractor',
+            field=models.CharField(choices=[('tfidf', 'Word TF-IDF (default)'), ('char hashing', 'Character n-gram hashing (faster for large datasets)'), ('embeddings', 'Uploaded embedding vectors (no text processing)')], default='tfidf', max_length=12),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-16 20:57
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0052_project_feature_extractor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='model',
+            name='feature_path',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-16 21:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0053_model_feature_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='reduction',
+            field=models.CharField(choices=[('none', 'None (default)'), ('svd', 'Truncated SVD'), ('random projection', 'Sparse random projection')], default='none', max_length=17),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-16 21:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0054_project_reduction'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MinHashBand',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('band', models.SmallIntegerField()),
+                ('bucket', models.BigIntegerField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='data',
+            name='near_duplicate_of',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='near_duplicates', to='core.Data'),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='near_duplicates',
+            field=models.CharField(choices=[('none', 'Keep all data (default)'), ('group', 'Group near-duplicate data'), ('collapse', 'Keep only the first of each group of near-duplicate data')], default='none', max_length=8),
+        ),
+        migrations.AddField(
+            model_name='minhashband',
+            name='data',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.Data'),
+        ),
+        migrations.AddField(
+            model_name='minhashband',
+            name='project',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.Project'),
+        ),
+        migrations.AlterIndexTogether(
+            name='minhashband',
+            index_together=set([('project', 'band', 'bucket')]),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-16 21:09
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0055_near_duplicates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='model',
+            name='incremental_updates',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='model',
+            name='last_label_pk',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='project',
+            name='classifier',
+            field=models.CharField(choices=[('logistic regression', 'Logistic Regression (default)'), ('svm', 'Support Vector Machine (warning: slower for large datasets)'), ('random forest', 'Random Forest'), ('gnb', 'Gaussian Naive Bayes'), ('sgd', 'Incremental Linear Model (faster for long-running projects)')], default='logistic regression', max_length=19, null=True),
+        ),
+    ]
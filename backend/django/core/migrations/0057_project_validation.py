@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-16 21:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0056_incremental_models'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='cv_folds',
+            field=models.IntegerField(default=5),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='fold_ensemble',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='holdout',
+            field=models.FloatField(default=0.0),
+        ),
+    ]
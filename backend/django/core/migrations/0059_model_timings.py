@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-16 21:30
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0058_alter_project_classifier'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='model',
+            name='n_features',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='model',
+            name='n_samples',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='model',
+            name='peak_rss',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='model',
+            name='timings',
+            field=django.contrib.postgres.fields.jsonb.JSONField(default=dict),
+        ),
+    ]
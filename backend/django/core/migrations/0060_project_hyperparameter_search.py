@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-16 21:45
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0059_model_timings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='classifier_params',
+            field=django.contrib.postgres.fields.jsonb.JSONField(default=dict),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='hyperparameter_search',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-16 22:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0060_project_hyperparameter_search'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='project',
+            name='classifier',
+            field=models.CharField(choices=[('logistic regression', 'Logistic Regression (default)'), ('svm', 'Support Vector Machine'), ('random forest', 'Random Forest'), ('gnb', 'Gaussian Naive Bayes'), ('mnb', 'Multinomial Naive Bayes (fastest for large datasets)'), ('sgd', 'Incremental Linear Model (faster for long-running projects)')], default='logistic regression', max_length=19, null=True),
+        ),
+    ]
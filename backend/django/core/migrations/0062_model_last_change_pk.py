@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-17 10:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0061_alter_project_classifier'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='model',
+            name='last_change_pk',
+            field=models.IntegerField(default=0),
+        ),
+    ]
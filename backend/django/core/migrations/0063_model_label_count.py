@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-17 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0062_model_last_change_pk'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='model',
+            name='label_count',
+            field=models.IntegerField(default=0),
+        ),
+    ]
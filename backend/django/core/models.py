@@ -50,15 +50,53 @@ class Project(models.Model):
 
     CLASSIFIER_CHOICES = [
         ("logistic regression", "Logistic Regression (default)"),
-        ("svm", "Support Vector Machine (warning: slower for large datasets)"),
+        ("svm", "Support Vector Machine"),
         ("random forest", "Random Forest"),
-        ("gnb", "Gaussian Naive Bayes")
+        ("gnb", "Gaussian Naive Bayes"),
+        ("mnb", "Multinomial Naive Bayes (fastest for large datasets)"),
+        ("sgd", "Incremental Linear Model (faster for long-running projects)")
+    ]
+
+    FEATURE_CHOICES = [
+        ("tfidf", "Word TF-IDF (default)"),
+        ("char hashing", "Character n-gram hashing (faster for large datasets)"),
+        ("embeddings", "Uploaded embedding vectors (no text processing)")
+    ]
+
+    NEAR_DUPLICATE_CHOICES = [
+        ("none", "Keep all data (default)"),
+        ("group", "Group near-duplicate data"),
+        ("collapse", "Keep only the first of each group of near-duplicate data")
+    ]
+
+    REDUCTION_CHOICES = [
+        ("none", "None (default)"),
+        ("svd", "Truncated SVD"),
+        ("random projection", "Sparse random projection")
     ]
 
     learning_method = models.CharField(
         max_length=15, default='least confident', choices=ACTIVE_L_CHOICES)
     classifier = models.CharField(
         max_length=19, default="logistic regression", choices=CLASSIFIER_CHOICES, null=True)
+    feature_extractor = models.CharField(
+        max_length=12, default="tfidf", choices=FEATURE_CHOICES)
+    # Only used by the classifiers that need dense features
+    reduction = models.CharField(
+        max_length=17, default="none", choices=REDUCTION_CHOICES)
+    near_duplicates = models.CharField(
+        max_length=8, default="none", choices=NEAR_DUPLICATE_CHOICES)
+    # Models are evaluated with cv_folds stratified folds, or on a stratified
+    # holdout of this fraction of the labeled data if it is above 0
+    cv_folds = models.IntegerField(default=5)
+    holdout = models.FloatField(default=0.0)
+    # Predict with the models fit while evaluating instead of fitting another
+    # model on every label
+    fold_ensemble = models.BooleanField(default=False)
+    # Search for the best classifier settings while the server is idle, and
+    # the best settings found, keyed by classifier
+    hyperparameter_search = models.BooleanField(default=False)
+    classifier_params = JSONField(default=dict)
 
     def get_absolute_url(self):
         return reverse('projects:project_detail', kwargs={'pk': self.pk})
@@ -99,10 +137,29 @@ class ProjectPermissions(models.Model):
 
 class Model(models.Model):
     pickle_path = models.TextField()
+    # The snapshot of the feature matrix the model was trained on
+    feature_path = models.TextField(blank=True, default='')
     project = models.ForeignKey('Project')
     training_set = models.ForeignKey('TrainingSet')
     cv_accuracy = models.FloatField()
     cv_metrics = JSONField()
+    # The newest DataLabel the model has learned from
+    last_label_pk = models.IntegerField(default=0)
+    # Number of the project's DataLabels up to last_label_pk when the model
+    # was trained, which drops if any of them are deleted
+    label_count = models.IntegerField(default=0)
+    # The newest LabelChangeLog when the model's labels were read
+    last_change_pk = models.IntegerField(default=0)
+    # Number of incremental updates since the model was last fit on every label
+    incremental_updates = models.IntegerField(default=0)
+    # Seconds spent in each stage of training, keyed by the names in
+    # utils_model.TRAINING_STAGES
+    timings = JSONField(default=dict)
+    # Size of the training data, and the peak resident memory of the worker
+    # in kilobytes while the task trained and used the model
+    n_samples = models.IntegerField(default=0)
+    n_features = models.IntegerField(default=0)
+    peak_rss = models.IntegerField(default=0)
     predictions = models.ManyToManyField(
         'Data', related_name='models', through='DataPrediction'
     )
@@ -117,11 +174,25 @@ class Data(models.Model):
     irr_ind = models.BooleanField(default=False)
     upload_id = models.CharField(max_length=128)
     upload_id_hash = models.CharField(max_length=128)
+    # The oldest datum of the near-duplicate group this datum is in, if any
+    near_duplicate_of = models.ForeignKey('self', null=True, blank=True, related_name='near_duplicates',
+                                          on_delete=models.SET_NULL)
 
     def __str__(self):
         return self.text
 
 
+class MinHashBand(models.Model):
+    """One band of the MinHash signature of a datum, the project's index for
+        finding near-duplicates (see utils_minhash)"""
+    class Meta:
+        index_together = (('project', 'band', 'bucket'), )
+    project = models.ForeignKey('Project')
+    data = models.ForeignKey('Data')
+    band = models.SmallIntegerField()
+    bucket = models.BigIntegerField()
+
+
 class Label(models.Model):
     class Meta:
         unique_together = (('name', 'project'))
@@ -27,7 +27,7 @@ class ProjectSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Project
-        fields = ('name', 'labels', 'learning_method', 'classifier')
+        fields = ('name', 'labels', 'learning_method', 'classifier', 'feature_extractor')
 
 
 class CoreModelSerializer(serializers.HyperlinkedModelSerializer):
@@ -8,10 +8,26 @@ def send_test_task():
 
 
 @shared_task
-def send_model_task(project_pk):
-    """Trains, Saves, Predicts, Fills Queue"""
-    from core.models import Project, TrainingSet
-    from core.utils.utils_model import train_and_save_model, predict_data
+def send_model_task(project_pk, lock_token=None):
+    """Trains, Saves, Predicts, Fills Queue.  A run started by
+        schedule_training holds the project's training lock until done.
+    """
+    from core.utils.utils_scheduler import hold_training_lock
+
+    if lock_token is None:
+        train_project(project_pk)
+    else:
+        with hold_training_lock(project_pk, lock_token):
+            train_project(project_pk)
+
+    send_model_cleanup_task.delay(project_pk)
+
+
+def train_project(project_pk):
+    """The steps of send_model_task"""
+    from core.models import Project, TrainingSet, DataLabel
+    from core.utils.utils_model import (train_and_save_model, predict_data, update_tfidf_matrix,
+                                        timed, tracked_rss)
     from core.utils.utils_queue import fill_queue, find_queue_length
 
     project = Project.objects.get(pk=project_pk)
@@ -20,37 +36,97 @@ def send_model_task(project_pk):
     al_method = project.learning_method
     batch_size = project.batch_size
 
-    model = train_and_save_model(project)
-    if al_method != 'random':
-        predict_data(project, model)
-    TrainingSet.objects.create(project=project, set_number=project.get_current_training_set().set_number + 1)
+    # The worker is reused across runs, so memory is sampled during this run
+    # rather than read from its lifetime peak
+    usage = {}
+    with tracked_rss(usage):
+        # Features are only computed for data added since the last update; with
+        # nothing new the model reuses the last snapshot of the features
+        update_tfidf_matrix(project_pk)
+        model = train_and_save_model(project)
+        timings = model.timings
+        if al_method != 'random':
+            with timed(timings, 'predict'):
+                predict_data(project, model)
+        with timed(timings, 'training_set'):
+            training_set = TrainingSet.objects.create(project=project,
+                                                      set_number=model.training_set.set_number + 1)
+            # Labels that came in during training were saved to the old set, but
+            # the model has not learned them, so they count towards the next run
+            DataLabel.objects.filter(training_set=model.training_set,
+                                     pk__gt=model.last_label_pk).update(training_set=training_set)
+
+        # Determine if queue size has changed (num_coders changed) and re-fill queue
+        num_coders = len(project.projectpermissions_set.all()) + 1
+        q_length = find_queue_length(batch_size, num_coders)
+        if q_length != queue.length:
+            queue.length = q_length
+            queue.save()
 
-    # Determine if queue size has changed (num_coders changed) and re-fill queue
-    num_coders = len(project.projectpermissions_set.all()) + 1
-    q_length = find_queue_length(batch_size, num_coders)
-    if q_length != queue.length:
-        queue.length = q_length
-        queue.save()
+        with timed(timings, 'fill_queue'):
+            fill_queue(queue, irr_queue=irr_queue, orderby=al_method,
+                       irr_percent=project.percentage_irr, batch_size=batch_size)
+
+    model.timings = timings
+    model.peak_rss = usage['peak_rss']
+    model.save(update_fields=['timings', 'peak_rss'])
+
+
+@shared_task
+def send_model_cleanup_task(project_pk):
+    """Delete the pickles and feature snapshots of a project's old models.
+        It holds the training lock, as a run may be using a snapshot that no
+        model refers to yet, and is skipped if the project is being trained.
+    """
+    from core.models import Project
+    from core.utils.utils_model import delete_old_models
+    from core.utils.utils_scheduler import acquire_training_lock, hold_training_lock
+
+    token = acquire_training_lock(project_pk)
+    if token is None:
+        return None
+    with hold_training_lock(project_pk, token):
+        return delete_old_models(Project.objects.get(pk=project_pk))
+
+
+@shared_task
+def send_hyperparameter_search_task(project_pk):
+    """Search for the best classifier settings of a project, unless it is
+        being trained.  The search holds the training lock, so training
+        triggered during it waits until it is done.
+    """
+    from core.models import Project
+    from core.utils.utils_model import search_hyperparameters
+    from core.utils.utils_scheduler import acquire_training_lock, hold_training_lock
+
+    token = acquire_training_lock(project_pk)
+    if token is None:
+        return None
+    with hold_training_lock(project_pk, token):
+        return search_hyperparameters(Project.objects.get(pk=project_pk))
+
+
+@shared_task
+def send_off_peak_search_task():
+    """Start the hyperparameter search of every project that has it on"""
+    from core.utils.utils_scheduler import schedule_hyperparameter_searches
 
-    fill_queue(queue, irr_queue=irr_queue, orderby=al_method,
-               irr_percent=project.percentage_irr, batch_size=batch_size)
+    return schedule_hyperparameter_searches()
 
 
 @shared_task
 def send_tfidf_creation_task(project_pk):
-    """Create and Save tfidf"""
-    from core.utils.utils_model import create_tfidf_matrix, save_tfidf_matrix, save_tfidf_vectorizer
+    """Create and Save tfidf, or append any new data to the existing tfidf"""
+    from core.utils.utils_model import update_tfidf_matrix
 
-    tf_idf, vectorizer = create_tfidf_matrix(project_pk)
-    file = save_tfidf_matrix(tf_idf, project_pk)
-    save_tfidf_vectorizer(vectorizer, project_pk)
+    file = update_tfidf_matrix(project_pk)
 
     return file
 
 
 @shared_task
 def send_check_and_trigger_model_task(project_pk):
-    from core.util.utils_model import check_and_trigger_model
+    from core.utils.utils_model import check_and_trigger_model
     from core.models import Data
 
     datum = Data.objects.filter(project=project_pk).first()
@@ -53,6 +53,10 @@ urlpatterns = [
     url(r'^progressbarupload/', include('progressbarupload.urls')),
     url(r'^download_data/(?P<project_pk>\d+)/$', api.download_data),
     url(r'^download_model/(?P<project_pk>\d+)/$', api.download_model),
+    url(r'^upload_embeddings/(?P<project_pk>\d+)/$', api.upload_embeddings),
+    url(r'^score_text/(?P<project_pk>\d+)/$', api.score_text),
+    url(r'^near_duplicates/(?P<project_pk>\d+)/$', api.near_duplicates),
+    url(r'^near_duplicate_group/(?P<data_pk>\d+)/$', api.near_duplicate_group),
     url(r'^', include(annotate_patterns)),
     url(r'^', include(adminpage_patterns)),
 ]
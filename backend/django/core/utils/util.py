@@ -2,6 +2,8 @@ from django.db import connection, transaction
 from django.contrib.auth import get_user_model
 from django.conf import settings
 from django.utils import timezone
+from django.db.models import BigIntegerField, Max
+from django.db.models.functions import Cast
 
 import os
 import numpy as np
@@ -14,6 +16,7 @@ from celery import chord
 from core.models import (Project, Data, Profile, Label,
                          DataLabel, TrainingSet, IRRLog, ProjectPermissions)
 from core.utils.utils_queue import fill_queue
+from core.utils.utils_minhash import index_near_duplicates
 from core import tasks
 
 # https://stackoverflow.com/questions/20625582/how-to-deal-with-settingwithcopywarning-in-pandas
@@ -166,12 +169,21 @@ def add_data(project, df):
         return []
 
     df = df[:2000000 - num_existing_data]
+    max_existing_pk = Data.objects.filter(project=project).aggregate(Max('pk'))['pk__max'] or 0
 
     # if there is no ID column already, add it and hash it
     df.reset_index(drop=True, inplace=True)
     if 'ID' not in df.columns:
         # should add to what already exists
-        df["ID"] = [x + num_existing_data for x in list(df.index.values)]
+        first_id = num_existing_data
+        if project.near_duplicates == "collapse":
+            # Collapsed near-duplicates are deleted, so there can be fewer data
+            # than IDs already given out
+            max_id = Data.objects.filter(project=project, upload_id__regex=r'^[0-9]+$').aggregate(
+                max_id=Max(Cast('upload_id', BigIntegerField())))['max_id']
+            if max_id is not None:
+                first_id = max(first_id, max_id + 1)
+        df["ID"] = [x + first_id for x in list(df.index.values)]
         df["id_hash"] = df["ID"].astype(str).apply(md5_hash)
     else:
         # get the hashes from existing identifiers. Check that the new identifiers do not overlap
@@ -190,6 +202,11 @@ def add_data(project, df):
     if len(labeled_df) > 0:
         create_labels_from_csv(labeled_df, project)
 
+    if project.near_duplicates != "none":
+        removed = index_near_duplicates(project, Data.objects.filter(project=project,
+                                                                     pk__gt=max_existing_pk))
+        df = df.loc[~df['id_hash'].isin(removed)]
+
     return df
 
 
@@ -0,0 +1,153 @@
+from collections import OrderedDict
+import os
+import pickle
+import sys
+import threading
+import numpy as np
+
+from django.conf import settings
+
+# Process-local cache of objects loaded from disk, least recently used first.
+# Each entry is key -> (stamp, nbytes, value)
+_entries = OrderedDict()
+_lock = threading.Lock()
+
+# Objects with nothing to walk beyond their sys.getsizeof
+_SCALAR_TYPES = (str, bytes, bytearray, int, float, complex, type(None), np.generic, np.dtype)
+
+
+def file_stamp(path):
+    """Identify the current version of a file.  A file that is rewritten or
+        replaced gets a new stamp, which invalidates anything cached from it.
+    """
+    stat = os.stat(path)
+    return (path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def cache_load(key, path, load, nbytes=None):
+    """Get the object loaded from path, only calling load if the cached copy
+        is missing or path has changed since it was loaded.
+
+    Args:
+        key: Hashable key for the object, ex: ('vectorizer', project_pk)
+        path: The file the object is loaded from
+        load: Function with no arguments that loads the object
+        nbytes: Size charged against settings.LOAD_CACHE_BYTES, defaults to
+            the memory_size of the object
+    Returns:
+        The loaded object
+    """
+    stamp = file_stamp(path)
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None and entry[0] == stamp:
+            _entries.move_to_end(key)
+            return entry[2]
+
+    value = load()
+    cache_put(key, path, value, nbytes, stamp=stamp)
+    return value
+
+
+def cache_put(key, path, value, nbytes=None, stamp=None):
+    """Cache an object that was just loaded from, or saved to, path.  The
+        least recently used objects are evicted to stay within
+        settings.LOAD_CACHE_BYTES; an object larger than that is not cached.
+
+    Args:
+        key: Hashable key for the object
+        path: The file the object was loaded from or saved to
+        value: The object
+        nbytes: Size charged against the budget, defaults to memory_size(value)
+        stamp: The file_stamp of path, if the caller already has it
+    """
+    if stamp is None:
+        stamp = file_stamp(path)
+    if nbytes is None:
+        nbytes = memory_size(value)
+
+    with _lock:
+        _entries.pop(key, None)
+        if nbytes > settings.LOAD_CACHE_BYTES:
+            return
+        _entries[key] = (stamp, nbytes, value)
+        total = sum(entry[1] for entry in _entries.values())
+        while total > settings.LOAD_CACHE_BYTES:
+            evicted_key, (evicted_stamp, evicted_bytes, evicted_value) = _entries.popitem(last=False)
+            total -= evicted_bytes
+
+
+def memory_size(value):
+    """Estimate the memory an object and everything it refers to takes.
+        numpy arrays are counted by their nbytes, the rest by sys.getsizeof,
+        walking into objects without a __dict__ through their pickled state.
+        Memory-mapped arrays are not counted, since their pages are shared in
+        the page cache and only read as they are used.  The size on disk is
+        no guide: a pickle can be compressed and a memory-mapped file is
+        mostly not resident.
+
+    Args:
+        value: The object
+    Returns:
+        nbytes: The estimated size in bytes
+    """
+    nbytes = 0
+    # Keep what was walked alive, since a pickled state built on the fly
+    # could otherwise be freed and its id reused
+    seen = {}
+    stack = [value]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen[id(obj)] = obj
+
+        if isinstance(obj, type):
+            # Classes are shared by all their instances
+            continue
+        if isinstance(obj, np.ndarray):
+            if isinstance(obj.base, np.ndarray):
+                # A view, so count the array it views, once
+                stack.append(obj.base)
+            elif not isinstance(obj, np.memmap):
+                nbytes += obj.nbytes
+            continue
+
+        nbytes += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+        elif not isinstance(obj, _SCALAR_TYPES):
+            stack.extend(reduced_state(obj))
+    return nbytes
+
+
+def reduced_state(obj):
+    """Get what an object without a __dict__, such as the Cython Tree in a
+        fitted sklearn forest, refers to from the state it gives pickle.
+
+    Args:
+        obj: The object
+    Returns:
+        List of the arguments and state from obj.__reduce_ex__, or an empty
+            list if the object cannot be pickled
+    """
+    try:
+        reduced = obj.__reduce_ex__(pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return []
+    # Either a global name or (callable, args[, state[, listitems[, dictitems]]]),
+    # where the items are iterators that would be consumed by walking them
+    if not isinstance(reduced, tuple):
+        return []
+    return list(reduced[1:3])
+
+
+def cache_clear():
+    """Empty the cache"""
+    with _lock:
+        _entries.clear()
@@ -0,0 +1,530 @@
+from sklearn.feature_extraction.text import TfidfTransformer
+from scipy import sparse
+from collections import deque
+from functools import partial
+from billiard import Pool
+import json
+import numbers
+import os
+import shutil
+import tempfile
+import uuid
+import numpy as np
+
+# Arrays making up a feature store on disk, each saved as <name>.npy
+STORE_ARRAYS = ('data', 'indices', 'indptr', 'upload_ids', 'index_ids', 'index_rows')
+
+
+class FeatureStore(object):
+    """A project's feature matrix kept as the three CSR arrays, together with
+        the upload_id of every row so rows can be gathered by identifier.
+
+        The arrays may be numpy memmaps (see load_feature_store), in which case
+        gathering rows only reads the pages those rows live on.
+
+    Args:
+        matrix: Sparse (or dense) matrix with one row per datum
+        upload_ids: Sequence of upload_id values, one for each row of matrix
+    """
+
+    def __init__(self, matrix, upload_ids):
+        matrix = sparse.csr_matrix(matrix)
+        upload_ids = np.asarray(upload_ids, dtype=str)
+        if matrix.shape[0] != len(upload_ids):
+            raise ValueError('Feature matrix has ' + str(matrix.shape[0])
+                             + ' rows but ' + str(len(upload_ids)) + ' upload ids were given')
+        self.data = matrix.data
+        self.indices = matrix.indices
+        self.indptr = matrix.indptr
+        self.shape = matrix.shape
+        self.upload_ids = upload_ids
+
+        # Row index: the upload ids sorted, and the row each one lives in
+        self.index_rows = np.argsort(upload_ids, kind='mergesort')
+        self.index_ids = upload_ids[self.index_rows]
+        self.info = {}
+
+    @classmethod
+    def from_arrays(cls, arrays, shape):
+        """Build a store directly from its arrays without copying them"""
+        store = cls.__new__(cls)
+        for name in STORE_ARRAYS:
+            setattr(store, name, arrays[name])
+        store.shape = tuple(shape)
+        store.info = {}
+        return store
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def matrix(self):
+        """The full feature matrix in CSR format"""
+        return sparse.csr_matrix((self.data, self.indices, self.indptr),
+                                 shape=self.shape, copy=False)
+
+    def row_indices(self, upload_ids):
+        """Map a sequence of upload_ids to row numbers in the matrix
+
+        Args:
+            upload_ids: Sequence of upload_id values
+        Returns:
+            rows: numpy array of row numbers, in the same order as upload_ids
+        """
+        rows, found = self.find(upload_ids)
+        if not found.all():
+            raise ValueError('There were no features found for '
+                             + str(int((~found).sum())) + ' of the requested data')
+        return rows
+
+    def find(self, upload_ids):
+        """Look up a sequence of upload_ids without requiring them all to exist
+
+        Args:
+            upload_ids: Sequence of upload_id values
+        Returns:
+            rows: numpy array of row numbers (meaningless where not found)
+            found: boolean numpy array, True where the upload_id is in the store
+        """
+        upload_ids = np.asarray(upload_ids, dtype=str)
+        if len(upload_ids) == 0 or len(self.index_ids) == 0:
+            return np.zeros(len(upload_ids), dtype=np.int64), np.zeros(len(upload_ids), dtype=bool)
+
+        # Search with the index's own dtype so a long query can't force numpy to
+        # copy the whole (memory-mapped) index into a wider one
+        query = upload_ids.astype(self.index_ids.dtype)
+        positions = np.searchsorted(self.index_ids, query)
+        positions[positions == len(self.index_ids)] = 0
+        found = (np.asarray(self.index_ids[positions]) == query) & (query == upload_ids)
+        return np.take(self.index_rows, positions).astype(np.int64), found
+
+    def rows(self, upload_ids):
+        """Gather the feature rows for a sequence of upload_ids
+
+        Args:
+            upload_ids: Sequence of upload_id values
+        Returns:
+            matrix: CSR matrix with one row per upload_id, in the given order
+        """
+        return self.gather(self.row_indices(upload_ids))
+
+    def gather(self, rows):
+        """Gather the given row numbers into a new CSR matrix, reading only
+            the nonzeros of those rows
+
+        Args:
+            rows: Sequence of row numbers
+        Returns:
+            matrix: CSR matrix with one row per row number, in the given order
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = np.take(self.indptr, rows).astype(np.int64)
+        lengths = np.take(self.indptr, rows + 1).astype(np.int64) - starts
+
+        new_indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=new_indptr[1:])
+        # position in data/indices of every nonzero that is being gathered
+        take = np.repeat(starts - new_indptr[:-1], lengths) + np.arange(new_indptr[-1])
+
+        # np.take rather than fancy indexing, which gives read-only arrays for a
+        # read-only memmap and estimators may sort the result in place
+        return sparse.csr_matrix((np.asarray(np.take(self.data, take)),
+                                  np.asarray(np.take(self.indices, take)), new_indptr),
+                                 shape=(len(rows), self.shape[1]))
+
+
+class SegmentedFeatureStore(object):
+    """Several FeatureStores treated as one matrix, the rows of each segment
+        following those of the one before.  Used when data is appended to a
+        project, so the new rows can be featurized without rewriting the rows
+        that already exist.
+
+    Args:
+        segments: List of FeatureStore objects with the same number of columns
+    """
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.offsets = np.cumsum([0] + [len(segment) for segment in segments])
+        self.shape = (int(self.offsets[-1]), segments[0].shape[1])
+        self.info = {}
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def upload_ids(self):
+        return np.concatenate([segment.upload_ids for segment in self.segments])
+
+    @property
+    def matrix(self):
+        """The full feature matrix in CSR format"""
+        return sparse.vstack([segment.matrix for segment in self.segments], format='csr')
+
+    def row_indices(self, upload_ids):
+        rows, found = self.find(upload_ids)
+        if not found.all():
+            raise ValueError('There were no features found for '
+                             + str(int((~found).sum())) + ' of the requested data')
+        return rows
+
+    def find(self, upload_ids):
+        upload_ids = np.asarray(upload_ids, dtype=str)
+        rows = np.zeros(len(upload_ids), dtype=np.int64)
+        found = np.zeros(len(upload_ids), dtype=bool)
+        for offset, segment in zip(self.offsets, self.segments):
+            segment_rows, segment_found = segment.find(upload_ids)
+            rows[segment_found] = segment_rows[segment_found] + offset
+            found |= segment_found
+        return rows, found
+
+    def rows(self, upload_ids):
+        return self.gather(self.row_indices(upload_ids))
+
+    def gather(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        segment_of_row = np.searchsorted(self.offsets, rows, side='right') - 1
+
+        # Gather segment by segment, then put the rows back in the requested order
+        order = np.argsort(segment_of_row, kind='mergesort')
+        parts = []
+        for i, (offset, segment) in enumerate(zip(self.offsets, self.segments)):
+            segment_rows = rows[segment_of_row == i]
+            if len(segment_rows) > 0:
+                parts.append(segment.gather(segment_rows - offset))
+        if len(parts) == 0:
+            return sparse.csr_matrix((0, self.shape[1]))
+
+        return sparse.vstack(parts, format='csr')[np.argsort(order)]
+
+
+def save_feature_store(store, path, info=None):
+    """Save a feature store to the directory at path as one .npy file per array
+        plus a meta.json header.  The directory is written next to path and then
+        moved into place, so a reader never sees a partially written store.
+
+    Args:
+        store: FeatureStore to save
+        path: Directory to save the store in (replaced if it exists)
+        info: Optional JSON-serializable dict saved with the store
+    Returns:
+        path: The directory the store was saved in
+    """
+    parent = os.path.dirname(path)
+    temp_path = tempfile.mkdtemp(dir=parent, prefix='.tmp_')
+    write_arrays(store, temp_path)
+    # Appending keeps the generation, so it and the number of segments name
+    # the version of the store (see snapshot_name)
+    write_meta(temp_path, {'format': 'csr', 'shape': list(store.shape), 'generation': uuid.uuid4().hex,
+                           'segments': [], 'info': info or {}})
+
+    # Processes that already opened the old store keep their memmaps, since the
+    # files are only unlinked
+    if os.path.isdir(path):
+        old_path = tempfile.mkdtemp(dir=parent, prefix='.old_')
+        os.rename(path, os.path.join(old_path, 'store'))
+        os.rename(temp_path, path)
+        shutil.rmtree(old_path)
+    else:
+        os.rename(temp_path, path)
+
+    return path
+
+
+def append_feature_store(store, path, info=None):
+    """Append the rows of a feature store to the store saved at path.  The rows
+        are saved as a new segment beside the existing arrays, which are left
+        untouched, and meta.json is then replaced to include it.
+
+    Args:
+        store: FeatureStore with the new rows
+        path: Directory of a store saved with save_feature_store
+        info: Optional dict of values to update in the store's info
+    Returns:
+        path: The directory the store was saved in
+    """
+    meta = read_meta(path)
+    if store.shape[1] != meta['shape'][1]:
+        raise ValueError('Cannot append ' + str(store.shape[1]) + ' features to a store with '
+                         + str(meta['shape'][1]) + ' features')
+
+    segment_name = 'segment_' + str(len(meta['segments']) + 1)
+    temp_path = tempfile.mkdtemp(dir=path, prefix='.tmp_')
+    write_arrays(store, temp_path)
+    os.rename(temp_path, os.path.join(path, segment_name))
+
+    meta['segments'].append({'name': segment_name, 'shape': list(store.shape)})
+    meta['info'].update(info or {})
+    write_meta(path, meta)
+
+    return path
+
+
+def load_feature_store(path, mmap_mode='r'):
+    """Open a feature store saved with save_feature_store.  By default the
+        arrays are memory-mapped rather than read, so opening is near instant
+        and processes on the same machine share one page-cached copy.
+
+    Args:
+        path: Directory the store was saved in
+        mmap_mode: Passed to numpy.load, None reads the arrays into memory
+    Returns:
+        FeatureStore, or SegmentedFeatureStore if rows have been appended.
+        Either way the store's info dict is set as store.info
+    """
+    meta = read_meta(path)
+    store = read_arrays(path, meta['shape'], mmap_mode)
+    if len(meta['segments']) > 0:
+        store = SegmentedFeatureStore(
+            [store] + [read_arrays(os.path.join(path, segment['name']), segment['shape'], mmap_mode)
+                       for segment in meta['segments']])
+    store.info = meta['info']
+
+    return store
+
+
+def snapshot_name(path):
+    """Name the current version of the store saved at path.  The name changes
+        whenever the store is saved or appended to.
+    """
+    meta = read_meta(path)
+    return meta.get('generation', 'initial') + '_' + str(len(meta['segments']))
+
+
+def snapshot_feature_store(path, snapshot_path, extra_files=()):
+    """Make a read-only copy of the current version of the store saved at
+        path, which stays the same however the store changes afterwards.  The
+        files are hard linked rather than copied where possible, since a saved
+        array is never modified, so a snapshot takes almost no time or space.
+
+    Args:
+        path: Directory of a store saved with save_feature_store
+        snapshot_path: Directory to make the snapshot in, must not exist
+        extra_files: Other files to include in the snapshot, ex: the vectorizer
+    Returns:
+        snapshot_path: The directory of the snapshot
+    """
+    meta = read_meta(path)
+    temp_path = tempfile.mkdtemp(dir=os.path.dirname(snapshot_path), prefix='.tmp_')
+    for folder in [''] + [segment['name'] for segment in meta['segments']]:
+        if folder:
+            os.mkdir(os.path.join(temp_path, folder))
+        for name in STORE_ARRAYS:
+            link_file(os.path.join(path, folder, name + '.npy'),
+                      os.path.join(temp_path, folder, name + '.npy'))
+    for fpath in extra_files:
+        link_file(fpath, os.path.join(temp_path, os.path.basename(fpath)))
+    write_meta(temp_path, meta)
+    os.rename(temp_path, snapshot_path)
+
+    return snapshot_path
+
+
+def link_file(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        # ex: the file system does not support hard links
+        shutil.copy2(source, destination)
+
+
+def write_arrays(store, path):
+    for name in STORE_ARRAYS:
+        np.save(os.path.join(path, name + '.npy'), getattr(store, name))
+
+
+def read_arrays(path, shape, mmap_mode):
+    arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+              for name in STORE_ARRAYS}
+    return FeatureStore.from_arrays(arrays, shape)
+
+
+def read_meta(path):
+    with open(os.path.join(path, 'meta.json')) as meta_file:
+        return json.load(meta_file)
+
+
+def write_meta(path, meta):
+    # Write then rename so readers always see a complete meta.json
+    temp_fpath = os.path.join(path, '.meta.json.tmp')
+    with open(temp_fpath, 'w') as meta_file:
+        json.dump(meta, meta_file)
+    os.replace(temp_fpath, os.path.join(path, 'meta.json'))
+
+
+# The arguments pool_map's current worker processes share, see call_with_shared
+_shared_args = ()
+
+
+def set_shared_args(args):
+    """Set the arguments shared by a pool_map worker process"""
+    global _shared_args
+    _shared_args = args
+
+
+def call_with_shared(func, chunk):
+    """Call func with the shared arguments and a chunk.  Run in a worker
+        process by pool_map.
+    """
+    return func(*_shared_args, chunk)
+
+
+def pool_map(func, chunks, n_jobs, shared=()):
+    """Apply func to each chunk in a pool of worker processes, yielding the
+        results in order.  The chunks are read on the calling thread, since
+        they may come from a database cursor, and at most two per worker are
+        waiting at a time so a large input is never held in memory at once.
+        The pool is billiard's, as it can be started from a celery worker
+        process, which multiprocessing does not allow since they are daemonic.
+
+    Args:
+        func: Picklable function taking the shared arguments and a chunk
+        chunks: Iterable of chunks
+        n_jobs: Number of worker processes
+        shared: Tuple of arguments given to func before each chunk.  The
+            workers get them when they are forked rather than with every
+            chunk, so large arrays are shared with the workers, not copied.
+    Yields:
+        The result of func for each chunk
+    """
+    with Pool(processes=n_jobs, initializer=set_shared_args, initargs=(shared, )) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(call_with_shared, (func, chunk)))
+            if len(pending) >= 2 * n_jobs:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def transform_texts(vectorizer, texts):
+    """Transform a shard of documents with a fitted vectorizer.  Run in a
+        worker process by parallel_transform.
+    """
+    return vectorizer.transform(texts)
+
+
+def parallel_transform(vectorizer, text_chunks, n_jobs):
+    """Transform documents with a fitted vectorizer, each chunk in a pool of
+        worker processes.  Every row is transformed on its own, so the result
+        is identical to transforming all of the documents at once.
+
+    Args:
+        vectorizer: Fitted vectorizer
+        text_chunks: Iterable of lists of documents
+        n_jobs: Number of worker processes
+    Returns:
+        matrix: CSR-format matrix with a row for each document
+    """
+    shards = list(pool_map(partial(transform_texts, vectorizer), text_chunks, n_jobs))
+    if not shards:
+        return vectorizer.transform([])
+    return sparse.vstack(shards, format='csr')
+
+
+def count_terms(vectorizer, texts):
+    """Tokenize and count the terms of a shard of documents the same way
+        CountVectorizer does when fitting.  Run in a worker process by
+        parallel_fit_transform.
+
+    Args:
+        vectorizer: The (unfitted) vectorizer whose analyzer should be used
+        texts: List of documents
+    Returns:
+        terms: List of the terms seen, in order of first appearance
+        counts: CSR matrix of term counts, column i counting terms[i]
+    """
+    analyze = vectorizer.build_analyzer()
+    vocabulary = {}
+    indices = []
+    values = []
+    indptr = [0]
+    for text in texts:
+        term_counts = {}
+        for term in analyze(text):
+            index = vocabulary.setdefault(term, len(vocabulary))
+            term_counts[index] = term_counts.get(index, 0) + 1
+        indices.extend(term_counts.keys())
+        values.extend(term_counts.values())
+        indptr.append(len(indices))
+
+    terms = [None] * len(vocabulary)
+    for term, index in vocabulary.items():
+        terms[index] = term
+    counts = sparse.csr_matrix((np.asarray(values, dtype=vectorizer.dtype),
+                                np.asarray(indices, dtype=np.intc),
+                                np.asarray(indptr, dtype=np.intc)),
+                               shape=(len(texts), len(terms)))
+    return terms, counts
+
+
+def parallel_fit_transform(vectorizer, text_chunks, n_jobs):
+    """Fit a TfidfVectorizer and transform the documents, tokenizing and
+        counting each chunk of documents in a pool of worker processes.  The
+        per-chunk vocabularies and counts are then merged and put through the
+        same steps as TfidfVectorizer.fit_transform, so the fitted vectorizer
+        and the returned matrix are identical to the serial result.
+
+    Args:
+        vectorizer: Unfitted TfidfVectorizer, fitted in place
+        text_chunks: Iterable of lists of documents
+        n_jobs: Number of worker processes
+    Returns:
+        tf_idf_matrix: CSR-format tf-idf matrix
+    """
+    vocabulary = {}
+    data = [np.zeros(0, dtype=vectorizer.dtype)]
+    indices = [np.zeros(0, dtype=np.intc)]
+    indptr = [np.zeros(1, dtype=np.intc)]
+    num_rows = 0
+
+    def merge(terms, counts):
+        nonlocal num_rows
+        # Number the chunk's terms by first appearance across all chunks
+        term_map = np.array([vocabulary.setdefault(term, len(vocabulary)) for term in terms],
+                            dtype=np.intc)
+        data.append(counts.data)
+        indices.append(term_map[counts.indices] if len(terms) > 0 else counts.indices)
+        indptr.append(counts.indptr[1:] + indptr[-1][-1])
+        num_rows += counts.shape[0]
+
+    for terms, counts in pool_map(partial(count_terms, vectorizer), text_chunks, n_jobs):
+        merge(terms, counts)
+
+    X = sparse.csr_matrix((np.concatenate(data), np.concatenate(indices), np.concatenate(indptr)),
+                          shape=(num_rows, len(vocabulary)), dtype=vectorizer.dtype)
+    X.sort_indices()
+
+    # Put the terms in alphabetical order
+    sorted_terms = sorted(vocabulary)
+    map_index = np.empty(len(sorted_terms), dtype=np.intc)
+    for new_index, term in enumerate(sorted_terms):
+        map_index[vocabulary[term]] = new_index
+    X.indices = map_index.take(X.indices, mode='clip')
+
+    # Drop the terms outside of max_df and min_df
+    max_doc_count = (vectorizer.max_df if isinstance(vectorizer.max_df, numbers.Integral)
+                     else vectorizer.max_df * num_rows)
+    min_doc_count = (vectorizer.min_df if isinstance(vectorizer.min_df, numbers.Integral)
+                     else vectorizer.min_df * num_rows)
+    if max_doc_count < min_doc_count:
+        raise ValueError("max_df corresponds to < documents than min_df")
+    dfs = np.bincount(X.indices, minlength=X.shape[1])
+    mask = (dfs <= max_doc_count) & (dfs >= min_doc_count)
+    kept_indices = np.where(mask)[0]
+    if len(kept_indices) == 0:
+        raise ValueError("After pruning, no terms remain. Try a lower min_df or a higher max_df.")
+    new_indices = np.cumsum(mask) - 1
+    vectorizer.vocabulary_ = {term: int(new_indices[index])
+                              for index, term in enumerate(sorted_terms) if mask[index]}
+    vectorizer.stop_words_ = set(term for index, term in enumerate(sorted_terms) if not mask[index])
+    vectorizer.fixed_vocabulary_ = False
+    X = X[:, kept_indices]
+
+    tfidf = TfidfTransformer(norm=vectorizer.norm, use_idf=vectorizer.use_idf,
+                             smooth_idf=vectorizer.smooth_idf,
+                             sublinear_tf=vectorizer.sublinear_tf).fit(X)
+    # TfidfVectorizer keeps its fitted transformer in _tfidf
+    vectorizer._tfidf = tfidf
+
+    return tfidf.transform(X, copy=False)
@@ -0,0 +1,213 @@
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+
+import numpy as np
+from io import StringIO
+
+from core.models import Data, DataLabel, MinHashBand
+
+# MinHash signatures have NUM_PERM values, split into NUM_BANDS bands of
+# ROWS_PER_BAND for locality sensitive hashing.  Two documents are candidates if
+# any band matches, which is likely above a Jaccard similarity of about
+# (1 / NUM_BANDS) ** (1 / ROWS_PER_BAND) = 0.71
+NUM_PERM = 128
+NUM_BANDS = 16
+ROWS_PER_BAND = 8
+# Documents are compared as sets of overlapping SHINGLE_SIZE-byte shingles
+SHINGLE_SIZE = 5
+# Most shingles hashed at once, bounds the memory used to NUM_PERM times this
+SHINGLE_BATCH = 50000
+
+# Multiply-shift hash functions, one per permutation.  The multipliers must be
+# odd, and the seed is fixed so signatures can be compared across uploads
+_random = np.random.RandomState(20180807)
+HASH_A = _random.randint(0, 2 ** 62, size=NUM_PERM, dtype=np.int64).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+HASH_B = _random.randint(0, 2 ** 62, size=NUM_PERM, dtype=np.int64).astype(np.uint64)
+
+
+def shingle_text(text):
+    """Get the distinct shingles of a text as integers.  The text is lowercased
+        and runs of whitespace made single spaces, so small formatting changes
+        do not matter.  Each shingle packs its bytes into one integer.
+    """
+    data = ' '.join(text.lower().split()).encode('utf-8')
+    data = np.frombuffer(data.ljust(SHINGLE_SIZE, b'\0'), dtype=np.uint8).astype(np.uint64)
+    num_shingles = len(data) - SHINGLE_SIZE + 1
+    shingles = np.zeros(num_shingles, dtype=np.uint64)
+    for i in range(SHINGLE_SIZE):
+        shingles = (shingles << np.uint64(8)) | data[i:i + num_shingles]
+    return np.unique(shingles)
+
+
+def minhash_signatures(texts):
+    """Compute the MinHash signature of each text.  The fraction of positions
+        at which two signatures are equal estimates the Jaccard similarity of
+        the texts' shingles.
+
+    Args:
+        texts: List of strings
+    Returns:
+        signatures: uint32 numpy array, one row of NUM_PERM values per text
+    """
+    signatures = np.zeros((len(texts), NUM_PERM), dtype=np.uint32)
+    start = 0
+    while start < len(texts):
+        # Hash the shingles of a batch of texts at once
+        shingle_sets = []
+        num_shingles = 0
+        while start + len(shingle_sets) < len(texts) and (num_shingles < SHINGLE_BATCH or not shingle_sets):
+            shingle_sets.append(shingle_text(texts[start + len(shingle_sets)]))
+            num_shingles += len(shingle_sets[-1])
+        shingles = np.concatenate(shingle_sets)
+        offsets = np.cumsum([0] + [len(shingle_set) for shingle_set in shingle_sets[:-1]])
+
+        # uint64 arithmetic wraps, which is the modulus of multiply-shift hashing
+        hashes = (HASH_A[:, None] * shingles[None, :] + HASH_B[:, None]) >> np.uint64(32)
+        signatures[start:start + len(shingle_sets)] = np.minimum.reduceat(hashes, offsets, axis=1).T
+        start += len(shingle_sets)
+
+    return signatures
+
+
+def lsh_buckets(signatures):
+    """Hash each band of the signatures to a bucket
+
+    Args:
+        signatures: Array of MinHash signatures, one per row
+    Returns:
+        buckets: int64 numpy array, one row of NUM_BANDS buckets per signature
+    """
+    bands = signatures.reshape(len(signatures), NUM_BANDS, ROWS_PER_BAND).astype(np.uint64)
+    # FNV-1a style mixing of the values in each band
+    buckets = np.full((len(signatures), NUM_BANDS), 14695981039346656037, dtype=np.uint64)
+    for i in range(ROWS_PER_BAND):
+        buckets = (buckets ^ bands[:, :, i]) * np.uint64(1099511628211)
+    return buckets.view(np.int64)
+
+
+def similarity(signature_a, signature_b):
+    """Estimate the Jaccard similarity of two texts from their signatures"""
+    return float(np.mean(signature_a == signature_b))
+
+
+def index_near_duplicates(project, new_data):
+    """Add newly uploaded data to the project's MinHash/LSH index and group
+        any near-duplicates.  Candidates are found by matching LSH buckets in
+        the database and kept if their estimated similarity is at least
+        settings.NEAR_DUPLICATE_THRESHOLD.  Each group points at its oldest
+        datum through Data.near_duplicate_of.  If the project collapses
+        near-duplicates, new unlabeled data that joined a group is deleted.
+
+    Args:
+        project: Project object
+        new_data: Queryset of the data just added to the project
+    Returns:
+        removed: Set of the upload_id_hash of the data that was deleted
+    """
+    new_rows = list(new_data.values_list('pk', 'text'))
+    if len(new_rows) == 0:
+        return set()
+    new_pks = [pk for pk, text in new_rows]
+    signatures = dict(zip(new_pks, minhash_signatures([text for pk, text in new_rows])))
+
+    stream = StringIO()
+    buckets = lsh_buckets(np.array([signatures[pk] for pk in new_pks]))
+    for pk, datum_buckets in zip(new_pks, buckets):
+        for band, bucket in enumerate(datum_buckets):
+            stream.write('%d\t%d\t%d\t%d\n' % (project.pk, pk, band, bucket))
+    stream.seek(0)
+
+    table = MinHashBand._meta.db_table
+    with connection.cursor() as c:
+        c.copy_from(stream, table, sep='\t', columns=['project_id', 'data_id', 'band', 'bucket'])
+        # Pairs of new data and earlier data sharing a bucket in any band
+        c.execute('SELECT DISTINCT new.data_id, old.data_id FROM ' + table + ' new JOIN ' + table + ' old'
+                  ' ON old.project_id = new.project_id AND old.band = new.band AND old.bucket = new.bucket'
+                  ' WHERE new.project_id = %s AND new.data_id = ANY(%s) AND old.data_id < new.data_id',
+                  [project.pk, new_pks])
+        candidates = c.fetchall()
+    if len(candidates) == 0:
+        return set()
+
+    # Check the candidates, the signatures of earlier data are recomputed
+    old_pks = list(set(old_pk for new_pk, old_pk in candidates) - set(new_pks))
+    old_rows = list(Data.objects.filter(pk__in=old_pks).values_list('pk', 'text', 'near_duplicate_of'))
+    signatures.update(zip([pk for pk, text, rep in old_rows],
+                          minhash_signatures([text for pk, text, rep in old_rows])))
+    pairs = [(new_pk, old_pk) for new_pk, old_pk in candidates
+             if similarity(signatures[new_pk], signatures[old_pk]) >= settings.NEAR_DUPLICATE_THRESHOLD]
+
+    # Union-find over the groups, each rooted at its smallest pk
+    parent = {pk: rep or pk for pk, text, rep in old_rows}
+    parent.update((rep, rep) for pk, text, rep in old_rows if rep)
+
+    def find(pk):
+        parent.setdefault(pk, pk)
+        while parent[pk] != pk:
+            parent[pk] = parent[parent[pk]]
+            pk = parent[pk]
+        return pk
+
+    for new_pk, old_pk in pairs:
+        root_a, root_b = find(new_pk), find(old_pk)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    current = {pk: rep for pk, text, rep in old_rows}
+    groups = {}
+    for pk in list(parent):
+        root = find(pk)
+        if root != pk and current.get(pk) != root:
+            groups.setdefault(root, []).append(pk)
+    for root, members in groups.items():
+        Data.objects.filter(pk__in=members).update(near_duplicate_of=root)
+        # Data already grouped under a member that is no longer the root
+        Data.objects.filter(near_duplicate_of__in=members).update(near_duplicate_of=root)
+
+    if project.near_duplicates != "collapse":
+        return set()
+    duplicate_pks = [pk for pk in new_pks if find(pk) != pk]
+    labeled_pks = set(DataLabel.objects.filter(data__pk__in=duplicate_pks).values_list('data', flat=True))
+    removed = Data.objects.filter(pk__in=[pk for pk in duplicate_pks if pk not in labeled_pks])
+    removed_hashes = set(removed.values_list('upload_id_hash', flat=True))
+    removed.delete()
+
+    return removed_hashes
+
+
+def find_near_duplicates(project, text):
+    """Find the data in a project that is a near-duplicate of a text, using the
+        project's MinHash/LSH index
+
+    Args:
+        project: Project object
+        text: The text to look for
+    Returns:
+        data: List of Data objects, most similar first
+    """
+    signature = minhash_signatures([text])[0]
+    buckets = lsh_buckets(signature[None, :])[0]
+    candidate_pks = set()
+    for band, bucket in enumerate(buckets):
+        candidate_pks.update(MinHashBand.objects.filter(project=project, band=band, bucket=bucket)
+                             .values_list('data', flat=True))
+
+    candidates = list(Data.objects.filter(pk__in=candidate_pks))
+    scores = dict(zip([datum.pk for datum in candidates],
+                      [similarity(signature, other) for other in
+                       minhash_signatures([datum.text for datum in candidates])]))
+    matches = [datum for datum in candidates if scores[datum.pk] >= settings.NEAR_DUPLICATE_THRESHOLD]
+    return sorted(matches, key=lambda datum: (-scores[datum.pk], datum.pk))
+
+
+def get_near_duplicate_group(datum):
+    """Get a datum's group of near-duplicates, including the datum itself
+
+    Args:
+        datum: Data object
+    Returns:
+        data: Queryset of the data in the group
+    """
+    root = datum.near_duplicate_of_id or datum.pk
+    return Data.objects.filter(Q(pk=root) | Q(near_duplicate_of=root)).order_by('pk')
@@ -1,25 +1,71 @@
 from django.conf import settings
-
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.linear_model import LogisticRegression
-from sklearn.svm import SVC
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.naive_bayes import GaussianNB
-from sklearn.model_selection import cross_val_predict
-from sklearn.metrics import accuracy_score, precision_recall_fscore_support
+from django.db import connection, transaction
+from django.db.models import Max
+
+from sklearn.feature_extraction.text import TfidfVectorizer, HashingVectorizer
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from sklearn.svm import LinearSVC
+from sklearn.calibration import CalibratedClassifierCV
+from sklearn.kernel_approximation import Nystroem
+from sklearn.pipeline import make_pipeline
+from sklearn.ensemble import RandomForestClassifier, VotingClassifier
+from sklearn.naive_bayes import GaussianNB, MultinomialNB
+from sklearn.model_selection import StratifiedKFold, StratifiedShuffleSplit, ParameterGrid
+from sklearn.preprocessing import LabelEncoder
+from sklearn.base import clone
+from sklearn.decomposition import TruncatedSVD
+from sklearn.random_projection import SparseRandomProjection
+from sklearn.metrics import accuracy_score, precision_recall_fscore_support, f1_score
 from sklearn.externals import joblib
-from scipy import sparse
 import statsmodels.stats.inter_rater as raters
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+from io import StringIO
+import copy
+import fcntl
+import json
+import logging
 import os
-import math
+import shutil
+import threading
+import time
 import numpy as np
 import pandas as pd
 import pickle
+from scipy import sparse
 
-from core.models import (Data, Label, DataLabel, Model, DataPrediction,
-                         DataUncertainty, RecycleBin, IRRLog)
-from core import tasks
+from core.models import (Project, Data, Label, DataLabel, Model, DataPrediction,
+                         DataUncertainty, RecycleBin, IRRLog, LabelChangeLog)
 from core.utils.utils_queue import handle_empty_queue, fill_queue
+from core.utils.utils_cache import cache_load, cache_put
+from core.utils.utils_scheduler import schedule_training
+from core.utils.utils_features import (FeatureStore, save_feature_store,
+                                       load_feature_store, append_feature_store,
+                                       parallel_fit_transform, parallel_transform,
+                                       snapshot_name, snapshot_feature_store, read_meta,
+                                       pool_map)
+
+# Classifiers that cannot be fit on sparse input
+DENSE_ONLY_CLASSIFIERS = (GaussianNB, )
+# Classifiers that are slow on wide features, and so use the project's
+# dimensionality reduction if it has one
+REDUCED_CLASSIFIERS = (GaussianNB, RandomForestClassifier)
+# The classifier settings search_hyperparameters tries, by classifier.  The
+# features are the project's saved ones, so only the classifier's own
+# settings are searched.
+SEARCH_GRIDS = {
+    'logistic regression': {'C': [0.1, 1.0, 10.0]},
+    'svm': {'C': [0.1, 1.0, 10.0]},
+    'random forest': {'n_estimators': [10, 50], 'max_features': ['sqrt', 'log2']},
+    'sgd': {'alpha': [1e-5, 1e-4, 1e-3]},
+    'mnb': {'alpha': [0.01, 0.1, 1.0]},
+}
+# The stages of send_model_task that are timed on each Model, in order
+TRAINING_STAGES = ('feature_load', 'cross_validation', 'fit', 'pickle_dump',
+                   'predict', 'training_set', 'fill_queue')
+
+logger = logging.getLogger(__name__)
 
 
 def cohens_kappa(project):
@@ -145,15 +191,14 @@ def least_confident(probs):
     if not isinstance(probs, np.ndarray):
         raise ValueError('Probs should be a numpy array')
 
-    max_prob = max(probs)
-    return 1 - max_prob
+    return least_confident_scores(probs[np.newaxis])[0]
 
 
 def margin_sampling(probs):
     """Margin Sampling
         x = p1 - p2
         p1 is probabiiity of highest probability class
-        p2 is probability of lowest probability class
+        p2 is probability of second highest probability class
     Args:
         probs: List of predicted probabilities
     Returns:
@@ -162,9 +207,7 @@ def margin_sampling(probs):
     if not isinstance(probs, np.ndarray):
         raise ValueError('Probs should be a numpy array')
 
-    # https://stackoverflow.com/questions/26984414/efficiently-sorting-a-numpy-array-in-descending-order#answer-26984520
-    probs[::-1].sort()
-    return probs[0] - probs[1]
+    return margin_sampling_scores(probs[np.newaxis])[0]
 
 
 def entropy(probs):
@@ -179,13 +222,47 @@ def entropy(probs):
     if not isinstance(probs, np.ndarray):
         raise ValueError('Probs should be a numpy array')
 
-    non_zero_probs = (p for p in probs if p > 0)
+    return entropy_scores(probs[np.newaxis])[0]
+
+
+def least_confident_scores(probs):
+    """least_confident of every row of a matrix of predicted probabilities"""
+    return 1 - probs.max(axis=1)
+
+
+def margin_sampling_scores(probs):
+    """margin_sampling of every row of a matrix of predicted probabilities"""
+    # Only the two highest probabilities of each row need to be in order
+    top_two = np.partition(probs, probs.shape[1] - 2, axis=1)[:, -2:]
+    return top_two[:, 1] - top_two[:, 0]
+
+
+def entropy_scores(probs):
+    """entropy of every row of a matrix of predicted probabilities"""
+    non_zero = probs > 0
+    logs = np.log10(probs, out=np.zeros(probs.shape), where=non_zero)
+    return -(probs * logs).sum(axis=1)
 
-    total = 0
-    for p in non_zero_probs:
-        total += p * math.log10(p)
 
-    return -total
+# The uncertainty scores saved for each prediction, by DataUncertainty field
+UNCERTAINTY_SCORES = OrderedDict([
+    ('least_confident', least_confident_scores),
+    ('margin_sampling', margin_sampling_scores),
+    ('entropy', entropy_scores),
+])
+
+
+def uncertainty_scores(probs):
+    """Score how uncertain a model is about every row of a matrix of predicted
+        probabilities, with each of UNCERTAINTY_SCORES
+
+    Args:
+        probs: Array with a row of predicted probabilities for each datum
+    Returns:
+        scores: Dict of the array of each score, by DataUncertainty field
+    """
+    probs = np.asarray(probs, dtype=np.float64)
+    return {field: score(probs) for field, score in UNCERTAINTY_SCORES.items()}
 
 
 def check_and_trigger_model(datum, profile=None):
@@ -207,19 +284,21 @@ def check_and_trigger_model(datum, profile=None):
     labeled_data_count = labeled_data.count()
     labels_count = labeled_data.distinct('label').count()
 
-    if current_training_set.celery_task_id != '':
-        return_str = 'task already running'
-    elif labeled_data_count >= batch_size:
-        if labels_count < project.labels.count() or project.classifier is None:
+    if labeled_data_count >= batch_size:
+        if (labels_count < project.labels.count() or project.classifier is None
+                or embeddings_missing(project)):
             queue = project.queue_set.get(type="normal")
 
             fill_queue(queue=queue, orderby='random', batch_size=batch_size)
             return_str = 'random'
         else:
-            task_num = tasks.send_model_task.delay(project.pk)
-            current_training_set.celery_task_id = task_num
-            current_training_set.save()
-            return_str = 'model running'
+            task = schedule_training(project)
+            if task is None:
+                return_str = 'task already running'
+            else:
+                current_training_set.celery_task_id = task.id
+                current_training_set.save()
+                return_str = 'model running'
     elif profile:
         # Model is not running, check if user needs more data
         handle_empty_queue(profile, project)
@@ -231,137 +310,1108 @@ def check_and_trigger_model(datum, profile=None):
     return return_str
 
 
-def train_and_save_model(project):
-    """Given a project create a model, train it, and save the model pickle
+def embeddings_missing(project):
+    """Check if a project uses uploaded embeddings but has none yet, so there
+        are no features to train on
+    """
+    return project.feature_extractor == "embeddings" and not os.path.isdir(get_tfidf_matrix_path(project.pk))
+
+
+def get_classifier(project, params=None):
+    """Create the unfitted classifier a project uses
 
     Args:
-        project: The project to start training
+        project: Project object
+        params: Dict of settings to override the defaults with, defaults to the
+            ones found by search_hyperparameters for the project's classifier
     Returns:
-        model: A model object
+        clf: The classifier
     """
+    if params is None:
+        params = project.classifier_params.get(project.classifier, {})
+
     if project.classifier == "logistic regression":
         clf = LogisticRegression(class_weight='balanced', solver='lbfgs', multi_class='multinomial')
     elif project.classifier == "svm":
-        clf = SVC(probability=True)
+        return get_svm(params)
     elif project.classifier == "random forest":
         clf = RandomForestClassifier()
     elif project.classifier == "gnb":
         clf = GaussianNB()
+    elif project.classifier == "mnb":
+        clf = MultinomialNB()
+    elif project.classifier == "sgd":
+        clf = SGDClassifier(loss='log', max_iter=50, tol=1e-3, random_state=0)
     else:
         raise ValueError('There was no valid classifier for project: ' + str(project.pk))
-    tf_idf = load_tfidf_matrix(project.pk)
+    return clf.set_params(**params)
+
+
+def get_svm(params=None):
+    """Create a linear SVM with probabilities from sigmoid (Platt) calibration
+        over 3 folds.  Unlike SVC(probability=True) it scales linearly with
+        the data.  If settings.SVM_KERNEL_COMPONENTS is above 0 an RBF kernel
+        is approximated with that many Nystroem components first.
+
+    Args:
+        params: Optional dict of settings for the LinearSVC
+    Returns:
+        clf: The unfitted classifier
+    """
+    svm = LinearSVC(**(params or {}))
+    if settings.SVM_KERNEL_COMPONENTS > 0:
+        svm = make_pipeline(Nystroem(n_components=settings.SVM_KERNEL_COMPONENTS, random_state=0), svm)
+    # The folds are given as a splitter rather than a number so that a label
+    # with fewer examples than folds is left out of some folds instead of
+    # failing the whole fit
+    return CalibratedClassifierCV(svm, method='sigmoid', cv=StratifiedKFold(n_splits=3))
+
+
+def train_and_save_model(project):
+    """Given a project create a model, train it, and save the model pickle.
+        An incremental classifier is instead updated with just the labels
+        added since its last model, when get_incremental_model allows it.
+        The time spent in each stage is recorded in model.timings.
+
+    Args:
+        project: The project to start training
+    Returns:
+        model: A model object
+    """
+    timings = {}
+    clf = get_classifier(project)
+    with timed(timings, 'feature_load'):
+        feature_path = snapshot_tfidf_matrix(project.pk)
+        tf_idf = load_tfidf_snapshot(feature_path)
 
     current_training_set = project.get_current_training_set()
 
-    # In order to train need X (tf-idf vector) and Y (label) for every labeled datum
-    # Order both X and Y by upload_id_hash to ensure the tf-idf vector corresponds to the correct
-    # label
+    # Read before the labels, so a change made while they are read is seen
+    # by the next model
+    last_change_pk = LabelChangeLog.objects.filter(project=project).aggregate(Max('pk'))['pk__max'] or 0
 
+    # In order to train need X (tf-idf vector) and Y (label) for every labeled datum
     labeled_data = DataLabel.objects.filter(data__project=project)
-    unique_ids = list(labeled_data.values_list("data__upload_id",
-                                               flat=True).order_by('data__upload_id_hash'))
-    labeled_values = list(labeled_data.values_list(
-        'label', flat=True).order_by('data__upload_id_hash'))
-
-    X = [tf_idf[id] for id in unique_ids]
-    Y = labeled_values
-    clf.fit(X, Y)
+    last_label_pk = labeled_data.aggregate(Max('pk'))['pk__max'] or 0
+    labeled_data = labeled_data.filter(pk__lte=last_label_pk)
+    label_count = labeled_data.count()
+
+    previous = get_incremental_model(project, feature_path, last_label_pk)
+    with timed(timings, 'feature_load'):
+        if previous is not None:
+            X, Y = get_labeled_features(project, tf_idf,
+                                        labeled_data.filter(pk__gt=previous.last_label_pk))
+            # None of the new labels have features yet, so there is nothing to update with
+            if X.shape[0] == 0:
+                previous = None
+        if previous is None:
+            X, Y = get_labeled_features(project, tf_idf, labeled_data)
+
+    if previous is not None:
+        clf = copy.deepcopy(load_classifier(previous))
+        incremental_updates = previous.incremental_updates + 1
+    else:
+        incremental_updates = 0
+
+    with timed(timings, 'feature_load'):
+        X = prepare_features(project, feature_path, clf, X)
+    if previous is not None:
+        # Score the previous model on the new labels before learning them,
+        # since cross validating would need every label again
+        with timed(timings, 'cross_validation'):
+            cv_predicts = clf.predict(X)
+        with timed(timings, 'fit'):
+            clf.partial_fit(X, Y)
+    else:
+        with timed(timings, 'cross_validation'):
+            test_rows, cv_predicts, fold_models = cross_validate_model(project, clf, X, Y)
+        with timed(timings, 'fit'):
+            if project.fold_ensemble and fold_ensemble_usable(fold_models, Y):
+                clf = make_fold_ensemble(clf, fold_models, Y)
+            else:
+                clf.fit(X, Y)
+        Y = Y[test_rows]
 
     classes = [str(c) for c in clf.classes_]
     keys = ('precision', 'recall', 'f1')
-    cv_predicts = cross_val_predict(clf, X, Y, cv=5)
     cv_accuracy = accuracy_score(Y, cv_predicts)
-    metrics = precision_recall_fscore_support(Y, cv_predicts)
+    metrics = precision_recall_fscore_support(Y, cv_predicts, labels=clf.classes_)
     metric_map = map(lambda x: dict(zip(classes, x)), metrics[:3])
     cv_metrics = dict(zip(keys, metric_map))
 
     fpath = os.path.join(settings.MODEL_PICKLE_PATH, 'project_' + str(project.pk) + '_training_'
                          + str(current_training_set.set_number) + '.pkl')
 
-    joblib.dump(clf, fpath)
+    with timed(timings, 'pickle_dump'):
+        save_classifier(clf, fpath)
+    # The model is used right away to predict, so keep it loaded
+    cache_put(('classifier', project.pk), fpath, clf)
 
-    model = Model.objects.create(pickle_path=fpath, project=project,
+    model = Model.objects.create(pickle_path=fpath, feature_path=feature_path, project=project,
                                  training_set=current_training_set,
                                  cv_accuracy=cv_accuracy,
-                                 cv_metrics=cv_metrics)
+                                 cv_metrics=cv_metrics,
+                                 last_label_pk=last_label_pk,
+                                 last_change_pk=last_change_pk,
+                                 label_count=label_count,
+                                 incremental_updates=incremental_updates,
+                                 timings=timings,
+                                 n_samples=X.shape[0],
+                                 n_features=X.shape[1])
 
     return model
 
 
+@contextmanager
+def timed(timings, stage):
+    """Add the seconds spent in the block to timings[stage]"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0) + time.perf_counter() - start
+
+
+def current_rss():
+    """The resident memory of this process now, in kilobytes, or 0 where
+        /proc is not available
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            resident_pages = int(statm.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return 0
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+@contextmanager
+def tracked_rss(usage, interval=0.1):
+    """Sample the resident memory of this process every interval seconds
+        while the block runs, keeping the largest in usage['peak_rss'].
+        Unlike ru_maxrss, which is the peak over the worker's whole life,
+        this only covers the block.
+    """
+    stop = threading.Event()
+
+    def sample():
+        while True:
+            usage['peak_rss'] = max(usage.get('peak_rss', 0), current_rss())
+            if stop.wait(interval):
+                return
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        sampler.join()
+        usage['peak_rss'] = max(usage['peak_rss'], current_rss())
+
+
+def cross_validate_model(project, clf, X, Y):
+    """Evaluate a classifier on a project's labeled data, with project.cv_folds
+        stratified folds, or a stratified holdout of the project.holdout
+        fraction of the data if it is above 0 (see get_cv_folds).  The folds
+        are fit in settings.CV_N_JOBS worker processes, which share X and Y rather
+        than each being sent a copy.
+
+    Args:
+        project: Project object
+        clf: The unfitted classifier
+        X: The features of the labeled data
+        Y: List of the labels
+    Returns:
+        test_rows: Array of the rows that were predicted, in order
+        predictions: Array of the label predicted for each of test_rows
+        fold_models: List of the classifier fit on each fold, if the
+            project predicts with them, otherwise a list of None
+    """
+    folds = get_cv_folds(project, Y)
+
+    fit = partial(fit_fold, clf, project.fold_ensemble)
+    shared = (X, np.asarray(Y))
+    if settings.CV_N_JOBS > 1:
+        # The workers share X and Y, so each fold only sends its row numbers
+        results = list(pool_map(fit, folds, settings.CV_N_JOBS, shared=shared))
+    else:
+        results = [fit(*shared, fold) for fold in folds]
+
+    test_rows = np.concatenate([test for train, test in folds])
+    predictions = np.concatenate([fold_predictions for fold_model, fold_predictions in results])
+    return test_rows, predictions, [fold_model for fold_model, fold_predictions in results]
+
+
+def get_cv_folds(project, Y):
+    """Split the labeled data into the (train, test) rows a project's models
+        are evaluated with: a stratified holdout of the project.holdout
+        fraction if it is above 0, otherwise project.cv_folds stratified
+        folds.  Labels too rare for that fall back to fewer folds:
+        - The holdout needs two examples of every label, and a label's worth
+          of rows on each side, or k-fold is used instead.
+        - A label with a single example is only ever trained on, and the
+          folds are cut to the fewest examples of the other labels.
+        - If every label has a single example there is nothing to test on,
+          so the model is scored on the data it is trained on.
+
+    Args:
+        project: Project object
+        Y: List of the labels
+    Returns:
+        folds: List of (train, test) arrays of row numbers
+    """
+    Y = np.asarray(Y)
+    classes, counts = np.unique(Y, return_counts=True)
+    num_test = int(np.ceil(project.holdout * len(Y)))
+    if project.holdout > 0 and counts.min() >= 2 and min(num_test, len(Y) - num_test) >= len(classes):
+        splitter = StratifiedShuffleSplit(n_splits=1, test_size=project.holdout, random_state=0)
+        return list(splitter.split(np.zeros(len(Y)), Y))
+
+    single = np.isin(Y, classes[counts < 2])
+    if single.all():
+        rows = np.arange(len(Y))
+        return [(rows, rows)]
+
+    rows = np.where(~single)[0]
+    single_rows = np.where(single)[0]
+    n_splits = min(project.cv_folds, counts[counts >= 2].min())
+    return [(np.sort(np.concatenate([rows[train], single_rows])), rows[test])
+            for train, test in StratifiedKFold(n_splits=n_splits).split(rows, Y[rows])]
+
+
+def fit_fold(clf, keep_model, X, Y, fold):
+    """Fit a copy of a classifier on the training rows of a fold and predict
+        its test rows.  Run in a worker process by cross_validate_model.
+    """
+    train, test = fold
+    fold_clf = clone(clf)
+    fold_clf.fit(X[train], Y[train])
+    return (fold_clf if keep_model else None), fold_clf.predict(X[test])
+
+
+def fold_ensemble_usable(fold_models, Y):
+    """The fold models can only be averaged if each one saw every label"""
+    classes = np.unique(Y)
+    return all(np.array_equal(fold_model.classes_, classes) for fold_model in fold_models)
+
+
+def make_fold_ensemble(clf, fold_models, Y):
+    """Combine the models fit on each fold into one classifier that averages
+        their probabilities.  A soft VotingClassifier is filled in with the
+        already fitted models, so the pickle is a plain scikit-learn object.
+
+    Args:
+        clf: The unfitted classifier the folds were fit from
+        fold_models: List of the fitted fold models
+        Y: List of the labels
+    Returns:
+        ensemble: Fitted VotingClassifier
+    """
+    ensemble = VotingClassifier([('fold_' + str(i), clf) for i in range(len(fold_models))],
+                                voting='soft')
+    ensemble.estimators_ = fold_models
+    ensemble.le_ = LabelEncoder().fit(Y)
+    ensemble.classes_ = ensemble.le_.classes_
+    return ensemble
+
+
+def get_labeled_arrays(labeled_data):
+    """Fetch the upload_id and label of labeled data in one query.  The rows
+        are ordered by upload_id_hash so the cross validation folds are the
+        same each time the same data is trained on.
+
+    Args:
+        labeled_data: Queryset of DataLabel objects
+    Returns:
+        upload_ids: numpy array of the upload_id of each datum
+        labels: numpy array of the pk of each datum's label
+    """
+    rows = list(labeled_data.order_by('data__upload_id_hash').values_list('data__upload_id', 'label'))
+    if len(rows) == 0:
+        return np.array([], dtype=str), np.array([], dtype=np.int64)
+    upload_ids, labels = zip(*rows)
+    return np.array(upload_ids, dtype=str), np.array(labels, dtype=np.int64)
+
+
+def get_labeled_features(project, tf_idf, labeled_data):
+    """Gather the features and labels of labeled data, in the order of
+        get_labeled_arrays.  Labeled data with no features is left out and
+        logged, ex: data an embeddings project has no embedding uploaded for.
+
+    Args:
+        project: Project object
+        tf_idf: FeatureStore holding the feature matrix
+        labeled_data: Queryset of DataLabel objects
+    Returns:
+        X: CSR matrix with a row for each labeled datum that has features
+        Y: numpy array of the pk of each row's label
+    """
+    upload_ids, Y = get_labeled_arrays(labeled_data)
+    rows, found = tf_idf.find(upload_ids)
+    if not found.all():
+        logger.warning('Project %s has no features for %d labeled data, which are left out of training',
+                       project.pk, int((~found).sum()))
+    return tf_idf.gather(rows[found]), Y[found]
+
+
+def search_hyperparameters(project):
+    """Find the settings in SEARCH_GRIDS that give the project's classifier
+        the best macro F1 score over the project's cross validation folds, and
+        save them in project.classifier_params for get_classifier to use.  The
+        candidates are scored in settings.SEARCH_N_JOBS worker processes,
+        which share the features, on the same snapshot of them training uses.
+
+    Args:
+        project: Project object
+    Returns:
+        params: The best settings, or None if the classifier has nothing to
+            search or there are too few labels with features
+    """
+    grid = SEARCH_GRIDS.get(project.classifier)
+    labeled_data = DataLabel.objects.filter(data__project=project)
+    if (grid is None or embeddings_missing(project)
+            or labeled_data.values('label').distinct().count() < 2):
+        return None
+
+    feature_path = snapshot_tfidf_matrix(project.pk)
+    tf_idf = load_tfidf_snapshot(feature_path)
+    X, Y = get_labeled_features(project, tf_idf, labeled_data)
+    if len(np.unique(Y)) < 2:
+        return None
+    candidates = list(ParameterGrid(grid))
+    clfs = [get_classifier(project, params) for params in candidates]
+    X = prepare_features(project, feature_path, clfs[0], X)
+    folds = get_cv_folds(project, Y)
+
+    if settings.SEARCH_N_JOBS > 1:
+        scores = list(pool_map(score_classifier, clfs, settings.SEARCH_N_JOBS, shared=(X, Y, folds)))
+    else:
+        scores = [score_classifier(X, Y, folds, clf) for clf in clfs]
+
+    params = candidates[int(np.argmax(scores))]
+    project.classifier_params = dict(project.classifier_params, **{project.classifier: params})
+    project.save(update_fields=['classifier_params'])
+    return params
+
+
+def score_classifier(X, Y, folds, clf):
+    """The mean macro F1 score of a classifier over cross validation folds.
+        Run in a worker process by search_hyperparameters.
+    """
+    scores = []
+    for train, test in folds:
+        fold_clf = clone(clf).fit(X[train], Y[train])
+        scores.append(f1_score(Y[test], fold_clf.predict(X[test]), average='macro'))
+    return np.mean(scores)
+
+
+def get_incremental_model(project, feature_path, last_label_pk):
+    """Find the model an incremental classifier can be updated from.  The
+        classifier is refit on every label instead if the previous model was
+        trained on different features, has seen every label already or has
+        been updated settings.INCREMENTAL_REFIT_INTERVAL times, so that it
+        does not drift too far from a model fit on all the labels.  It is
+        also refit if a label the previous model learned was changed (see
+        LabelChangeLog) or deleted, ex: when IRR labels are resolved, since
+        updating can only add labels.
+
+    Args:
+        project: Project object
+        feature_path: The feature matrix snapshot the new model will use
+        last_label_pk: The newest DataLabel the new model will learn from
+    Returns:
+        model: The previous Model object, or None to fit a new classifier
+    """
+    if project.classifier != "sgd":
+        return None
+    previous = Model.objects.filter(project=project).order_by('-training_set__set_number', '-pk').first()
+    if (previous is None or not previous.feature_path
+            or previous.incremental_updates >= settings.INCREMENTAL_REFIT_INTERVAL
+            or previous.last_label_pk >= last_label_pk
+            or not os.path.isfile(previous.pickle_path)
+            or LabelChangeLog.objects.filter(project=project, pk__gt=previous.last_change_pk).exists()
+            or DataLabel.objects.filter(data__project=project,
+                                        pk__lte=previous.last_label_pk).count() != previous.label_count):
+        return None
+
+    # A refit vectorizer starts a new generation of the features, which the
+    # previous classifier's coefficients do not line up with
+    if read_meta(previous.feature_path).get('generation') != read_meta(feature_path).get('generation'):
+        return None
+
+    clf = load_classifier(previous)
+    labels = set(Label.objects.filter(project=project).values_list('pk', flat=True))
+    if not isinstance(clf, SGDClassifier) or set(clf.classes_) != labels:
+        return None
+
+    return previous
+
+
 def predict_data(project, model):
     """Given a project and its model, predict any unlabeled data and create
         Prediction objects for each.  There will be #label * #unlabeled_data
         predictions.  This is because we are saving the probability of each label
-        for every data.
+        for every data.  The unlabeled data is read, predicted and written
+        settings.PREDICTION_CHUNK_SIZE at a time, so memory use does not grow
+        with the size of the project.  The chunks are predicted in
+        settings.PREDICTION_N_JOBS worker processes, and written in order as
+        they finish; the predictions are only committed once every chunk is.
 
     Args:
         project: Project object
         model: Model object
     Returns:
-        predictions: List of DataPrediction objects
+        predictions: Queryset of the model's DataPrediction objects
     """
-    clf = joblib.load(model.pickle_path)
-    tf_idf = load_tfidf_matrix(project.pk)
-
-    # In order to predict need X (tf-idf vector) for every unlabeled datum. Order
-    # X by upload_id_hash to ensure the tf-idf vector corresponds to the correct datum
     recycle_data = RecycleBin.objects.filter(data__project=project).values_list('pk', flat=True)
     unlabeled_data = project.data_set.filter(datalabel__isnull=True).exclude(
-        pk__in=recycle_data).order_by('upload_id_hash')
-    unique_ids = list(unlabeled_data.values_list("upload_id", flat=True).order_by('upload_id_hash'))
+        pk__in=recycle_data).order_by('upload_id_hash').values_list('pk', 'upload_id')
+
+    predict = partial(predict_chunk, project, model)
+    if settings.PREDICTION_N_JOBS > 1:
+        # Load the classifier and features before the workers are forked, so
+        # they share the loaded copies instead of each loading their own
+        load_classifier(model)
+        if model.feature_path:
+            load_tfidf_snapshot(model.feature_path)
+
+    # The queue is filled from the uncertainties, so it never sees some of them
+    with transaction.atomic():
+        chunks = iterate_query(unlabeled_data, settings.PREDICTION_CHUNK_SIZE)
+        if settings.PREDICTION_N_JOBS > 1:
+            results = pool_map(predict, chunks, settings.PREDICTION_N_JOBS)
+        else:
+            results = map(predict, chunks)
+        for data_pks, label_pks, probs, scores in results:
+            create_predictions_from_probs(model, data_pks, label_pks, probs)
+            create_uncertainty_from_scores(model, data_pks, scores)
+
+    return DataPrediction.objects.filter(model=model)
+
+
+def predict_chunk(project, model, chunk):
+    """Predict the probability of each label for a chunk of data, and score
+        the model's uncertainty about each datum.  The classifier and features
+        come from the process's load cache.  Run in a worker process by
+        predict_data, so it does not use the database.
+
+    Args:
+        project: Project object
+        model: Model object
+        chunk: List of (pk, upload_id) of the data
+    Returns:
+        data_pks: Array of the pk of each datum that was predicted
+        label_pks: Array of the label of each column of probs
+        probs: Array of the predicted probabilities, a row per datum
+        scores: Dict of the uncertainty scores (see uncertainty_scores)
+    """
+    clf = load_classifier(model)
+    # Use the features the model was trained on
+    if model.feature_path:
+        tf_idf = load_tfidf_snapshot(model.feature_path)
+    else:
+        tf_idf = load_tfidf_matrix(project.pk)
+
+    data_pks = np.array([pk for pk, upload_id in chunk], dtype=np.int64)
+    # Data added since the model's snapshot has no features in it, so it is
+    # left for the next model to predict
+    rows, found = tf_idf.find([upload_id for pk, upload_id in chunk])
+    if found.any():
+        X = prepare_features(project, model.feature_path, clf, tf_idf.gather(rows[found]))
+        probs = clf.predict_proba(X)
+    else:
+        # The classifier can't predict zero rows, ex: a chunk of a large upload
+        probs = np.zeros((0, len(clf.classes_)))
+    return data_pks[found], clf.classes_, probs, uncertainty_scores(probs)
+
+
+def create_predictions_from_probs(model, data_pks, label_pks, probs):
+    '''
+    Insert the DataPrediction objects of a model into the database using
+    cursor.copy_from, straight from the predicted probabilities.  Each row of
+    probs is the probability of each of label_pks for the datum in data_pks,
+    and settings.PREDICTION_COPY_ROWS data are written at a time.
+    '''
+    label_pks = np.asarray(label_pks, dtype=np.int64)
+    for start in range(0, len(data_pks), settings.PREDICTION_COPY_ROWS):
+        chunk = probs[start:start + settings.PREDICTION_COPY_ROWS]
+        df = pd.DataFrame(OrderedDict([
+            ('data_id', np.repeat(data_pks[start:start + len(chunk)], len(label_pks))),
+            ('model_id', model.pk),
+            ('label_id', np.tile(label_pks, len(chunk))),
+            ('predicted_probability', chunk.ravel()),
+        ]))
+        copy_dataframe(df, DataPrediction._meta.db_table)
+
+
+def create_uncertainty_from_scores(model, data_pks, scores):
+    '''
+    Insert the DataUncertainty objects of a model into the database using
+    cursor.copy_from by creating an in-memory tsv representation of them
+    '''
+    df = pd.DataFrame(scores, columns=list(UNCERTAINTY_SCORES))
+    df.insert(0, 'data_id', data_pks)
+    df.insert(1, 'model_id', model.pk)
+    copy_dataframe(df, DataUncertainty._meta.db_table)
+
+
+def copy_dataframe(df, table):
+    '''
+    Insert the rows of a dataframe into a table with cursor.copy_from, the
+    columns of the dataframe naming the columns of the table
+    '''
+    stream = StringIO()
+    df.to_csv(stream, sep='\t', header=False, index=False, float_format='%.17g')
+    stream.seek(0)
+
+    with connection.cursor() as c:
+        c.copy_from(stream, table, sep='\t', null='', columns=list(df.columns))
+
+
+def score_texts(project, texts):
+    """Predict the probability of each label for texts that need not be in
+        the project, with the project's latest model.  The texts are
+        transformed with the vectorizer the model was trained with, and
+        scored settings.SCORE_CHUNK_SIZE at a time.  The vectorizer and
+        classifier stay cached in the process between calls.
+
+    Args:
+        project: Project object
+        texts: List of strings
+    Returns:
+        model: The Model object used
+        probabilities: Array with a row for each text and a column for each
+            label in model classifier's classes_
+    """
+    if project.feature_extractor == "embeddings":
+        raise ValueError('Project ' + str(project.pk) + ' uses uploaded embeddings, so it cannot score text')
+    model = Model.objects.filter(project=project).order_by('-training_set__set_number', '-pk').first()
+    if model is None:
+        raise ValueError('There is no model for project: ' + str(project.pk))
+
+    clf = load_classifier(model)
+    vectorizer = load_snapshot_vectorizer(project.pk, model.feature_path)
+    probabilities = [np.zeros((0, len(clf.classes_)))]
+    for i in range(0, len(texts), settings.SCORE_CHUNK_SIZE):
+        X = vectorizer.transform(texts[i:i + settings.SCORE_CHUNK_SIZE])
+        probabilities.append(clf.predict_proba(prepare_features(project, model.feature_path, clf, X)))
+    return model, np.vstack(probabilities)
+
+
+def load_snapshot_vectorizer(project_pk, feature_path):
+    """Load the vectorizer saved in a feature snapshot, or the project's
+        current one for a model trained before snapshots.  The vectorizer is
+        cached in the process until the file changes.
+
+    Args:
+        project_pk: The project pk the snapshot belongs to
+        feature_path: The directory of the snapshot, may be empty
+    Returns:
+        vectorizer: The fitted vectorizer
+    """
+    if not feature_path:
+        return load_tfidf_vectorizer(project_pk)
+    fpath = os.path.join(feature_path, os.path.basename(get_tfidf_vectorizer_path(project_pk)))
+
+    def load():
+        with open(fpath, "rb") as file:
+            return pickle.load(file)
+
+    if os.path.isfile(fpath):
+        return cache_load(('vectorizer', fpath), fpath, load)
+    else:
+        raise ValueError('There was no vectorizer found in the snapshot: ' + feature_path)
+
+
+def load_classifier(model):
+    """Load the classifier of a Model from its pickle.  The latest classifier
+        of each project is cached in the process until the file changes.
+
+    Args:
+        model: Model object
+    Returns:
+        clf: The fitted classifier
+    """
+    return cache_load(('classifier', model.project_id), model.pickle_path,
+                      lambda: read_classifier(model.pickle_path))
+
+
+def get_coefficients_path(pickle_path):
+    """The path of the coefficient file saved beside a linear model's pickle"""
+    return os.path.splitext(pickle_path)[0] + '_coef.npz'
+
+
+def save_classifier(clf, fpath):
+    """Save a fitted classifier as a compressed joblib pickle.  A logistic
+        regression also has its coefficients saved to a plain numpy file, which
+        read_classifier loads much faster than the pickle.
+
+    Args:
+        clf: The fitted classifier
+        fpath: The path of the pickle
+    """
+    coef_path = get_coefficients_path(fpath)
+    if type(clf) is LogisticRegression:
+        with open(coef_path, 'wb') as coef_file:
+            np.savez(coef_file, coef=clf.coef_, intercept=clf.intercept_, classes=clf.classes_,
+                     n_iter=clf.n_iter_, params=json.dumps(clf.get_params()))
+    elif os.path.isfile(coef_path):
+        os.remove(coef_path)
+    joblib.dump(clf, fpath, compress=settings.MODEL_COMPRESSION)
 
-    # get the list of all data sorted by identifier
-    X = [tf_idf[id] for id in unique_ids]
-    predictions = clf.predict_proba(X)
 
-    label_obj = [Label.objects.get(pk=label) for label in clf.classes_]
+def read_classifier(fpath):
+    """Read a classifier saved by save_classifier, from its coefficients if
+        it has them
 
-    bulk_predictions = []
-    for datum, prediction in zip(unlabeled_data, predictions):
-        # each prediction is an array of probabilities.  Each index in that array
-        # corresponds to the label of the same index in clf.classes_
-        for p, label in zip(prediction, label_obj):
-            bulk_predictions.append(DataPrediction(data=datum, model=model,
-                                                   label=label,
-                                                   predicted_probability=p))
+    Args:
+        fpath: The path of the pickle
+    Returns:
+        clf: The fitted classifier
+    """
+    coef_path = get_coefficients_path(fpath)
+    if not os.path.isfile(coef_path):
+        return joblib.load(fpath)
+
+    with np.load(coef_path) as arrays:
+        clf = LogisticRegression(**json.loads(str(arrays['params'])))
+        clf.coef_ = arrays['coef']
+        clf.intercept_ = arrays['intercept']
+        clf.classes_ = arrays['classes']
+        clf.n_iter_ = arrays['n_iter']
+    return clf
+
+
+def delete_old_models(project):
+    """Delete the saved classifiers of a project's old models.  The newest
+        settings.MODEL_RETENTION models are kept, along with the model whose
+        predictions are the latest ones.  The Model rows are kept for their
+        metrics.  The feature snapshots only the deleted models used are
+        deleted too (see delete_old_snapshots).
+
+    Args:
+        project: Project object
+    Returns:
+        deleted: List of the pickle paths that were deleted
+    """
+    models = Model.objects.filter(project=project).order_by('-training_set__set_number', '-pk')
+    keep = set(models.values_list('pk', flat=True)[:settings.MODEL_RETENTION])
+    predicted = models.filter(pk__in=DataPrediction.objects.filter(
+        model__project=project).values('model')).first()
+    if predicted is not None:
+        keep.add(predicted.pk)
+
+    deleted = []
+    for pickle_path in models.exclude(pk__in=keep).values_list('pickle_path', flat=True):
+        # A pickle can be shared by a kept model, ex: one retrained in the same set
+        if not os.path.isfile(pickle_path) or models.filter(pk__in=keep, pickle_path=pickle_path).exists():
+            continue
+        for path in (pickle_path, get_coefficients_path(pickle_path)):
+            if os.path.isfile(path):
+                os.remove(path)
+        deleted.append(pickle_path)
 
-        # Need to crate uncertainty object so fill_queue can sort by one of the metrics
-        lc = least_confident(prediction)
-        ms = margin_sampling(prediction)
-        e = entropy(prediction)
+    feature_paths = models.filter(pk__in=keep).values_list('feature_path', flat=True)
+    delete_old_snapshots(project.pk, {os.path.basename(path) for path in feature_paths if path})
+    return deleted
 
-        DataUncertainty.objects.create(data=datum,
-                                       model=model,
-                                       least_confident=lc,
-                                       margin_sampling=ms,
-                                       entropy=e)
 
-    prediction_objs = DataPrediction.objects.bulk_create(bulk_predictions)
+def delete_old_snapshots(project_pk, keep):
+    """Delete a project's feature snapshots, other than the ones kept models
+        use and the one of the current version of the matrix, which the next
+        model is trained on.  The files of old versions of the matrix are
+        only kept on disk by their snapshots, so this frees them too.  It must
+        not run during the project's training, whose snapshot no model
+        refers to yet.
 
-    return prediction_objs
+    Args:
+        project_pk: The pk of the project
+        keep: Set of the names of the snapshots to keep
+    Returns:
+        deleted: List of the snapshot directories that were deleted
+    """
+    snapshot_dir = get_snapshot_dir(project_pk)
+    if not os.path.isdir(snapshot_dir):
+        return []
+
+    deleted = []
+    with tfidf_lock(project_pk):
+        fpath = get_tfidf_matrix_path(project_pk)
+        if os.path.isdir(fpath):
+            keep = keep | {snapshot_name(fpath)}
+        for name in sorted(os.listdir(snapshot_dir)):
+            # Names starting with . are snapshots being written
+            if name in keep or name.startswith('.'):
+                continue
+            shutil.rmtree(os.path.join(snapshot_dir, name))
+            deleted.append(os.path.join(snapshot_dir, name))
+    return deleted
+
+
+def get_vectorizer(feature_extractor, max_df=0.995, min_df=0.005):
+    """Given the name of a project's feature extractor, create its vectorizer
+
+    Args:
+        feature_extractor: One of the text extractors in Project.FEATURE_CHOICES
+        max_df: Maximum document frequency of a term (word TF-IDF only)
+        min_df: Minimum document frequency of a term (word TF-IDF only)
+    Returns:
+        vectorizer: The unfitted vectorizer
+    """
+    if feature_extractor == "tfidf":
+        return TfidfVectorizer(max_df=max_df, min_df=min_df, stop_words='english')
+    elif feature_extractor == "char hashing":
+        # Hashing needs no fitted vocabulary, so it takes one pass and a fixed
+        # amount of memory however large the project gets
+        return HashingVectorizer(analyzer='char_wb', ngram_range=(2, 4),
+                                 n_features=2 ** 18, alternate_sign=False)
+    else:
+        raise ValueError('There is no vectorizer for feature extractor: ' + str(feature_extractor))
 
 
 def create_tfidf_matrix(project_pk, max_df=0.995, min_df=0.005):
-    """Create a TF-IDF matrix. Make sure to order the data by upload_id_hash so that we
-        can sync the data up again when training the model
+    """Create a project's feature matrix with the vectorizer of its feature
+        extractor (a TF-IDF matrix by default).  The project data is streamed
+        from the database in chunks and fed to the vectorizer as it arrives, so
+        the text of the whole project is never held in memory at once.  If
+        settings.TFIDF_N_JOBS is more than one, the chunks are tokenized in that
+        many processes.
 
     Args:
         project_pk: The pk of the project
     Returns:
-        tf_idf_matrix: CSR-format tf-idf matrix
+        feature_store: FeatureStore holding the CSR-format feature matrix
+        fitted_vectorizer: The fitted vectorizer
     """
-    project_data = Data.objects.filter(project__pk=project_pk)
-    id_list = list(project_data.values_list('upload_id', flat=True).order_by('upload_id_hash'))
-    data_list = list(project_data.values_list('text', flat=True).order_by('upload_id_hash'))
+    feature_extractor = Project.objects.values_list('feature_extractor', flat=True).get(pk=project_pk)
+    vectorizer = get_vectorizer(feature_extractor, max_df, min_df)
+
+    id_list = []
+    max_data_pk = 0
+
+    def stream_text():
+        nonlocal max_data_pk
+        for chunk in iterate_project_data(project_pk):
+            id_list.extend(upload_id for pk, upload_id, text in chunk)
+            max_data_pk = chunk[-1][0]
+            yield [text for pk, upload_id, text in chunk]
+
+    if isinstance(vectorizer, HashingVectorizer):
+        # Stateless, there is nothing to fit
+        if settings.TFIDF_N_JOBS > 1:
+            tf_idf_matrix = parallel_transform(vectorizer, stream_text(), settings.TFIDF_N_JOBS)
+        else:
+            tf_idf_matrix = vectorizer.transform(text for chunk in stream_text() for text in chunk)
+    elif settings.TFIDF_N_JOBS > 1:
+        tf_idf_matrix = parallel_fit_transform(vectorizer, stream_text(), settings.TFIDF_N_JOBS)
+    else:
+        # fit_transform only iterates over the text once
+        tf_idf_matrix = vectorizer.fit_transform(text for chunk in stream_text() for text in chunk)
+
+    feature_store = FeatureStore(tf_idf_matrix, id_list)
+    # Record what the vectorizer was fit on so later uploads can be appended
+    feature_store.info = {'feature_extractor': feature_extractor,
+                          'fitted_rows': len(id_list), 'max_data_pk': max_data_pk}
+
+    return feature_store, vectorizer
+
+
+def iterate_project_data(project_pk, chunk_size=None):
+    """Read the (pk, upload_id, text) of all of a project's data, ordered by pk,
+        in a single pass over a server-side cursor
+
+    Args:
+        project_pk: The pk of the project
+        chunk_size: Rows fetched per round trip [default: settings.TFIDF_CHUNK_SIZE]
+    Yields:
+        chunk: List of (pk, upload_id, text) tuples
+    """
+    if chunk_size is None:
+        chunk_size = settings.TFIDF_CHUNK_SIZE
+    project_data = Data.objects.filter(project__pk=project_pk).order_by('pk').values_list(
+        'pk', 'upload_id', 'text')
+    return iterate_query(project_data, chunk_size)
+
+
+def iterate_query(queryset, chunk_size):
+    """Read the rows of a values_list queryset in a single pass over a
+        server-side cursor
+
+    Args:
+        queryset: The values_list queryset
+        chunk_size: Rows fetched per round trip
+    Yields:
+        chunk: List of tuples of the values
+    """
+    sql, params = queryset.query.sql_with_params()
+
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(sql, params)
+        while True:
+            chunk = cursor.fetchmany(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def update_tfidf_matrix(project_pk):
+    """Bring a project's tf-idf matrix up to date with its data.  Data added
+        since the vectorizer was fit is transformed with the saved vectorizer and
+        appended to the matrix, so the work done scales with the size of the
+        upload.  The vectorizer (vocabulary and idf weights) is refit on all the
+        project data when there is no matrix yet, or once the appended data grows
+        past settings.TFIDF_REFIT_FRACTION of the data it was fit on.
 
-    vectorizer = TfidfVectorizer(max_df=max_df, min_df=min_df, stop_words='english')
-    fitted_vectorizer = vectorizer.fit(data_list)
+        Projects using uploaded embeddings have nothing to compute, their
+        matrix only changes when embeddings are uploaded (see save_embeddings).
+        Only one process at a time can update a project's matrix.
 
-    tf_idf_matrix = fitted_vectorizer.transform(data_list)
+    Args:
+        project_pk: The pk of the project
+    Returns:
+        file: The path to the directory holding the saved matrix, None if
+            embeddings have not been uploaded yet
+    """
+    with tfidf_lock(project_pk):
+        feature_extractor = Project.objects.values_list('feature_extractor', flat=True).get(pk=project_pk)
+        if feature_extractor == "embeddings":
+            fpath = get_tfidf_matrix_path(project_pk)
+            return fpath if os.path.isdir(fpath) else None
+
+        try:
+            tf_idf = load_tfidf_matrix(project_pk)
+            vectorizer = load_tfidf_vectorizer(project_pk)
+        except ValueError:
+            return refit_tfidf_matrix(project_pk)
+
+        info = tf_idf.info
+        if 'max_data_pk' not in info or info.get('feature_extractor', 'tfidf') != feature_extractor:
+            return refit_tfidf_matrix(project_pk)
+
+        new_data = Data.objects.filter(project__pk=project_pk, pk__gt=info['max_data_pk'])
+        num_new = new_data.count()
+        # If the matrix is missing rows that aren't new (ex: they were committed
+        # out of pk order) appending can't fix it, so start over
+        if Data.objects.filter(project__pk=project_pk).count() != len(tf_idf) + num_new:
+            return refit_tfidf_matrix(project_pk)
+
+        fpath = get_tfidf_matrix_path(project_pk)
+        if num_new == 0:
+            return fpath
+
+        # A hashing vectorizer has nothing fit to the data, so never needs a refit
+        num_appended = len(tf_idf) + num_new - info['fitted_rows']
+        if (not isinstance(vectorizer, HashingVectorizer)
+                and num_appended > settings.TFIDF_REFIT_FRACTION * info['fitted_rows']):
+            return refit_tfidf_matrix(project_pk)
+
+        new_rows = list(new_data.values_list('pk', 'upload_id', 'text').order_by('pk'))
+        texts = [text for pk, upload_id, text in new_rows]
+        if settings.TFIDF_N_JOBS > 1:
+            chunk_size = settings.TFIDF_CHUNK_SIZE
+            tf_idf_matrix = parallel_transform(vectorizer,
+                                               (texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)),
+                                               settings.TFIDF_N_JOBS)
+        else:
+            tf_idf_matrix = vectorizer.transform(texts)
+
+        return append_feature_store(FeatureStore(tf_idf_matrix, [upload_id for pk, upload_id, text in new_rows]),
+                                    fpath, info={'max_data_pk': new_rows[-1][0]})
+
+
+def refit_tfidf_matrix(project_pk):
+    """Fit a new vectorizer on all of a project's data and save it along with
+        the tf-idf matrix
+
+    Args:
+        project_pk: The pk of the project
+    Returns:
+        file: The path to the directory holding the saved matrix
+    """
+    tf_idf, vectorizer = create_tfidf_matrix(project_pk)
+    fpath = save_tfidf_matrix(tf_idf, project_pk)
+    save_tfidf_vectorizer(vectorizer, project_pk)
 
-    new_dict = dict(zip(id_list, np.matrix.tolist(sparse.csr_matrix.todense(tf_idf_matrix))))
+    return fpath
 
-    return new_dict, fitted_vectorizer
+
+@contextmanager
+def tfidf_lock(project_pk):
+    """Hold a lock on a project's feature matrix, so that two processes never
+        change it (or snapshot it while it changes) at the same time
+    """
+    os.makedirs(settings.TF_IDF_PATH, exist_ok=True)
+    lock_path = os.path.join(settings.TF_IDF_PATH, 'project_' + str(project_pk) + '_tfidf_matrix.lock')
+    with open(lock_path, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def snapshot_tfidf_matrix(project_pk):
+    """Take a snapshot of the current version of a project's feature matrix
+        and vectorizer for a model to be trained on.  The snapshot never
+        changes, so the model can always be used with exactly the features it
+        was trained on.  If the matrix has not changed since the last snapshot
+        that snapshot is reused.
+
+    Args:
+        project_pk: The pk of the project
+    Returns:
+        snapshot_path: The directory of the snapshot
+    """
+    fpath = get_tfidf_matrix_path(project_pk)
+    snapshot_dir = get_snapshot_dir(project_pk)
+    os.makedirs(snapshot_dir, exist_ok=True)
+
+    with tfidf_lock(project_pk):
+        if not os.path.isdir(fpath):
+            raise ValueError('There was no tfidf matrix found for project: ' + str(project_pk))
+        snapshot_path = os.path.join(snapshot_dir, snapshot_name(fpath))
+        if not os.path.isdir(snapshot_path):
+            vectorizer_path = get_tfidf_vectorizer_path(project_pk)
+            snapshot_feature_store(fpath, snapshot_path,
+                                   [vectorizer_path] if os.path.isfile(vectorizer_path) else [])
+
+    return snapshot_path
+
+
+def load_tfidf_snapshot(snapshot_path):
+    """Load a feature matrix snapshot made by snapshot_tfidf_matrix.  Like
+        load_tfidf_matrix the matrix is memory-mapped and cached in the process.
+
+    Args:
+        snapshot_path: The directory of the snapshot
+    Returns:
+        FeatureStore holding the CSR-format feature matrix
+    """
+    return cache_load(('snapshot', snapshot_path), os.path.join(snapshot_path, 'meta.json'),
+                      lambda: load_feature_store(snapshot_path))
+
+
+def prepare_features(project, feature_path, clf, X):
+    """Get rows of a feature matrix ready for a classifier, reducing their
+        dimension first if the classifier needs it (see get_reducer)
+
+    Args:
+        project: Project object
+        feature_path: The feature snapshot the rows come from, may be empty
+        clf: The classifier
+        X: CSR matrix of rows from the snapshot
+    Returns:
+        X: The features to give the classifier
+    """
+    if isinstance(clf, VotingClassifier):
+        # A fold ensemble takes the same features as its models
+        clf = clf.estimators_[0]
+    if isinstance(clf, REDUCED_CLASSIFIERS) and feature_path:
+        reducer = get_reducer(project, feature_path)
+        if reducer is not None:
+            X = reducer.transform(X)
+    if isinstance(clf, DENSE_ONLY_CLASSIFIERS) and sparse.issparse(X):
+        X = X.toarray()
+    return X
+
+
+def get_reducer(project, feature_path):
+    """Get the project's dimensionality reduction for a feature snapshot.  It
+        is fit the first time it is needed and saved in the snapshot, so every
+        model trained on the snapshot shares it.
+
+    Args:
+        project: Project object
+        feature_path: The directory of a feature snapshot
+    Returns:
+        reducer: The fitted reducer, or None if the project does not use one
+            or the features are already narrow
+    """
+    if project.reduction == "none":
+        return None
+    fpath = os.path.join(feature_path, 'reducer_' + project.reduction.replace(' ', '_') + '.pkl')
+    if os.path.isfile(fpath):
+        return cache_load(('reducer', fpath), fpath, lambda: joblib.load(fpath))
+
+    tf_idf = load_tfidf_snapshot(feature_path)
+    if tf_idf.shape[1] <= settings.REDUCTION_COMPONENTS:
+        return None
+    reducer = fit_reducer(project.reduction, tf_idf)
+
+    temp_fpath = fpath + '.tmp'
+    joblib.dump(reducer, temp_fpath)
+    os.replace(temp_fpath, fpath)
+    cache_put(('reducer', fpath), fpath, reducer)
+
+    return reducer
+
+
+def fit_reducer(reduction, tf_idf):
+    """Fit a dimensionality reduction on a feature matrix.  Only a random
+        sample of settings.REDUCTION_SAMPLE_SIZE rows is used to fit it.
+
+    Args:
+        reduction: One of the reductions in Project.REDUCTION_CHOICES
+        tf_idf: FeatureStore holding the feature matrix
+    Returns:
+        reducer: The fitted reducer, with settings.REDUCTION_COMPONENTS components
+    """
+    if reduction == "svd":
+        reducer = TruncatedSVD(n_components=settings.REDUCTION_COMPONENTS, random_state=0)
+    elif reduction == "random projection":
+        reducer = SparseRandomProjection(n_components=settings.REDUCTION_COMPONENTS,
+                                         dense_output=True, random_state=0)
+    else:
+        raise ValueError('There was no valid dimensionality reduction: ' + str(reduction))
+
+    rows = np.arange(len(tf_idf))
+    if len(rows) > settings.REDUCTION_SAMPLE_SIZE:
+        rows = np.sort(np.random.RandomState(0).choice(rows, settings.REDUCTION_SAMPLE_SIZE,
+                                                       replace=False))
+    return reducer.fit(tf_idf.gather(rows))
+
+
+def save_embeddings(project, embeddings):
+    """Save uploaded embedding vectors as the feature matrix of a project that
+        uses the "embeddings" feature extractor.  Vectors for IDs that already
+        have one are replaced and the rest of the existing vectors are kept.
+
+    Args:
+        project: Project object
+        embeddings: DataFrame with an ID column matching the upload_id of the
+            data, and one numeric column per dimension
+    Returns:
+        file: The path to the directory holding the saved matrix
+    """
+    if project.feature_extractor != "embeddings":
+        raise ValueError('Project ' + str(project.pk) + ' does not use uploaded embeddings')
+    if 'ID' not in embeddings.columns or len(embeddings.columns) < 2:
+        raise ValueError('Embeddings must have an ID column and at least one value column')
+    if embeddings['ID'].isnull().any() or embeddings['ID'].astype(str).duplicated().any():
+        raise ValueError('Embedding IDs must be present and unique')
+    try:
+        vectors = embeddings.drop('ID', axis=1).values.astype(np.float64)
+    except ValueError:
+        raise ValueError('Embedding values must all be numbers')
+    if not np.isfinite(vectors).all():
+        raise ValueError('Embeddings cannot have missing values')
+
+    feature_store = FeatureStore(vectors, embeddings['ID'].astype(str).values)
+    with tfidf_lock(project.pk):
+        try:
+            existing = load_tfidf_matrix(project.pk)
+        except ValueError:
+            existing = None
+        if existing is not None and existing.shape[1] == feature_store.shape[1]:
+            rows, replaced = feature_store.find(existing.upload_ids)
+            kept_rows = np.where(~replaced)[0]
+            if len(kept_rows) > 0:
+                feature_store = FeatureStore(
+                    sparse.vstack([existing.gather(kept_rows), feature_store.matrix], format='csr'),
+                    np.concatenate([np.asarray(existing.upload_ids)[kept_rows], feature_store.upload_ids]))
+        feature_store.info = {'feature_extractor': 'embeddings'}
+
+        return save_tfidf_matrix(feature_store, project.pk)
 
 
 def save_tfidf_matrix(matrix, project_pk):
@@ -369,16 +1419,12 @@ def save_tfidf_matrix(matrix, project_pk):
         TF_IDF_PATH
 
     Args:
-        matrix: CSR-format tf-idf matrix
+        matrix: FeatureStore holding the CSR-format tf-idf matrix
         project_pk: The project pk the data comes from
     Returns:
-        file: The filepath to the saved matrix
+        file: The path to the directory holding the saved matrix
     """
-    fpath = os.path.join(settings.TF_IDF_PATH, 'project_' + str(project_pk) + '_tfidf_matrix.pkl')
-    with open(fpath, "wb") as tfidf_file:
-        pickle.dump(matrix, tfidf_file)
-
-    return fpath
+    return save_feature_store(matrix, get_tfidf_matrix_path(project_pk), info=matrix.info)
 
 
 def save_tfidf_vectorizer(vectorizer, project_pk):
@@ -391,24 +1437,74 @@ def save_tfidf_vectorizer(vectorizer, project_pk):
     Returns:
         file: The filepath to the saved matrix
     """
-    fpath = os.path.join(settings.TF_IDF_PATH, 'project_' + str(project_pk) + '_vectorizer.pkl')
-    with open(fpath, "wb") as tfidf_file:
+    fpath = get_tfidf_vectorizer_path(project_pk)
+    # Write a new file rather than over the old one, which snapshots may link to
+    temp_fpath = fpath + '.tmp'
+    with open(temp_fpath, "wb") as tfidf_file:
         pickle.dump(vectorizer, tfidf_file)
+    os.replace(temp_fpath, fpath)
+    cache_put(('vectorizer', project_pk), fpath, vectorizer)
     return fpath
 
 
-def load_tfidf_matrix(project_pk):
-    """Load tf-idf matrix from persistent volume, otherwise None
+def load_tfidf_vectorizer(project_pk):
+    """Load the fitted tf-idf vectorizer from persistent volume.  The vectorizer
+        is cached in the process until the file changes.
 
     Args:
         project_pk: The project pk the data comes from
     Returns:
-        matrix or None
+        vectorizer: The fitted TfidfVectorizer
     """
-    fpath = os.path.join(settings.TF_IDF_PATH, 'project_' + str(project_pk) + '_tfidf_matrix.pkl')
+    fpath = get_tfidf_vectorizer_path(project_pk)
 
-    if os.path.isfile(fpath):
+    def load():
         with open(fpath, "rb") as file:
             return pickle.load(file)
+
+    if os.path.isfile(fpath):
+        return cache_load(('vectorizer', project_pk), fpath, load)
+    else:
+        raise ValueError('There was no tfidf vectorizer found for project: ' + str(project_pk))
+
+
+def get_tfidf_vectorizer_path(project_pk):
+    """Get the path a project's fitted vectorizer is saved at"""
+    return os.path.join(settings.TF_IDF_PATH, 'project_' + str(project_pk) + '_vectorizer.pkl')
+
+
+def get_tfidf_matrix_path(project_pk):
+    """Get the path to the directory a project's tf-idf matrix is saved in
+
+    Args:
+        project_pk: The project pk the data comes from
+    Returns:
+        path: The directory path
+    """
+    return os.path.join(settings.TF_IDF_PATH, 'project_' + str(project_pk) + '_tfidf_matrix')
+
+
+def get_snapshot_dir(project_pk):
+    """Get the directory a project's feature snapshots are made in"""
+    return os.path.join(settings.TF_IDF_PATH, 'project_' + str(project_pk) + '_snapshots')
+
+
+def load_tfidf_matrix(project_pk):
+    """Load tf-idf matrix from persistent volume, otherwise None.  The matrix
+        is memory-mapped, so only the rows that are used are read from disk.
+        The opened store is cached in the process until the matrix is saved
+        or appended to again.
+
+    Args:
+        project_pk: The project pk the data comes from
+    Returns:
+        FeatureStore holding the CSR-format tf-idf matrix
+    """
+    fpath = get_tfidf_matrix_path(project_pk)
+
+    if os.path.isdir(fpath):
+        # meta.json is replaced whenever the store changes
+        return cache_load(('tfidf', project_pk), os.path.join(fpath, 'meta.json'),
+                          lambda: load_feature_store(fpath))
     else:
         raise ValueError('There was no tfidf matrix found for project: ' + str(project_pk))
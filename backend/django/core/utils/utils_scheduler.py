@@ -0,0 +1,182 @@
+from contextlib import contextmanager
+import math
+import threading
+import uuid
+
+from django.conf import settings
+
+from core import tasks
+from core.models import Project
+
+# Searches go after the training of projects of every size (see training_priority)
+SEARCH_PRIORITY = 9
+
+# Take the project's training lock, or if another run holds it leave a note
+# that the labels it was triggered for still need a run.  Returns 1 if the
+# lock was taken.
+ACQUIRE_SCRIPT = """
+if redis.call('set', KEYS[1], ARGV[1], 'nx', 'ex', ARGV[2]) then
+    return 1
+end
+redis.call('set', KEYS[2], 1, 'ex', ARGV[2])
+return 0
+"""
+
+# Release the project's training lock if this run still holds it, and clear
+# the note left by any triggers that arrived during the run.  Returns 1 if
+# there was such a note.
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('del', KEYS[1])
+return redis.call('del', KEYS[2])
+"""
+
+
+# Extend the expiry of the project's training lock, and of the note left by
+# triggers during the run, if this run still holds it.  Returns 1 if it does.
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('expire', KEYS[2], ARGV[2])
+return redis.call('expire', KEYS[1], ARGV[2])
+"""
+
+
+def redis_serialize_training_lock(project_pk):
+    """Serialize a project's training lock for redis.  The format is 'training_lock:<pk>'"""
+    return 'training_lock:' + str(project_pk)
+
+
+def redis_serialize_training_pending(project_pk):
+    """Serialize a project's pending training for redis.  The format is 'training_pending:<pk>'"""
+    return 'training_pending:' + str(project_pk)
+
+
+def training_priority(project):
+    """The priority of a project's training task, from 0 (first) to 9.  Smaller
+        projects train faster, so they go first rather than wait behind large
+        ones.
+    """
+    num_data = project.data_set.count()
+    return min(9, int(math.log10(max(num_data, 1))))
+
+
+def schedule_training(project):
+    """Start a training run for a project, unless one is already running.  Only
+        one run per project is in flight at a time, so triggers that arrive
+        during a run are coalesced into a single run after it finishes.  The run
+        renews the lock while it is going (see hold_training_lock), so it only
+        expires, after settings.TRAINING_LOCK_TIMEOUT seconds, if the worker
+        running it dies.
+
+    Args:
+        project: Project object
+    Returns:
+        task: The AsyncResult of the run, or None if one was already running
+    """
+    token = uuid.uuid4().hex
+    acquired = settings.REDIS.eval(ACQUIRE_SCRIPT, 2,
+                                   redis_serialize_training_lock(project.pk),
+                                   redis_serialize_training_pending(project.pk),
+                                   token, settings.TRAINING_LOCK_TIMEOUT)
+    if not acquired:
+        return None
+
+    return tasks.send_model_task.apply_async(args=[project.pk], kwargs={'lock_token': token},
+                                             queue=settings.TRAINING_QUEUE,
+                                             priority=training_priority(project))
+
+
+def acquire_training_lock(project_pk):
+    """Take a project's training lock for work that must not run at the same
+        time as its training, ex: a hyperparameter search.  Training triggered
+        while it is held starts once it is released with finish_training.
+
+    Args:
+        project_pk: Primary key of the project
+    Returns:
+        token: The lock token, or None if the lock is already held
+    """
+    token = uuid.uuid4().hex
+    if settings.REDIS.set(redis_serialize_training_lock(project_pk), token,
+                          nx=True, ex=settings.TRAINING_LOCK_TIMEOUT):
+        return token
+    return None
+
+
+def training_in_progress(project_pk):
+    """Check if a project has a training run in flight"""
+    return bool(settings.REDIS.exists(redis_serialize_training_lock(project_pk)))
+
+
+def schedule_hyperparameter_searches():
+    """Queue the hyperparameter search of every project that has it on, behind
+        any training.  Run off-peak by celery beat (see CELERY_BEAT_SCHEDULE).
+
+    Returns:
+        project_pks: List of the projects a search was queued for
+    """
+    project_pks = list(Project.objects.filter(hyperparameter_search=True, classifier__isnull=False)
+                       .values_list('pk', flat=True))
+    for project_pk in project_pks:
+        tasks.send_hyperparameter_search_task.apply_async(args=[project_pk],
+                                                          queue=settings.TRAINING_QUEUE,
+                                                          priority=SEARCH_PRIORITY)
+    return project_pks
+
+
+@contextmanager
+def hold_training_lock(project_pk, token):
+    """Keep a project's training lock while the block runs, renewing it every
+        third of settings.TRAINING_LOCK_TIMEOUT so that a long run never
+        loses it, then release it with finish_training
+
+    Args:
+        project_pk: Primary key of the project
+        token: The lock token the run was started with
+    """
+    stop = threading.Event()
+    renewer = threading.Thread(target=renew_training_lock, args=(project_pk, token, stop), daemon=True)
+    renewer.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        renewer.join()
+        finish_training(project_pk, token)
+
+
+def renew_training_lock(project_pk, token, stop):
+    """Renew a project's training lock until stop is set.  Run on a thread by
+        hold_training_lock.
+    """
+    while not stop.wait(settings.TRAINING_LOCK_TIMEOUT / 3):
+        settings.REDIS.eval(RENEW_SCRIPT, 2,
+                            redis_serialize_training_lock(project_pk),
+                            redis_serialize_training_pending(project_pk),
+                            token, settings.TRAINING_LOCK_TIMEOUT)
+
+
+def finish_training(project_pk, token):
+    """Release a project's training lock, and start the
+        follow-up run if any triggers arrived while it was held.  The labels
+        that came in during the run are moved to the new training set (see
+        train_project), so the follow-up trains if there are enough of them.
+
+    Args:
+        project_pk: Primary key of the project
+        token: The lock token the run was started with
+    Returns:
+        pending: True if a follow-up run was started
+    """
+    pending = settings.REDIS.eval(RELEASE_SCRIPT, 2,
+                                  redis_serialize_training_lock(project_pk),
+                                  redis_serialize_training_pending(project_pk),
+                                  token)
+    if pending:
+        tasks.send_check_and_trigger_model_task.apply_async(args=[project_pk],
+                                                            queue=settings.TRAINING_QUEUE)
+    return bool(pending)
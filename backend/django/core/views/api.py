@@ -1,15 +1,20 @@
 from django.http import HttpResponse
 from django.conf import settings
 from rest_framework.decorators import api_view, permission_classes
+from rest_framework.response import Response
 
 import csv
 import io
 import os
 import zipfile
 import tempfile
+import pandas as pd
 
-from core.models import Project
+from core.models import Project, Model, Label, Data
 from core.utils.util import get_labeled_data
+from core.utils.utils_model import (get_tfidf_matrix_path, get_tfidf_vectorizer_path, save_embeddings,
+                                    score_texts, load_classifier)
+from core.utils.utils_minhash import find_near_duplicates, get_near_duplicate_group
 from core.permissions import IsAdminOrCreator
 
 
@@ -55,15 +60,19 @@ def download_model(request, project_pk):
     # https://stackoverflow.com/questions/12881294/django-create-a-zip-of-multiple-files-and-make-it-downloadable
     zip_subdir = 'model_project' + str(project_pk)
 
-    tfidf_path = os.path.join(settings.TF_IDF_PATH, 'project_'
-                              + str(project_pk) + '_tfidf_matrix.pkl')
-    tfidf_vectorizer_path = os.path.join(
-        settings.TF_IDF_PATH, 'project_' + str(project_pk) + '_vectorizer.pkl')
-    readme_path = os.path.join(settings.BASE_DIR, 'core', 'data', 'README.pdf')
+    tfidf_path = get_tfidf_matrix_path(project_pk)
+    tfidf_vectorizer_path = get_tfidf_vectorizer_path(project_pk)
+    readme_path = os.path.join(settings.BASE_DIR, 'core', 'data', 'README.md')
     current_training_set = project.get_current_training_set()
     model_path = os.path.join(settings.MODEL_PICKLE_PATH, 'project_' + str(project_pk)
                               + '_training_' + str(current_training_set.set_number - 1) + '.pkl')
 
+    # Give the features and vectorizer the model was trained with
+    model = Model.objects.filter(pickle_path=model_path).order_by('-pk').first()
+    if model is not None and model.feature_path:
+        tfidf_path = model.feature_path
+        tfidf_vectorizer_path = os.path.join(tfidf_path, os.path.basename(tfidf_vectorizer_path))
+
     data, label_data = get_labeled_data(project)
     # open the tempfile and write the label data to it
     temp_labeleddata_file = tempfile.NamedTemporaryFile(
@@ -83,7 +92,18 @@ def download_model(request, project_pk):
     s = io.BytesIO()
     # open the zip folder
     zip_file = zipfile.ZipFile(s, "w")
-    for path in [tfidf_path, tfidf_vectorizer_path, readme_path, model_path, temp_labeleddata_file.name, temp_label_file.name]:
+    # the tf-idf matrix is a directory of numpy arrays, keep it as one in the zip
+    tfidf_dir = os.path.basename(get_tfidf_matrix_path(project_pk))
+    for root, dirs, fnames in os.walk(tfidf_path):
+        dirs.sort()
+        for fname in sorted(fnames):
+            fpath = os.path.join(root, fname)
+            if fpath != tfidf_vectorizer_path:
+                zip_file.write(fpath, os.path.join(zip_subdir, tfidf_dir, os.path.relpath(fpath, tfidf_path)))
+    for path in [tfidf_vectorizer_path, readme_path, model_path, temp_labeleddata_file.name, temp_label_file.name]:
+        # projects using uploaded embeddings have no vectorizer
+        if path == tfidf_vectorizer_path and not os.path.isfile(path):
+            continue
         fdir, fname = os.path.split(path)
         if path == temp_label_file.name:
             fname = "project_" + str(project_pk) + "_labels.csv"
@@ -98,3 +118,117 @@ def download_model(request, project_pk):
     response['Content-Disposition'] = 'attachment;'
 
     return response
+
+
+@api_view(['POST'])
+@permission_classes((IsAdminOrCreator, ))
+def upload_embeddings(request, project_pk):
+    """Upload precomputed embedding vectors to use as the features of a project
+        instead of its text.  The file is a csv with an ID column matching the
+        IDs of the project data and one column for each dimension.
+
+    Args:
+        request: The POST request, with the csv as the file "data"
+        project_pk: Primary key of the project
+    Returns:
+        {'rows': the number of vectors uploaded} or {'error': the problem}
+    """
+    project = Project.objects.get(pk=project_pk)
+    response = {}
+
+    if 'data' not in request.FILES:
+        response['error'] = 'No embeddings file was uploaded.'
+        return Response(response)
+
+    try:
+        embeddings = pd.read_csv(request.FILES['data'])
+        save_embeddings(project, embeddings)
+        response['rows'] = len(embeddings)
+    except ValueError as e:
+        # includes the errors pandas raises for a file it cannot parse
+        response['error'] = str(e)
+
+    return Response(response)
+
+
+@api_view(['POST'])
+@permission_classes((IsAdminOrCreator, ))
+def score_text(request, project_pk):
+    """Predict the probability of each label for a batch of texts with the
+        project's latest model, without adding them to the project
+
+    Args:
+        request: The POST request, with a JSON body of {'texts': list of strings}
+        project_pk: Primary key of the project
+    Returns:
+        {'model': pk of the model used, 'labels': the label names,
+         'probabilities': a list for each text of the probability of each label}
+        or {'error': the problem}
+    """
+    project = Project.objects.get(pk=project_pk)
+    response = {}
+
+    texts = request.data.get('texts')
+    if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+        response['error'] = 'texts must be a list of strings.'
+        return Response(response)
+
+    try:
+        model, probabilities = score_texts(project, texts)
+    except ValueError as e:
+        response['error'] = str(e)
+        return Response(response)
+
+    label_names = dict(Label.objects.filter(project=project).values_list('pk', 'name'))
+    response['model'] = model.pk
+    response['labels'] = [label_names[label_pk] for label_pk in load_classifier(model).classes_]
+    response['probabilities'] = probabilities.tolist()
+    return Response(response)
+
+
+def near_duplicate_rows(data):
+    """The fields of each datum returned by the near-duplicate endpoints"""
+    return [{'pk': datum.pk, 'upload_id': datum.upload_id, 'text': datum.text} for datum in data]
+
+
+@api_view(['GET'])
+@permission_classes((IsAdminOrCreator, ))
+def near_duplicates(request, project_pk):
+    """Find the data in a project that is a near-duplicate of a text
+
+    Args:
+        request: The GET request, with the text as the parameter "text"
+        project_pk: Primary key of the project
+    Returns:
+        {'data': list of {'pk', 'upload_id', 'text'}, most similar first}
+        or {'error': the problem}
+    """
+    project = Project.objects.get(pk=project_pk)
+    response = {}
+
+    if project.near_duplicates == "none":
+        response['error'] = 'This project does not find near-duplicates.'
+        return Response(response)
+    if not request.GET.get('text'):
+        response['error'] = 'No text was given.'
+        return Response(response)
+
+    response['data'] = near_duplicate_rows(find_near_duplicates(project, request.GET['text']))
+    return Response(response)
+
+
+@api_view(['GET'])
+@permission_classes((IsAdminOrCreator, ))
+def near_duplicate_group(request, data_pk):
+    """Get the group of near-duplicates a datum belongs to
+
+    Args:
+        request: The GET request
+        data_pk: Primary key of the data
+    Returns:
+        {'data': list of {'pk', 'upload_id', 'text'} of the group, including
+         the datum itself, oldest first}
+    """
+    datum = Data.objects.get(pk=data_pk)
+
+    return Response({'data': near_duplicate_rows(get_near_duplicate_group(datum))})
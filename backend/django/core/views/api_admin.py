@@ -11,7 +11,7 @@ from core.models import (Project, Model, Data, Label, DataLabel,
                          DataPrediction, TrainingSet,
                          IRRLog, ProjectPermissions)
 from core.utils.util import perc_agreement_table_data, irr_heatmap_data
-from core.utils.utils_model import fleiss_kappa, cohens_kappa
+from core.utils.utils_model import fleiss_kappa, cohens_kappa, TRAINING_STAGES
 from core.permissions import IsAdminOrCreator
 
 
@@ -123,6 +123,20 @@ def model_metrics(request, project_pk):
                 'values': values
             }
         ]
+    elif metric == 'timings':
+        # Seconds spent in each stage of training, one line per stage
+        dataset = []
+        for stage in TRAINING_STAGES:
+            values = []
+            for model in models:
+                values.append({
+                    'x': model.training_set.set_number,
+                    'y': model.timings.get(stage, 0)
+                })
+            dataset.append({
+                'key': stage.replace('_', ' ').capitalize(),
+                'values': values
+            })
     else:
         labels = {str(label.pk): label.name for label in project.labels.all()}
         dataset = []
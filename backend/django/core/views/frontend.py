@@ -220,6 +220,13 @@ class ProjectCreateWizard(LoginRequiredMixin, SessionWizardView):
             proj_obj.percentage_irr = advanced_data["percentage_irr"]
             proj_obj.num_users_irr = advanced_data["num_users_irr"]
             proj_obj.classifier = advanced_data["classifier"]
+            proj_obj.feature_extractor = advanced_data["feature_extractor"]
+            proj_obj.reduction = advanced_data["reduction"]
+            proj_obj.near_duplicates = advanced_data["near_duplicates"]
+            proj_obj.cv_folds = advanced_data["cv_folds"]
+            proj_obj.holdout = advanced_data["holdout"]
+            proj_obj.fold_ensemble = advanced_data["fold_ensemble"]
+            proj_obj.hyperparameter_search = advanced_data["hyperparameter_search"]
             proj_obj.save()
 
             # Training Set
@@ -9,4 +9,7 @@ while [ $n -ne 0 ]; do
     n=$?
 done
 
-celery -A smart worker -l info -n default@%h 
\ No newline at end of file
+# Model training has its own worker, so it never holds up uploads.  It also
+# runs celery beat, which starts the off-peak hyperparameter searches
+celery -A smart worker -B -l info -Q training -n training@%h &
+celery -A smart worker -l info -Q celery -n default@%h
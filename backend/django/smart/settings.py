@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/1.11/ref/settings/
 """
 import redis
+from celery.schedules import crontab
 import os
 from configurations import Configuration
 
@@ -170,6 +171,57 @@ class Dev(Configuration):
     PROJECT_FILE_PATH = os.path.join(DATA_DIR, 'data_files')
     CODEBOOK_FILE_PATH = os.path.join(DATA_DIR, 'code_books')
 
+    # Data uploaded to a project is transformed with the existing tf-idf
+    # vectorizer and appended to the tf-idf matrix.  The vectorizer is refit on
+    # all the project data once the appended data passes this fraction of the
+    # data it was fit on
+    TFIDF_REFIT_FRACTION = 0.2
+    # Number of rows read from the database at a time when fitting the vectorizer
+    TFIDF_CHUNK_SIZE = 10000
+    # Number of processes used to tokenize the data when fitting the vectorizer
+    TFIDF_N_JOBS = 1
+    # Memory budget, in bytes, for the vectorizers, feature matrices and models
+    # each worker keeps loaded between tasks, by their estimated size in
+    # memory (memory-mapped feature matrices take next to none)
+    LOAD_CACHE_BYTES = 512 * 1024 * 1024
+    # Number of components a project's dimensionality reduction keeps, and the
+    # most rows of the feature matrix it is fit on
+    REDUCTION_COMPONENTS = 300
+    REDUCTION_SAMPLE_SIZE = 100000
+    # Estimated Jaccard similarity of their shingles at which two documents are
+    # near-duplicates
+    NEAR_DUPLICATE_THRESHOLD = 0.8
+    # Incremental models are refit on every label after this many updates
+    # with just the new labels
+    INCREMENTAL_REFIT_INTERVAL = 10
+    # Number of processes used to fit the cross validation folds of a model
+    CV_N_JOBS = 1
+    # Number of components used to approximate an RBF kernel for the SVM, 0
+    # keeps it linear
+    SVM_KERNEL_COMPONENTS = 0
+    # zlib level the model pickles are compressed with, 0 for none
+    MODEL_COMPRESSION = 3
+    # Number of each project's newest models whose pickles are kept
+    MODEL_RETENTION = 5
+    # Number of processes used to score the candidate settings of a
+    # hyperparameter search, and the hour (server time) searches start at
+    SEARCH_N_JOBS = 1
+    HYPERPARAMETER_SEARCH_HOUR = 3
+    # Number of unlabeled data predicted at a time, which bounds the memory
+    # prediction uses
+    PREDICTION_CHUNK_SIZE = 10000
+    # Number of processes the chunks are predicted in
+    PREDICTION_N_JOBS = 1
+    # Number of data whose predictions are written to the database at a time
+    PREDICTION_COPY_ROWS = 10000
+    # Number of texts transformed and scored at a time by the score_texts API
+    SCORE_CHUNK_SIZE = 1000
+    # Celery queue that model training runs on, apart from uploads
+    TRAINING_QUEUE = 'training'
+    # Seconds before a project's training lock expires.  The run holding it
+    # renews it every third of this, so it only expires if the worker dies
+    TRAINING_LOCK_TIMEOUT = 60 * 60
+
     AUTH_USER_MODEL = 'auth.User'
 
     SITE_ID = 1
@@ -192,6 +244,23 @@ class Dev(Configuration):
     CELERY_ACCEPT_CONTENT = ['json']
     CELERY_TASK_SERIALIZER = 'json'
     CELERY_RESULT_SERIALIZER = 'json'
+    CELERY_TASK_ROUTES = {
+        'core.tasks.send_model_task': {'queue': TRAINING_QUEUE},
+    }
+    # Have the redis broker honor task priorities, 0 being the first
+    CELERY_BROKER_TRANSPORT_OPTIONS = {
+        'priority_steps': list(range(10)),
+        'queue_order_strategy': 'priority',
+    }
+    CELERY_BEAT_SCHEDULE = {
+        'off-peak-hyperparameter-search': {
+            'task': 'core.tasks.send_off_peak_search_task',
+            'schedule': crontab(hour=HYPERPARAMETER_SEARCH_HOUR, minute=0),
+        },
+    }
+    # Take one task at a time so a queued small project is not stuck behind
+    # large ones a worker has already reserved
+    CELERY_WORKER_PREFETCH_MULTIPLIER = 1
 
     STATICFILES_DIRS = [
         os.path.join(BASE_DIR, 'frontend', 'dist'),
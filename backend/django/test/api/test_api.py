@@ -1,8 +1,14 @@
+import io
+import json
+import zipfile
+import pandas as pd
+
 from core.management.commands.seed import (SEED_PROJECT, SEED_USERNAME, SEED_EMAIL,
                                            SEED_PASSWORD, SEED_LABELS, SEED_USERNAME2,
                                            SEED_PASSWORD2)
 from core.pagination import SmartPagination
-from core.models import Profile, ProjectPermissions
+from core.models import Profile, ProjectPermissions, Data
+from core.utils.util import add_data
 from core.utils.utils_queue import fill_queue
 from test.util import read_test_data_api, compare_get_response
 
@@ -117,6 +123,114 @@ def test_download_model(seeded_database, client, admin_client, test_project_with
     assert 'detail' not in response
     assert response.get("Content-Type") == "application/x-zip-compressed"
 
+    zip_names = zipfile.ZipFile(io.BytesIO(response.content)).namelist()
+    tfidf_dir = 'model_project' + str(project.pk) + '/project_' + str(project.pk) + '_tfidf_matrix/'
+    assert tfidf_dir + 'data.npy' in zip_names
+    assert tfidf_dir + 'meta.json' in zip_names
+    # The vectorizer comes from the model's feature snapshot
+    assert 'model_project' + str(project.pk) + '/project_' + str(project.pk) + '_vectorizer.pkl' in zip_names
+
+
+def test_score_text(seeded_database, client, admin_client, test_project_with_trained_model, settings):
+    '''
+    This tests the score text api call
+    '''
+    project = test_project_with_trained_model
+    settings.SCORE_CHUNK_SIZE = 2
+
+    admin_client.login(username=SEED_USERNAME2, password=SEED_PASSWORD2)
+    admin_profile = Profile.objects.get(user__username=SEED_USERNAME2)
+    ProjectPermissions.objects.create(profile=admin_profile,
+                                      project=project,
+                                      permission='ADMIN')
+
+    client.login(username=SEED_USERNAME, password=SEED_PASSWORD)
+    client_profile = Profile.objects.get(user__username=SEED_USERNAME)
+    ProjectPermissions.objects.create(profile=client_profile,
+                                      project=project,
+                                      permission='CODER')
+
+    texts = ['the first text', 'another text to score', 'a third', '']
+    response = client.post('/api/score_text/' + str(project.pk) + '/', json.dumps({'texts': texts}),
+                           content_type='application/json').json()
+    assert 'detail' in response and 'Invalid permission. Must be an admin' in response['detail']
+
+    response = admin_client.post('/api/score_text/' + str(project.pk) + '/', json.dumps({'texts': texts}),
+                                 content_type='application/json').json()
+    assert response['model'] == project.model_set.latest('pk').pk
+    assert sorted(response['labels']) == sorted(project.labels.values_list('name', flat=True))
+    assert len(response['probabilities']) == len(texts)
+    for probabilities in response['probabilities']:
+        assert len(probabilities) == len(response['labels'])
+        assert abs(sum(probabilities) - 1) < 1e-6
+
+    response = admin_client.post('/api/score_text/' + str(project.pk) + '/', json.dumps({'texts': 'not a list'}),
+                                 content_type='application/json').json()
+    assert response == {'error': 'texts must be a list of strings.'}
+
+
+def test_upload_embeddings(seeded_database, admin_client, test_project_data, tmpdir, settings):
+    '''
+    This tests the upload embeddings api call
+    '''
+    settings.TF_IDF_PATH = str(tmpdir.mkdir('tf_idf'))
+    project = test_project_data
+    project.feature_extractor = 'embeddings'
+    project.save()
+
+    admin_client.login(username=SEED_USERNAME2, password=SEED_PASSWORD2)
+    admin_profile = Profile.objects.get(user__username=SEED_USERNAME2)
+    ProjectPermissions.objects.create(profile=admin_profile,
+                                      project=project,
+                                      permission='ADMIN')
+
+    upload_ids = list(project.data_set.values_list('upload_id', flat=True))
+    embeddings = io.BytesIO(('ID,x,y\n' + ''.join(i + ',0.5,1.5\n' for i in upload_ids)).encode())
+    embeddings.name = 'embeddings.csv'
+    response = admin_client.post('/api/upload_embeddings/' + str(project.pk) + '/',
+                                 {'data': embeddings}).json()
+    assert response == {'rows': len(upload_ids)}
+
+    bad_embeddings = io.BytesIO(b'ID,x\n1,not a number\n')
+    bad_embeddings.name = 'embeddings.csv'
+    response = admin_client.post('/api/upload_embeddings/' + str(project.pk) + '/',
+                                 {'data': bad_embeddings}).json()
+    assert 'must all be numbers' in response['error']
+
+
+def test_near_duplicates(seeded_database, admin_client, test_project):
+    '''
+    This tests the near-duplicate query api calls
+    '''
+    project = test_project
+    admin_client.login(username=SEED_USERNAME2, password=SEED_PASSWORD2)
+    admin_profile = Profile.objects.get(user__username=SEED_USERNAME2)
+    ProjectPermissions.objects.create(profile=admin_profile,
+                                      project=project,
+                                      permission='ADMIN')
+
+    text = 'The senator announced on Tuesday that the new bill would fund rural broadband expansion'
+    response = admin_client.get('/api/near_duplicates/' + str(project.pk) + '/', {'text': text}).json()
+    assert response == {'error': 'This project does not find near-duplicates.'}
+
+    project.near_duplicates = 'group'
+    project.save()
+    add_data(project, pd.DataFrame({'Text': [text, 'RT ' + text, 'Local bakery wins a prize for its sourdough bread'],
+                                    'Label': [None] * 3}))
+    original, retweet, other = Data.objects.filter(project=project).order_by('pk')
+
+    response = admin_client.get('/api/near_duplicates/' + str(project.pk) + '/', {'text': text + '!'}).json()
+    assert [datum['pk'] for datum in response['data']] == [original.pk, retweet.pk]
+    assert response['data'][0]['text'] == text
+
+    response = admin_client.get('/api/near_duplicates/' + str(project.pk) + '/').json()
+    assert response == {'error': 'No text was given.'}
+
+    response = admin_client.get('/api/near_duplicate_group/' + str(retweet.pk) + '/').json()
+    assert [datum['pk'] for datum in response['data']] == [original.pk, retweet.pk]
+    response = admin_client.get('/api/near_duplicate_group/' + str(other.pk) + '/').json()
+    assert [datum['upload_id'] for datum in response['data']] == [other.upload_id]
+
 
 def test_download_labeled_data(seeded_database, client, admin_client, test_project_labeled, test_queue_labeled, test_irr_queue_labeled, test_admin_queue_labeled):
     '''
@@ -8,6 +8,7 @@ from core.models import (Profile, DataLabel, Data, ProjectPermissions,
                          DataPrediction, TrainingSet, Model)
 from core.utils.utils_annotate import get_assignments
 from core.utils.utils_queue import fill_queue
+from core.utils.utils_model import TRAINING_STAGES
 from test.util import assert_collections_equal, sign_in_and_fill_queue
 
 
@@ -393,6 +394,13 @@ def test_model_metrics(seeded_database, admin_client, client, test_project_unlab
         for temp_dict in response:
             assert len(temp_dict['values']) == 2
 
+    response = admin_client.get('/api/model_metrics/'
+                                + str(project.pk) + '/?metric=timings').json()
+    assert len(response) == len(TRAINING_STAGES)
+    for temp_dict in response:
+        assert len(temp_dict['values']) == 2
+        assert all(value['y'] >= 0 for value in temp_dict['values'])
+
 
 def test_coded_table(seeded_database, client, admin_client, test_project_data, test_queue, test_admin_queue, test_irr_queue, test_labels):
     '''
@@ -189,7 +189,7 @@ def test_profile_queue2(db, test_profile2, test_project_data):
 @pytest.fixture
 def test_tfidf_matrix(test_project_data):
     '''
-    A CSR-format tf-idf matrix created from the data of test_project_data
+    A FeatureStore holding the tf-idf matrix created from the data of test_project_data
     '''
     Data.objects.filter(project=test_project_data)
     return create_tfidf_matrix(test_project_data.pk)[0]
@@ -0,0 +1,120 @@
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.externals import joblib
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
+
+from core.utils.utils_cache import cache_load, cache_put, cache_clear, memory_size
+from core.utils.utils_model import load_tfidf_vectorizer, load_tfidf_matrix, update_tfidf_matrix
+from core.utils.util import add_data
+
+
+def make_loader(calls, value):
+    def load():
+        calls.append(value)
+        return value
+    return load
+
+
+def test_cache_load_reuses_until_file_changes(tmpdir, settings):
+    cache_clear()
+    path = tmpdir.join('object.pkl')
+    path.write('first')
+    calls = []
+
+    first = cache_load('key', str(path), make_loader(calls, ['first']))
+    assert cache_load('key', str(path), make_loader(calls, ['unused'])) is first
+    assert calls == [['first']]
+
+    # Replacing the file invalidates the cached copy
+    new_path = tmpdir.join('new.pkl')
+    new_path.write('second version')
+    os.replace(str(new_path), str(path))
+    assert cache_load('key', str(path), make_loader(calls, ['second'])) == ['second']
+    assert calls == [['first'], ['second']]
+
+
+def make_array_loader(calls, name):
+    # Loads a name, which takes 10 bytes in memory
+    def load():
+        calls.append(name)
+        return np.zeros(10, dtype=np.uint8)
+    return load
+
+
+def test_cache_evicts_least_recently_used(tmpdir, settings):
+    cache_clear()
+    settings.LOAD_CACHE_BYTES = 25
+    paths = []
+    for name in ['a', 'b', 'c']:
+        path = tmpdir.join(name)
+        path.write('x')
+        paths.append(str(path))
+    calls = []
+
+    cache_load('a', paths[0], make_array_loader(calls, 'a'))
+    cache_load('b', paths[1], make_array_loader(calls, 'b'))
+    # Use a again so b is the least recently used
+    cache_load('a', paths[0], make_array_loader(calls, 'a'))
+    cache_load('c', paths[2], make_array_loader(calls, 'c'))
+    assert calls == ['a', 'b', 'c']
+
+    cache_load('a', paths[0], make_array_loader(calls, 'a'))
+    cache_load('c', paths[2], make_array_loader(calls, 'c'))
+    assert calls == ['a', 'b', 'c']
+    cache_load('b', paths[1], make_array_loader(calls, 'b'))
+    assert calls == ['a', 'b', 'c', 'b']
+
+    # Objects larger than the whole budget are never kept
+    cache_put('big', paths[0], 'big', nbytes=100)
+    cache_load('big', paths[0], make_loader(calls, 'big'))
+    assert calls[-1] == 'big'
+
+
+def test_memory_size(tmpdir):
+    array = np.zeros(1000)
+    assert memory_size(array) == array.nbytes
+    # Views are counted as the array they view
+    assert array.nbytes < memory_size({'array': array, 'view': array[:10]}) < array.nbytes + 1000
+
+    # A sparse matrix is counted by its arrays
+    matrix = sparse.random(100, 100, density=0.1, format='csr')
+    assert memory_size(matrix) > matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+    # Memory-mapped arrays are only read as they are used
+    path = str(tmpdir.join('array.npy'))
+    np.save(path, array)
+    assert memory_size(np.load(path, mmap_mode='r')) < 1000
+
+    # A compressed classifier takes much more memory than its file
+    clf = LogisticRegression().fit(np.zeros((4, 5000)) + np.arange(4)[:, np.newaxis], [0, 1, 0, 1])
+    path = str(tmpdir.join('clf.pkl'))
+    joblib.dump(clf, path, compress=3)
+    assert memory_size(clf) > clf.coef_.nbytes > os.path.getsize(path)
+
+    # The trees of a forest are Cython objects without a __dict__, counted
+    # through their pickled state
+    forest = RandomForestClassifier(n_estimators=5, random_state=0).fit(np.random.rand(200, 10), np.arange(200) % 2)
+    nodes = sum(tree.tree_.__getstate__()['nodes'].nbytes for tree in forest.estimators_)
+    assert memory_size(forest) > nodes
+
+
+def test_cached_tfidf_loads(test_project_labeled_and_tfidf, settings):
+    cache_clear()
+    project = test_project_labeled_and_tfidf
+    settings.TFIDF_REFIT_FRACTION = 0.5
+
+    vectorizer = load_tfidf_vectorizer(project.pk)
+    matrix = load_tfidf_matrix(project.pk)
+    assert load_tfidf_vectorizer(project.pk) is vectorizer
+    assert load_tfidf_matrix(project.pk) is matrix
+
+    # Appending to the matrix rewrites it, so it is loaded again
+    add_data(project, pd.DataFrame({'Text': ['Some new text about feminism'], 'Label': [None]}))
+    update_tfidf_matrix(project.pk)
+    updated = load_tfidf_matrix(project.pk)
+    assert updated is not matrix
+    assert len(updated) == len(matrix) + 1
+    assert load_tfidf_vectorizer(project.pk) is vectorizer
@@ -0,0 +1,92 @@
+import pandas as pd
+
+from core.models import Data, DataLabel, MinHashBand
+from core.utils.util import add_data
+from core.utils.utils_minhash import (NUM_BANDS, minhash_signatures, similarity,
+                                      find_near_duplicates, get_near_duplicate_group)
+
+TEXT = 'The senator announced on Tuesday that the new bill would fund rural broadband expansion'
+NEAR_TEXTS = [TEXT, TEXT + '!', 'RT ' + TEXT, TEXT.replace('Tuesday', 'tuesday,')]
+OTHER_TEXTS = ['Local bakery wins a prize for its sourdough bread',
+               'Weather service warns of heavy snow across the northern counties']
+
+
+def upload(project, texts, labels=None):
+    return add_data(project, pd.DataFrame({'Text': texts,
+                                           'Label': labels or [None] * len(texts)}))
+
+
+def test_minhash_similarity():
+    signatures = minhash_signatures(NEAR_TEXTS + OTHER_TEXTS)
+    assert signatures.shape == (6, 128)
+
+    assert similarity(signatures[0], signatures[1]) > 0.9
+    assert similarity(signatures[0], signatures[2]) > 0.8
+    assert similarity(signatures[0], signatures[4]) < 0.2
+    # Whitespace and case are normalized
+    assert similarity(minhash_signatures(['Some  Text here'])[0],
+                      minhash_signatures(['some text\nhere'])[0]) == 1.0
+    # Texts shorter than a shingle still get a signature
+    assert minhash_signatures(['', 'a']).shape == (2, 128)
+
+
+def test_add_data_groups_near_duplicates(test_project):
+    test_project.near_duplicates = 'group'
+    test_project.save()
+
+    upload(test_project, NEAR_TEXTS[:1] + OTHER_TEXTS)
+    assert MinHashBand.objects.filter(project=test_project).count() == 3 * NUM_BANDS
+    assert not Data.objects.filter(project=test_project, near_duplicate_of__isnull=False).exists()
+
+    # Near-duplicates in a later upload point at the first copy
+    df = upload(test_project, NEAR_TEXTS[1:])
+    assert len(df) == 3
+    first = Data.objects.get(project=test_project, text=TEXT)
+    group = get_near_duplicate_group(Data.objects.get(project=test_project, text=TEXT + '!'))
+    assert list(group.values_list('text', flat=True)) == NEAR_TEXTS
+    assert all(datum.near_duplicate_of == first for datum in group[1:])
+    assert list(get_near_duplicate_group(first)) == list(group)
+    assert Data.objects.filter(project=test_project, near_duplicate_of__isnull=True).count() == 3
+
+
+def test_add_data_no_near_duplicates(test_project):
+    upload(test_project, NEAR_TEXTS)
+
+    assert MinHashBand.objects.filter(project=test_project).count() == 0
+    assert not Data.objects.filter(project=test_project, near_duplicate_of__isnull=False).exists()
+
+
+def test_add_data_collapses_near_duplicates(test_project_labels):
+    project = test_project_labels
+    project.near_duplicates = 'collapse'
+    project.save()
+    label = project.labels.first().name
+
+    df = upload(project, NEAR_TEXTS[:2] + OTHER_TEXTS)
+    assert len(df) == 3
+    assert list(df['Text']) == NEAR_TEXTS[:1] + OTHER_TEXTS
+
+    # Labeled near-duplicates are kept
+    df = upload(project, NEAR_TEXTS[2:], [label, None])
+    assert list(df['Text']) == NEAR_TEXTS[2:3]
+    kept = Data.objects.get(project=project, text=NEAR_TEXTS[2])
+    assert kept.near_duplicate_of.text == TEXT
+    assert DataLabel.objects.filter(data=kept).exists()
+    assert Data.objects.filter(project=project).count() == 4
+
+    # IDs of the collapsed data are not given out again
+    upload(project, ['A completely different text about city council elections'])
+    upload_ids = list(Data.objects.filter(project=project).values_list('upload_id', flat=True))
+    assert len(set(upload_ids)) == len(upload_ids)
+
+
+def test_find_near_duplicates(test_project):
+    test_project.near_duplicates = 'group'
+    test_project.save()
+    upload(test_project, NEAR_TEXTS[1:] + OTHER_TEXTS)
+
+    matches = find_near_duplicates(test_project, TEXT)
+    assert set(datum.text for datum in matches) == set(NEAR_TEXTS[1:])
+    scores = [similarity(minhash_signatures([TEXT])[0], minhash_signatures([datum.text])[0]) for datum in matches]
+    assert scores == sorted(scores, reverse=True)
+    assert find_near_duplicates(test_project, 'Nothing like anything uploaded') == []
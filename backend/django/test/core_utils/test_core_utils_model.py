@@ -1,27 +1,186 @@
 import pytest
 import os
+import time
+from functools import partial
 import numpy as np
-
-from core.models import (Data, DataQueue, Model, DataLabel, DataPrediction,
-                         DataUncertainty, ProjectPermissions)
-from core.utils.utils_annotate import assign_datum, label_data
+import pandas as pd
+from scipy import sparse
+
+from sklearn.feature_extraction.text import TfidfVectorizer, HashingVectorizer
+from sklearn.decomposition import TruncatedSVD
+from sklearn.random_projection import SparseRandomProjection
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from sklearn.svm import LinearSVC
+from sklearn.calibration import CalibratedClassifierCV
+from sklearn.kernel_approximation import Nystroem
+from sklearn.ensemble import VotingClassifier
+from sklearn.naive_bayes import MultinomialNB
+from sklearn.model_selection import cross_val_predict
+from sklearn.metrics import accuracy_score
+from sklearn.externals import joblib
+
+from core.models import (Data, DataQueue, Model, Label, DataLabel, DataPrediction,
+                         DataUncertainty, ProjectPermissions, TrainingSet, LabelChangeLog)
+from core.utils.utils_annotate import assign_datum, label_data, process_irr_label
 from core.utils.utils_queue import fill_queue, find_queue_length
 from core.utils.utils_redis import get_ordered_data
-from core.utils.utils_model import (save_tfidf_matrix, load_tfidf_matrix,
-                                    train_and_save_model, predict_data,
-                                    least_confident, margin_sampling, entropy,
+from core.utils.utils_features import (FeatureStore, SegmentedFeatureStore, parallel_transform,
+                                       load_feature_store, save_feature_store, pool_map)
+from core.utils.util import add_data
+from core.utils.utils_model import (create_tfidf_matrix, save_tfidf_matrix, load_tfidf_matrix,
+                                    update_tfidf_matrix, load_tfidf_vectorizer, save_embeddings,
+                                    snapshot_tfidf_matrix, load_tfidf_snapshot,
+                                    get_reducer, load_classifier, get_classifier,
+                                    prepare_features, cross_validate_model, get_cv_folds, get_labeled_arrays,
+                                    save_classifier, read_classifier, get_coefficients_path,
+                                    delete_old_models, search_hyperparameters, SEARCH_GRIDS,
+                                    score_texts,
+                                    iterate_project_data,
+                                    train_and_save_model, predict_data, predict_chunk,
+                                    tracked_rss, current_rss,
+                                    least_confident, margin_sampling, entropy, uncertainty_scores,
                                     check_and_trigger_model, cohens_kappa, fleiss_kappa)
-from test.util import assert_obj_exists, assert_redis_matches_db
+from test.util import assert_obj_exists, assert_redis_matches_db, assert_runs_in_daemon
 from test.conftest import TEST_QUEUE_LEN
 
 
 def test_create_tfidf_matrix(test_tfidf_matrix):
-    # UPDATE: is now saved as a dictionary of lists
-    assert isinstance(test_tfidf_matrix, dict)
+    # UPDATE: is now saved as a sparse FeatureStore
+    assert isinstance(test_tfidf_matrix, FeatureStore)
+    assert sparse.isspmatrix_csr(test_tfidf_matrix.matrix)
     assert len(test_tfidf_matrix) == 285
-    for key in test_tfidf_matrix:
-        assert len(test_tfidf_matrix[key]) == 307
-        assert np.all([type(val) == float for val in test_tfidf_matrix[key]])
+    assert test_tfidf_matrix.shape == (285, 307)
+    assert len(set(test_tfidf_matrix.upload_ids)) == 285
+
+
+def test_create_tfidf_matrix_matches_in_memory_fit(test_project_data, test_tfidf_matrix):
+    data = Data.objects.filter(project=test_project_data).order_by('pk')
+    vectorizer = TfidfVectorizer(max_df=0.995, min_df=0.005, stop_words='english')
+    expected = vectorizer.fit_transform(list(data.values_list('text', flat=True)))
+
+    assert list(test_tfidf_matrix.upload_ids) == list(data.values_list('upload_id', flat=True))
+    assert np.allclose(test_tfidf_matrix.matrix.toarray(), expected.toarray())
+    assert test_tfidf_matrix.info == {'feature_extractor': 'tfidf', 'fitted_rows': 285,
+                                      'max_data_pk': data.last().pk}
+
+
+def test_create_tfidf_matrix_parallel(test_project_data, settings):
+    serial_matrix, serial_vectorizer = create_tfidf_matrix(test_project_data.pk)
+
+    settings.TFIDF_N_JOBS = 2
+    settings.TFIDF_CHUNK_SIZE = 50
+    parallel_matrix, parallel_vectorizer = create_tfidf_matrix(test_project_data.pk)
+
+    # The parallel fit must give exactly the serial result
+    assert parallel_vectorizer.vocabulary_ == serial_vectorizer.vocabulary_
+    assert parallel_vectorizer.stop_words_ == serial_vectorizer.stop_words_
+    assert np.array_equal(parallel_vectorizer.idf_, serial_vectorizer.idf_)
+    assert list(parallel_matrix.upload_ids) == list(serial_matrix.upload_ids)
+    assert parallel_matrix.info == serial_matrix.info
+    for name in ['data', 'indices', 'indptr']:
+        assert np.array_equal(getattr(parallel_matrix.matrix, name),
+                              getattr(serial_matrix.matrix, name))
+
+    texts = ['new text about the project', 'more words', 'and a third document']
+    expected = serial_vectorizer.transform(texts)
+    assert np.array_equal(parallel_vectorizer.transform(texts).toarray(), expected.toarray())
+    assert np.array_equal(parallel_transform(serial_vectorizer, [texts[:2], texts[2:]], 2).toarray(),
+                          expected.toarray())
+
+    # Tasks run in daemonic celery worker processes, which must still be able
+    # to start the pool
+    def transform_in_worker():
+        assert np.array_equal(parallel_transform(serial_vectorizer, [texts[:2], texts[2:]], 2).toarray(),
+                              expected.toarray())
+
+    assert_runs_in_daemon(transform_in_worker)
+
+
+def test_create_tfidf_matrix_char_hashing(test_project_data, tmpdir, settings):
+    settings.TF_IDF_PATH = str(tmpdir.mkdir('tf_idf'))
+    settings.TFIDF_REFIT_FRACTION = 0.001
+    project = test_project_data
+    project.feature_extractor = 'char hashing'
+    project.save()
+
+    matrix, vectorizer = create_tfidf_matrix(project.pk)
+    assert isinstance(vectorizer, HashingVectorizer)
+    assert matrix.shape == (285, 2 ** 18)
+    assert matrix.info['feature_extractor'] == 'char hashing'
+    assert np.allclose(matrix.rows([matrix.upload_ids[0]]).toarray(),
+                       vectorizer.transform([Data.objects.filter(project=project).order_by('pk')[0].text]).toarray())
+
+    # Hashing has nothing to refit, so new data is always appended
+    update_tfidf_matrix(project.pk)
+    add_data(project, pd.DataFrame({'Text': ['Some new text about feminism'], 'Label': [None]}))
+    update_tfidf_matrix(project.pk)
+    updated = load_tfidf_matrix(project.pk)
+    assert isinstance(updated, SegmentedFeatureStore)
+    assert len(updated) == 286
+
+
+def test_save_embeddings(test_project_data, tmpdir, settings):
+    settings.TF_IDF_PATH = str(tmpdir.mkdir('tf_idf'))
+    project = test_project_data
+    upload_ids = list(Data.objects.filter(project=project).values_list('upload_id', flat=True))
+    vectors = np.random.rand(len(upload_ids), 4)
+    embeddings = pd.DataFrame(vectors, columns=['a', 'b', 'c', 'd'])
+    embeddings.insert(0, 'ID', upload_ids)
+
+    with pytest.raises(ValueError) as excinfo:
+        save_embeddings(project, embeddings)
+    assert 'does not use uploaded embeddings' in str(excinfo.value)
+
+    project.feature_extractor = 'embeddings'
+    project.save()
+    # Nothing to compute until the embeddings are uploaded
+    assert update_tfidf_matrix(project.pk) is None
+
+    fpath = save_embeddings(project, embeddings)
+    assert update_tfidf_matrix(project.pk) == fpath
+    matrix = load_tfidf_matrix(project.pk)
+    assert matrix.shape == (len(upload_ids), 4)
+    assert np.allclose(matrix.rows(upload_ids[::-1]).toarray(), vectors[::-1])
+
+    # A second upload replaces the vectors it has and keeps the others
+    replacement = embeddings[:2].copy()
+    replacement[['a', 'b', 'c', 'd']] = 0.5
+    save_embeddings(project, replacement)
+    matrix = load_tfidf_matrix(project.pk)
+    assert len(matrix) == len(upload_ids)
+    assert np.allclose(matrix.rows(upload_ids[:2]).toarray(), 0.5)
+    assert np.allclose(matrix.rows(upload_ids[2:]).toarray(), vectors[2:])
+
+    with pytest.raises(ValueError) as excinfo:
+        save_embeddings(project, embeddings.drop('ID', axis=1))
+    assert 'ID column' in str(excinfo.value)
+    embeddings['a'] = 'text'
+    with pytest.raises(ValueError) as excinfo:
+        save_embeddings(project, embeddings)
+    assert 'must all be numbers' in str(excinfo.value)
+
+
+def test_iterate_project_data(test_project_data):
+    chunks = list(iterate_project_data(test_project_data.pk, chunk_size=100))
+
+    assert [len(chunk) for chunk in chunks] == [100, 100, 85]
+    rows = [row for chunk in chunks for row in chunk]
+    assert rows == list(Data.objects.filter(project=test_project_data).order_by('pk')
+                        .values_list('pk', 'upload_id', 'text'))
+
+
+def test_feature_store_rows(test_tfidf_matrix):
+    upload_ids = list(test_tfidf_matrix.upload_ids[[5, 0, 42]])
+    rows = test_tfidf_matrix.rows(upload_ids)
+
+    assert sparse.isspmatrix_csr(rows)
+    assert rows.shape == (3, 307)
+    for i, row in enumerate([5, 0, 42]):
+        assert np.allclose(rows[i].toarray(), test_tfidf_matrix.matrix[row].toarray())
+
+    with pytest.raises(ValueError) as excinfo:
+        test_tfidf_matrix.rows(['not an upload id'])
+    assert 'There were no features found' in str(excinfo.value)
 
 
 def test_save_tfidf_matrix(test_project_data, test_tfidf_matrix, tmpdir, settings):
@@ -30,17 +189,76 @@ def test_save_tfidf_matrix(test_project_data, test_tfidf_matrix, tmpdir, setting
 
     file = save_tfidf_matrix(test_tfidf_matrix, test_project_data.pk)
 
-    assert os.path.isfile(file)
+    assert os.path.isdir(file)
     assert file == os.path.join(settings.TF_IDF_PATH, 'project_'
-                                + str(test_project_data.pk) + '_tfidf_matrix.pkl')
+                                + str(test_project_data.pk) + '_tfidf_matrix')
+    for name in ['meta.json', 'data.npy', 'indices.npy', 'indptr.npy', 'upload_ids.npy']:
+        assert os.path.isfile(os.path.join(file, name))
+
+    # Saving again replaces the store in place
+    assert save_tfidf_matrix(test_tfidf_matrix, test_project_data.pk) == file
+    assert sorted(os.listdir(settings.TF_IDF_PATH)) == [os.path.basename(file)]
 
 
 def test_load_tfidf_matrix(test_project_labeled_and_tfidf, test_tfidf_matrix_labeled, tmpdir, settings):
     matrix = load_tfidf_matrix(test_project_labeled_and_tfidf.pk)
 
-    for key in matrix:
-        assert key in test_tfidf_matrix_labeled
-        assert np.allclose(matrix[key], test_tfidf_matrix_labeled[key])
+    assert isinstance(matrix, FeatureStore)
+    assert isinstance(matrix.data, np.memmap)
+    assert list(matrix.upload_ids) == list(test_tfidf_matrix_labeled.upload_ids)
+    assert np.allclose(matrix.matrix.toarray(), test_tfidf_matrix_labeled.matrix.toarray())
+
+    upload_ids = list(test_tfidf_matrix_labeled.upload_ids[::-7])
+    assert np.allclose(matrix.rows(upload_ids).toarray(),
+                       test_tfidf_matrix_labeled.rows(upload_ids).toarray())
+
+
+def test_update_tfidf_matrix_appends(test_project_labeled_and_tfidf, settings):
+    project = test_project_labeled_and_tfidf
+    settings.TFIDF_REFIT_FRACTION = 0.5
+    initial_matrix = load_tfidf_matrix(project.pk)
+    vectorizer = load_tfidf_vectorizer(project.pk)
+
+    # Nothing new to add
+    assert update_tfidf_matrix(project.pk) == os.path.join(settings.TF_IDF_PATH, 'project_'
+                                                           + str(project.pk) + '_tfidf_matrix')
+    assert isinstance(load_tfidf_matrix(project.pk), FeatureStore)
+
+    new_text = ['I am new text about feminism', 'More appended text', 'Yet another new post']
+    add_data(project, pd.DataFrame({'Text': new_text, 'Label': [None] * 3}))
+    update_tfidf_matrix(project.pk)
+
+    matrix = load_tfidf_matrix(project.pk)
+    assert isinstance(matrix, SegmentedFeatureStore)
+    assert len(matrix) == len(initial_matrix) + 3
+    # The existing rows are untouched and the vectorizer is not refit
+    assert np.allclose(matrix.gather(range(len(initial_matrix))).toarray(),
+                       initial_matrix.matrix.toarray())
+    assert load_tfidf_vectorizer(project.pk).vocabulary_ == vectorizer.vocabulary_
+
+    new_ids = [project.data_set.get(text=text).upload_id for text in new_text]
+    assert np.allclose(matrix.rows(new_ids).toarray(), vectorizer.transform(new_text).toarray())
+
+    # Rows from several segments come back in the requested order
+    upload_ids = [new_ids[1], initial_matrix.upload_ids[4], new_ids[0]]
+    assert np.allclose(matrix.rows(upload_ids).toarray(),
+                       np.vstack([vectorizer.transform([new_text[1]]).toarray(),
+                                  initial_matrix.gather([4]).toarray(),
+                                  vectorizer.transform([new_text[0]]).toarray()]))
+
+
+def test_update_tfidf_matrix_refits(test_project_labeled_and_tfidf, settings):
+    project = test_project_labeled_and_tfidf
+    settings.TFIDF_REFIT_FRACTION = 0.0
+    initial_matrix = load_tfidf_matrix(project.pk)
+
+    add_data(project, pd.DataFrame({'Text': ['Some new text'], 'Label': [None]}))
+    update_tfidf_matrix(project.pk)
+
+    matrix = load_tfidf_matrix(project.pk)
+    assert isinstance(matrix, FeatureStore)
+    assert len(matrix) == len(initial_matrix) + 1
+    assert matrix.info['fitted_rows'] == len(initial_matrix) + 1
 
 
 def test_least_confident_notarray():
@@ -157,6 +375,22 @@ def test_entropy_with_zero():
     np.testing.assert_almost_equal(e, 0.26529499557412151)
 
 
+def test_uncertainty_scores_match_rows():
+    rng = np.random.RandomState(0)
+    probs = rng.dirichlet(np.ones(4), size=50)
+    probs[0] = [0, 0.3, 0.7, 0]
+    probs[1] = [0.25, 0.25, 0.25, 0.25]
+
+    scores = uncertainty_scores(probs)
+    assert list(scores) == ['least_confident', 'margin_sampling', 'entropy']
+    for i, row in enumerate(probs):
+        np.testing.assert_almost_equal(scores['least_confident'][i], least_confident(row.copy()))
+        np.testing.assert_almost_equal(scores['margin_sampling'][i], margin_sampling(row.copy()))
+        np.testing.assert_almost_equal(scores['entropy'][i], entropy(row.copy()))
+    # The probabilities are left as they were
+    assert probs[0].tolist() == [0, 0.3, 0.7, 0]
+
+
 def test_train_and_save_model(test_project_labeled_and_tfidf, tmpdir, settings):
     project = test_project_labeled_and_tfidf
 
@@ -175,10 +409,477 @@ def test_train_and_save_model(test_project_labeled_and_tfidf, tmpdir, settings):
                                              + '_training_'
                                              + str(project.get_current_training_set().set_number)
                                              + '.pkl')
+    assert model.feature_path == snapshot_tfidf_matrix(project.pk)
+    assert set(model.timings) == {'feature_load', 'cross_validation', 'fit', 'pickle_dump'}
+    assert model.n_samples == DataLabel.objects.filter(data__project=project).count()
+    assert model.n_features == load_tfidf_snapshot(model.feature_path).shape[1]
+
+
+def test_train_and_save_model_missing_embeddings(test_project_labeled_and_tfidf, tmpdir, settings):
+    project = test_project_labeled_and_tfidf
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir('model_pickles'))
+    project.feature_extractor = 'embeddings'
+    project.save()
+
+    # Three of the labeled data have no embedding yet
+    missing = list(DataLabel.objects.filter(data__project=project).values_list('data__upload_id', flat=True)[:3])
+    upload_ids = list(project.data_set.exclude(upload_id__in=missing).values_list('upload_id', flat=True))
+    embeddings = pd.DataFrame(np.random.RandomState(0).rand(len(upload_ids), 4), columns=['a', 'b', 'c', 'd'])
+    embeddings.insert(0, 'ID', upload_ids)
+    save_embeddings(project, embeddings)
+
+    model = train_and_save_model(project)
+    assert model.n_samples == DataLabel.objects.filter(data__project=project).count() - 3
+    assert model.n_features == 4
+
+
+@pytest.mark.parametrize('classifier,reduction,reducer_class', [
+    ('gnb', 'svd', TruncatedSVD),
+    ('random forest', 'random projection', SparseRandomProjection),
+])
+def test_train_and_save_model_reduced(test_project_labeled_and_tfidf, tmpdir, settings,
+                                      classifier, reduction, reducer_class):
+    project = test_project_labeled_and_tfidf
+    project.classifier = classifier
+    project.reduction = reduction
+    project.save()
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir('model_pickles'))
+    settings.REDUCTION_COMPONENTS = 20
+    settings.REDUCTION_SAMPLE_SIZE = 100
+
+    model = train_and_save_model(project)
+    reducer = get_reducer(project, model.feature_path)
+    assert isinstance(reducer, reducer_class)
+    assert reducer.n_components == 20
+    assert os.path.isfile(os.path.join(model.feature_path,
+                                       'reducer_' + reduction.replace(' ', '_') + '.pkl'))
+    # The classifier was fit on the reduced features
+    clf = load_classifier(model)
+    num_features = clf.theta_.shape[1] if classifier == 'gnb' else clf.n_features_
+    assert num_features == 20
+
+    predictions = predict_data(project, model)
+    assert len(predictions) == project.data_set.filter(
+        datalabel__isnull=True).count() * project.labels.count()
+
+    # The next model on the same snapshot reuses the reducer
+    assert train_and_save_model(project).feature_path == model.feature_path
+    assert get_reducer(project, model.feature_path) is reducer
+
+
+def test_get_labeled_arrays(test_project_labeled_and_tfidf):
+    project = test_project_labeled_and_tfidf
+    labeled_data = DataLabel.objects.filter(data__project=project)
+
+    upload_ids, labels = get_labeled_arrays(labeled_data)
+    ordered = labeled_data.order_by('data__upload_id_hash')
+    assert list(upload_ids) == list(ordered.values_list('data__upload_id', flat=True))
+    assert list(labels) == list(ordered.values_list('label', flat=True))
+    assert labels.dtype == np.int64
+
+    upload_ids, labels = get_labeled_arrays(labeled_data.none())
+    assert len(upload_ids) == len(labels) == 0
+
+
+def test_cross_validate_model_matches_cross_val_predict(test_project_labeled_and_tfidf, settings):
+    project = test_project_labeled_and_tfidf
+    feature_path = snapshot_tfidf_matrix(project.pk)
+    clf = get_classifier(project)
+    labeled_data = DataLabel.objects.filter(data__project=project).order_by('data__upload_id_hash')
+    X = prepare_features(project, feature_path, clf,
+                         load_tfidf_snapshot(feature_path).rows(labeled_data.values_list('data__upload_id', flat=True)))
+    Y = list(labeled_data.values_list('label', flat=True))
+
+    expected = accuracy_score(Y, cross_val_predict(clf, X, Y, cv=5))
+    for n_jobs in [1, 2]:
+        settings.CV_N_JOBS = n_jobs
+        test_rows, predictions, fold_models = cross_validate_model(project, clf, X, Y)
+        assert sorted(test_rows) == list(range(len(Y)))
+        assert accuracy_score([Y[row] for row in test_rows], predictions) == expected
+        assert fold_models == [None] * 5
+
+    project.holdout = 0.2
+    test_rows, predictions, fold_models = cross_validate_model(project, clf, X, Y)
+    assert len(test_rows) == len(predictions) == int(np.ceil(0.2 * len(Y)))
+    assert len(fold_models) == 1
+
+
+def add_to_shared(get_number, chunk):
+    return get_number() + chunk
+
+
+def test_pool_map_shared():
+    # The shared arguments are not pickled, so even a lambda can be shared
+    results = pool_map(add_to_shared, [1, 2, 3, 4], 2, shared=(lambda: 10, ))
+    assert list(results) == [11, 12, 13, 14]
+
+
+def test_cross_validate_model_single_example_label(test_project_labeled_and_tfidf, tmpdir, settings):
+    project = test_project_labeled_and_tfidf
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir('model_pickles'))
+    project.holdout = 0.2
+    project.cv_folds = 10
+    project.save()
+
+    # A label with only one example can't be split into train and test
+    rare_label = Label.objects.create(name='rare', project=project)
+    rare = DataLabel.objects.filter(data__project=project).first()
+    rare.label = rare_label
+    rare.save()
+
+    model = train_and_save_model(project)
+    assert model.n_samples == DataLabel.objects.filter(data__project=project).count()
+    assert set(load_classifier(model).classes_) == set(project.labels.values_list('pk', flat=True))
+
+    # It is only trained on, in every fold
+    Y = np.array([rare_label.pk, rare_label.pk + 1, rare_label.pk + 1, rare_label.pk + 2,
+                  rare_label.pk + 2, rare_label.pk + 2])
+    folds = get_cv_folds(project, Y)
+    assert len(folds) == 2
+    for train, test in folds:
+        assert 0 in train and 0 not in test
+    assert sorted(np.concatenate([test for train, test in folds])) == [1, 2, 3, 4, 5]
+
+    # With every label seen once there is nothing else to test on
+    assert [list(rows) for rows in get_cv_folds(project, [1, 2, 3])[0]] == [[0, 1, 2], [0, 1, 2]]
+
+
+def test_train_and_save_model_fold_ensemble(test_project_labeled_and_tfidf, tmpdir, settings):
+    project = test_project_labeled_and_tfidf
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir('model_pickles'))
+    model = train_and_save_model(project)
+
+    project.fold_ensemble = True
+    project.cv_folds = 3
+    project.save()
+    TrainingSet.objects.create(project=project, set_number=project.get_current_training_set().set_number + 1)
+    ensemble_model = train_and_save_model(project)
+    clf = load_classifier(ensemble_model)
+    assert isinstance(clf, VotingClassifier)
+    assert len(clf.estimators_) == 3
+    assert list(clf.classes_) == list(load_classifier(model).classes_)
+
+    predictions = predict_data(project, ensemble_model)
+    assert len(predictions) == project.data_set.filter(
+        datalabel__isnull=True).count() * project.labels.count()
+    # The probabilities of each datum still sum to one
+    probs = list(DataPrediction.objects.filter(model=ensemble_model).values_list('data', 'predicted_probability'))
+    totals = pd.DataFrame(probs, columns=['data', 'p']).groupby('data')['p'].sum()
+    assert np.allclose(totals, 1)
 
 
-def test_predict_data(test_project_with_trained_model, tmpdir):
+def label_unlabeled(project, num):
+    """Label some of the unlabeled data in a new training set"""
+    training_set = TrainingSet.objects.create(
+        project=project, set_number=project.get_current_training_set().set_number + 1)
+    labels = list(project.labels.all())
+    for i, datum in enumerate(project.data_set.filter(datalabel__isnull=True)[:num]):
+        DataLabel.objects.create(data=datum, label=labels[i % len(labels)], profile=project.creator,
+                                 training_set=training_set)
+
+
+def test_train_and_save_model_incremental(test_project_labeled_and_tfidf, tmpdir, settings):
+    project = test_project_labeled_and_tfidf
+    project.classifier = 'sgd'
+    project.save()
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir('model_pickles'))
+    settings.INCREMENTAL_REFIT_INTERVAL = 2
+
+    model = train_and_save_model(project)
+    assert isinstance(load_classifier(model), SGDClassifier)
+    assert model.incremental_updates == 0
+    assert model.last_label_pk == DataLabel.objects.filter(data__project=project).latest('pk').pk
+
+    # Only the new labels are learned, starting from the previous classifier
+    label_unlabeled(project, 9)
+    first_clf = load_classifier(model)
+    first_coef = first_clf.coef_.copy()
+    updated = train_and_save_model(project)
+    assert updated.incremental_updates == 1
+    assert updated.last_label_pk == DataLabel.objects.filter(data__project=project).latest('pk').pk
+    assert 0 <= updated.cv_accuracy <= 1
+    assert set(updated.cv_metrics['f1']) == set(str(label.pk) for label in project.labels.all())
+    clf = load_classifier(updated)
+    assert clf is not first_clf
+    assert not np.array_equal(clf.coef_, first_coef)
+    # The previous model's classifier is left as it was
+    assert np.array_equal(first_clf.coef_, first_coef)
+
+    label_unlabeled(project, 9)
+    assert train_and_save_model(project).incremental_updates == 2
+
+    # Refit on every label after INCREMENTAL_REFIT_INTERVAL updates
+    label_unlabeled(project, 9)
+    assert train_and_save_model(project).incremental_updates == 0
+
+    # Refit when a label the previous model learned was changed
+    label_unlabeled(project, 9)
+    changed = DataLabel.objects.filter(data__project=project).first()
+    LabelChangeLog.objects.create(project=project, data=changed.data, profile=changed.profile,
+                                  old_label=changed.label.name, new_label='skip')
+    changed.delete()
+    refit = train_and_save_model(project)
+    assert refit.incremental_updates == 0
+    assert refit.last_change_pk == LabelChangeLog.objects.get().pk
+    label_unlabeled(project, 9)
+    assert train_and_save_model(project).incremental_updates == 1
+
+    # Without new labels there is nothing to update with
+    TrainingSet.objects.create(project=project, set_number=project.get_current_training_set().set_number + 1)
+    assert train_and_save_model(project).incremental_updates == 0
+
+
+def test_train_and_save_model_incremental_irr(test_project_labeled_and_tfidf, test_admin_queue_labeled,
+                                              test_irr_queue_labeled, test_profile2, test_redis, tmpdir, settings):
+    project = test_project_labeled_and_tfidf
+    project.classifier = 'sgd'
+    project.num_users_irr = 2
+    project.save()
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir('model_pickles'))
+
+    # Two coders disagree on an IRR datum, and the model learns both labels
+    datum = project.data_set.filter(datalabel__isnull=True).first()
+    Data.objects.filter(pk=datum.pk).update(irr_ind=True)
+    labels = list(project.labels.all())
+    for profile, label in [(project.creator, labels[0]), (test_profile2, labels[1])]:
+        DataLabel.objects.create(data=datum, label=label, profile=profile,
+                                 training_set=project.get_current_training_set())
+    model = train_and_save_model(project)
+    assert model.label_count == DataLabel.objects.filter(data__project=project).count()
+
+    # Resolving the disagreement deletes the coders' labels without a
+    # LabelChangeLog, which must still refit rather than update the model
+    process_irr_label(Data.objects.get(pk=datum.pk), labels[0])
+    assert not DataLabel.objects.filter(data=datum).exists()
+    assert not LabelChangeLog.objects.exists()
+    label_unlabeled(project, 9)
+    assert train_and_save_model(project).incremental_updates == 0
+
+
+@pytest.mark.parametrize('n_jobs', [1, 2])
+def test_search_hyperparameters(test_project_labeled_and_tfidf, tmpdir, settings, n_jobs):
+    project = test_project_labeled_and_tfidf
+    settings.SEARCH_N_JOBS = n_jobs
+
+    params = search_hyperparameters(project)
+    assert params['C'] in SEARCH_GRIDS['logistic regression']['C']
+    project.refresh_from_db()
+    assert project.classifier_params == {'logistic regression': params}
+
+    # Training uses the settings that were found
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir('model_pickles'))
+    model = train_and_save_model(project)
+    assert load_classifier(model).C == params['C']
+
+    # The settings of another classifier are kept apart
+    project.classifier = 'svm'
+    project.save()
+    params = search_hyperparameters(project)
+    project.refresh_from_db()
+    assert set(project.classifier_params) == {'logistic regression', 'svm'}
+    assert get_classifier(project).base_estimator.C == params['C']
+
+    # There is nothing to search for Gaussian Naive Bayes
+    project.classifier = 'gnb'
+    assert search_hyperparameters(project) is None
+
+
+def test_tracked_rss():
+    usage = {}
+    with tracked_rss(usage, interval=0.01):
+        before = current_rss()
+        array = np.ones(50 * 1024 * 1024 // 8)
+        time.sleep(0.1)
+        del array
+    assert usage['peak_rss'] > before + 40 * 1024
+
+    # A later block is not charged the earlier peak, unlike ru_maxrss
+    later = {}
+    with tracked_rss(later):
+        pass
+    assert 0 < later['peak_rss'] < usage['peak_rss']
+
+
+def test_train_and_save_model_multinomial_nb(test_project_labeled_and_tfidf, tmpdir, settings):
+    project = test_project_labeled_and_tfidf
+    project.classifier = 'mnb'
+    project.save()
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir('model_pickles'))
+
+    model = train_and_save_model(project)
+    clf = load_classifier(model)
+    assert isinstance(clf, MultinomialNB)
+    # The sparse features are used as they are
+    tf_idf = load_tfidf_snapshot(model.feature_path)
+    X = prepare_features(project, model.feature_path, clf, tf_idf.gather(range(10)))
+    assert sparse.isspmatrix_csr(X)
+    assert clf.feature_count_.shape[1] == tf_idf.shape[1]
+
+    predictions = predict_data(project, model)
+    assert len(predictions) == project.data_set.filter(
+        datalabel__isnull=True).count() * project.labels.count()
+
+
+def test_score_texts(test_project_labeled_and_tfidf, tmpdir, settings):
+    project = test_project_labeled_and_tfidf
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir('model_pickles'))
+    settings.SCORE_CHUNK_SIZE = 7
+
+    with pytest.raises(ValueError):
+        score_texts(project, ['no model yet'])
+
+    model = train_and_save_model(project)
+    data = list(project.data_set.order_by('pk')[:20])
+    used, probabilities = score_texts(project, [datum.text for datum in data])
+    assert used == model
+
+    # The texts get the same features, and so scores, as the project's data
+    X = load_tfidf_snapshot(model.feature_path).rows([datum.upload_id for datum in data])
+    assert np.allclose(probabilities, load_classifier(model).predict_proba(X))
+    assert score_texts(project, [])[1].shape == (0, project.labels.count())
+
+
+def test_save_classifier_coefficients(test_project_labeled_and_tfidf, tmpdir, settings):
+    project = test_project_labeled_and_tfidf
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir('model_pickles'))
+
+    model = train_and_save_model(project)
+    clf = joblib.load(model.pickle_path)
+    assert os.path.isfile(get_coefficients_path(model.pickle_path))
+
+    # The classifier read back from its coefficients predicts the same
+    X = load_tfidf_snapshot(model.feature_path).gather(range(10))
+    loaded = read_classifier(model.pickle_path)
+    assert isinstance(loaded, LogisticRegression)
+    assert loaded.get_params() == clf.get_params()
+    assert np.allclose(loaded.predict_proba(X), clf.predict_proba(X))
+
+    # Other classifiers only have the pickle
+    sgd = SGDClassifier(loss='log', random_state=0).fit(X, clf.predict(X))
+    save_classifier(sgd, model.pickle_path)
+    assert not os.path.isfile(get_coefficients_path(model.pickle_path))
+    assert isinstance(read_classifier(model.pickle_path), SGDClassifier)
+
+
+def test_delete_old_models(test_project_labeled_and_tfidf, tmpdir, settings):
+    project = test_project_labeled_and_tfidf
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir('model_pickles'))
+    settings.MODEL_RETENTION = 2
+
+    models = []
+    for i in range(4):
+        models.append(train_and_save_model(project))
+        if i == 0:
+            predict_data(project, models[0])
+        TrainingSet.objects.create(project=project, set_number=project.get_current_training_set().set_number + 1)
+
+    deleted = delete_old_models(project)
+    # The newest two are kept, and the first since its predictions are the latest
+    assert deleted == [models[1].pickle_path]
+    assert not os.path.isfile(models[1].pickle_path)
+    assert not os.path.isfile(get_coefficients_path(models[1].pickle_path))
+    for model in (models[0], models[2], models[3]):
+        assert os.path.isfile(model.pickle_path)
+    assert Model.objects.filter(project=project).count() == 4
+    assert delete_old_models(project) == []
+
+
+def test_delete_old_models_snapshots(test_project_labeled_and_tfidf, tmpdir, settings):
+    project = test_project_labeled_and_tfidf
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir('model_pickles'))
+    settings.MODEL_RETENTION = 1
+
+    # Each model is trained on a new version of the features
+    models = []
+    for i in range(3):
+        add_data(project, pd.DataFrame({'Text': ['New text number ' + str(i)], 'Label': [None]}))
+        update_tfidf_matrix(project.pk)
+        models.append(train_and_save_model(project))
+        TrainingSet.objects.create(project=project, set_number=project.get_current_training_set().set_number + 1)
+    assert len(set(model.feature_path for model in models)) == 3
+
+    # The current version's snapshot has no model yet, ex: one being trained
+    add_data(project, pd.DataFrame({'Text': ['New text number 3'], 'Label': [None]}))
+    update_tfidf_matrix(project.pk)
+    current = snapshot_tfidf_matrix(project.pk)
+
+    delete_old_models(project)
+    assert not os.path.exists(models[0].feature_path)
+    assert not os.path.exists(models[1].feature_path)
+    assert os.path.isdir(models[2].feature_path)
+    assert os.path.isdir(current)
+    assert len(load_tfidf_snapshot(current)) == project.data_set.count()
+
+
+def test_snapshot_tfidf_matrix(test_project_labeled_and_tfidf, settings):
+    project = test_project_labeled_and_tfidf
+    settings.TFIDF_REFIT_FRACTION = 0.01
+    fpath = os.path.join(settings.TF_IDF_PATH, 'project_' + str(project.pk) + '_tfidf_matrix')
+
+    snapshot = snapshot_tfidf_matrix(project.pk)
+    assert os.path.dirname(snapshot) == os.path.join(settings.TF_IDF_PATH,
+                                                     'project_' + str(project.pk) + '_snapshots')
+    # Nothing has changed, so the snapshot is reused
+    assert snapshot_tfidf_matrix(project.pk) == snapshot
+    # The arrays are shared with the store rather than copied
+    assert os.path.samefile(os.path.join(snapshot, 'data.npy'), os.path.join(fpath, 'data.npy'))
+    assert os.path.isfile(os.path.join(snapshot, 'project_' + str(project.pk) + '_vectorizer.pkl'))
+    initial = load_tfidf_snapshot(snapshot)
+
+    # Appending data makes a new version
+    add_data(project, pd.DataFrame({'Text': ['New text about feminism'], 'Label': [None]}))
+    update_tfidf_matrix(project.pk)
+    appended = snapshot_tfidf_matrix(project.pk)
+    assert appended != snapshot
+    assert len(load_tfidf_snapshot(appended)) == len(initial) + 1
+
+    # Refitting replaces the store, but earlier snapshots are unchanged
+    add_data(project, pd.DataFrame({'Text': ['More new text', 'Yet more text'], 'Label': [None] * 2}))
+    update_tfidf_matrix(project.pk)
+    refit = snapshot_tfidf_matrix(project.pk)
+    assert refit not in (snapshot, appended)
+    assert not os.path.exists(os.path.join(refit, 'segment_1'))
+    reloaded = load_feature_store(snapshot)
+    assert list(reloaded.upload_ids) == list(initial.upload_ids)
+    assert np.array_equal(reloaded.matrix.toarray(), initial.matrix.toarray())
+
+
+def test_predict_data_uses_model_features(test_project_with_trained_model, settings):
+    project = test_project_with_trained_model
+    settings.PREDICTION_CHUNK_SIZE = 10
+    model = project.model_set.get()
+    num_unlabeled = project.data_set.filter(datalabel__isnull=True).count()
+
+    # Data added after the model was trained is not in its features
+    add_data(project, pd.DataFrame({'Text': ['Text added after training'], 'Label': [None]}))
+    update_tfidf_matrix(project.pk)
+    predictions = predict_data(project, model)
+
+    assert len(predictions) == num_unlabeled * project.labels.count()
+
+
+def test_predict_data_none_in_model_features(test_project_with_trained_model, tmpdir):
     project = test_project_with_trained_model
+    model = project.model_set.get()
+
+    # Features snapshotted before any of the unlabeled data was uploaded
+    labeled_ids = list(DataLabel.objects.filter(data__project=project).values_list('data__upload_id', flat=True))
+    labeled_features = load_tfidf_snapshot(model.feature_path).rows(labeled_ids)
+    model.feature_path = save_feature_store(FeatureStore(labeled_features, labeled_ids),
+                                            os.path.join(str(tmpdir), 'labeled_snapshot'))
+    model.save()
+
+    assert len(predict_data(project, model)) == 0
+    assert DataUncertainty.objects.filter(model=model).count() == 0
+
+
+@pytest.mark.parametrize('n_jobs', [1, 2])
+def test_predict_data(test_project_with_trained_model, tmpdir, settings, n_jobs):
+    project = test_project_with_trained_model
+    # Predict and write the predictions a few data at a time
+    settings.PREDICTION_CHUNK_SIZE = 11
+    settings.PREDICTION_N_JOBS = n_jobs
+    settings.PREDICTION_COPY_ROWS = 7
 
     predictions = predict_data(project, project.model_set.get())
 
@@ -196,6 +897,57 @@ def test_predict_data(test_project_with_trained_model, tmpdir):
             'predicted_probability': prediction.predicted_probability
         })
 
+    # The probabilities are the classifier's, for the right datum and label
+    model = project.model_set.get()
+    clf = load_classifier(model)
+    datum = project.data_set.filter(datalabel__isnull=True).order_by('pk').last()
+    X = load_tfidf_snapshot(model.feature_path).rows([datum.upload_id])
+    expected = dict(zip(clf.classes_, clf.predict_proba(X)[0]))
+    for prediction in DataPrediction.objects.filter(data=datum, model=model):
+        assert prediction.predicted_probability == pytest.approx(expected[prediction.label_id])
+
+    # Each predicted datum has its uncertainty scores
+    uncertainties = DataUncertainty.objects.filter(model=project.model_set.get())
+    assert uncertainties.count() == project.data_set.filter(datalabel__isnull=True).count()
+    for uncertainty in uncertainties:
+        probs = np.array(list(DataPrediction.objects.filter(
+            data=uncertainty.data, model=uncertainty.model).values_list('predicted_probability', flat=True)))
+        assert uncertainty.least_confident == pytest.approx(least_confident(probs))
+        assert uncertainty.margin_sampling == pytest.approx(margin_sampling(probs))
+        assert uncertainty.entropy == pytest.approx(entropy(probs))
+
+
+def test_predict_chunk_without_features(test_project_with_trained_model):
+    project = test_project_with_trained_model
+    model = project.model_set.get()
+
+    # None of the data uploaded after training is in the model's features
+    add_data(project, pd.DataFrame({'Text': ['Text added after training', 'More text added after training'],
+                                    'Label': [None, None]}))
+    chunk = list(project.data_set.order_by('-pk').values_list('pk', 'upload_id')[:2])
+    data_pks, label_pks, probs, scores = predict_chunk(project, model, chunk)
+
+    assert len(data_pks) == 0
+    assert probs.shape == (0, project.labels.count())
+    assert all(len(score) == 0 for score in scores.values())
+
+
+def test_predict_chunk_in_daemon(test_project_with_trained_model):
+    project = test_project_with_trained_model
+    model = project.model_set.get()
+    chunk = list(project.data_set.filter(datalabel__isnull=True).order_by('upload_id_hash')
+                 .values_list('pk', 'upload_id'))
+    data_pks, label_pks, probs, scores = predict_chunk(project, model, chunk)
+
+    # predict_data runs in a daemonic celery worker process, which must still
+    # be able to start the pool
+    def predict_in_worker():
+        results = list(pool_map(partial(predict_chunk, project, model), [chunk[:10], chunk[10:]], 2))
+        assert np.array_equal(np.concatenate([result[0] for result in results]), data_pks)
+        assert np.allclose(np.vstack([result[2] for result in results]), probs)
+
+    assert_runs_in_daemon(predict_in_worker)
+
 
 def test_check_and_trigger_model_first_labeled(setup_celery, test_project_data, test_labels, test_queue, test_profile):
     initial_training_set = test_project_data.get_current_training_set()
@@ -288,6 +1040,18 @@ def test_check_and_trigger_batched_success(setup_celery, test_project_labeled_an
     assert project.get_current_training_set().set_number == initial_training_set.set_number + 1
 
 
+def test_check_and_trigger_no_embeddings(test_project_labeled, test_queue_labeled, tmpdir, settings):
+    project = test_project_labeled
+    settings.TF_IDF_PATH = str(tmpdir.mkdir('tf_idf'))
+    project.feature_extractor = 'embeddings'
+    project.save()
+
+    # Nothing to train on until the embeddings are uploaded
+    datum = DataLabel.objects.filter(data__project=project).first().data
+    assert check_and_trigger_model(datum) == 'random'
+    assert project.model_set.count() == 0
+
+
 def test_check_and_trigger_batched_onlyone_label(setup_celery, test_project_data, test_labels, test_queue, test_profile):
     initial_training_set = test_project_data.get_current_training_set()
 
@@ -415,6 +1179,34 @@ def test_svm_classifier(setup_celery, test_project_svm_data_tfidf, test_svm_labe
                                                    labelers=None).count() * project.labels.count()
 
 
+@pytest.mark.parametrize('kernel_components', [0, 20])
+def test_train_and_save_model_svm(test_project_labeled_and_tfidf, tmpdir, settings, kernel_components):
+    project = test_project_labeled_and_tfidf
+    project.classifier = 'svm'
+    project.save()
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir('model_pickles'))
+    settings.SVM_KERNEL_COMPONENTS = kernel_components
+
+    # Leave a label with fewer examples than calibration folds
+    labels = list(project.labels.all())
+    rare = DataLabel.objects.filter(data__project=project, label=labels[0])
+    DataLabel.objects.filter(pk__in=list(rare.values_list('pk', flat=True)[2:])).update(label=labels[1])
+
+    model = train_and_save_model(project)
+    clf = load_classifier(model)
+    assert isinstance(clf, CalibratedClassifierCV)
+    svm = clf.calibrated_classifiers_[0].base_estimator
+    if kernel_components:
+        assert isinstance(svm.steps[0][1], Nystroem)
+        svm = svm.steps[-1][1]
+    assert isinstance(svm, LinearSVC)
+
+    predict_data(project, model)
+    probs = list(DataPrediction.objects.filter(model=model).values_list('data', 'predicted_probability'))
+    totals = pd.DataFrame(probs, columns=['data', 'p']).groupby('data')['p'].sum()
+    assert np.allclose(totals, 1)
+
+
 def test_randomforest_classifier(setup_celery, test_project_randomforest_data_tfidf, test_randomforest_labels,
                                  test_randomforest_queue_list, test_profile, test_redis, tmpdir, settings):
     '''
@@ -0,0 +1,136 @@
+import time
+
+from core import tasks
+from core.models import Model, DataLabel
+from core.utils import utils_model
+from core.utils.utils_scheduler import (schedule_training, finish_training, training_priority,
+                                        hold_training_lock,
+                                        training_in_progress, schedule_hyperparameter_searches,
+                                        redis_serialize_training_lock,
+                                        redis_serialize_training_pending)
+
+
+def test_schedule_training_coalesces_while_running(test_project_labeled_and_tfidf, test_redis,
+                                                   monkeypatch):
+    project = test_project_labeled_and_tfidf
+    started = []
+    monkeypatch.setattr(tasks.send_model_task, 'apply_async',
+                        lambda args, kwargs, **options: started.append(kwargs['lock_token']) or True)
+    followups = []
+    monkeypatch.setattr(tasks.send_check_and_trigger_model_task, 'apply_async',
+                        lambda args, **options: followups.append(args))
+
+    assert schedule_training(project)
+    token = started[0]
+    assert test_redis.get(redis_serialize_training_lock(project.pk)).decode() == token
+
+    # Triggers during the run leave one note for a follow-up run
+    assert schedule_training(project) is None
+    assert schedule_training(project) is None
+    assert len(started) == 1
+    assert test_redis.exists(redis_serialize_training_pending(project.pk))
+
+    # A stale token does not release the lock
+    assert not finish_training(project.pk, 'stale')
+    assert test_redis.exists(redis_serialize_training_lock(project.pk))
+
+    assert finish_training(project.pk, token)
+    assert followups == [[project.pk]]
+    assert not test_redis.exists(redis_serialize_training_lock(project.pk))
+    assert not test_redis.exists(redis_serialize_training_pending(project.pk))
+
+    # With nothing pending the next run starts right away
+    assert schedule_training(project)
+    assert not finish_training(project.pk, started[1])
+    assert followups == [[project.pk]]
+
+
+def test_schedule_training_runs_and_releases(test_project_labeled_and_tfidf, test_queue_labeled,
+                                             test_irr_queue_labeled, test_redis, tmpdir, settings):
+    project = test_project_labeled_and_tfidf
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir('model_pickles'))
+
+    task = schedule_training(project)
+    assert task is not None
+    assert Model.objects.filter(project=project).count() == 1
+    assert not test_redis.exists(redis_serialize_training_lock(project.pk))
+
+
+def test_hold_training_lock_renews(test_project_labeled_and_tfidf, test_redis, settings, monkeypatch):
+    project = test_project_labeled_and_tfidf
+    settings.TRAINING_LOCK_TIMEOUT = 2
+    started = []
+    monkeypatch.setattr(tasks.send_model_task, 'apply_async',
+                        lambda args, kwargs, **options: started.append(kwargs['lock_token']) or True)
+    assert schedule_training(project)
+
+    # A run longer than the timeout keeps the lock
+    with hold_training_lock(project.pk, started[0]):
+        time.sleep(3)
+        assert test_redis.get(redis_serialize_training_lock(project.pk)).decode() == started[0]
+    assert not test_redis.exists(redis_serialize_training_lock(project.pk))
+
+
+def test_labels_during_training_count_towards_next_run(test_project_labeled_and_tfidf, test_queue_labeled,
+                                                       test_irr_queue_labeled, test_profile, tmpdir,
+                                                       settings, monkeypatch):
+    project = test_project_labeled_and_tfidf
+    settings.MODEL_PICKLE_PATH = str(tmpdir.listdir()[0].mkdir('model_pickles'))
+    training_set = project.get_current_training_set()
+    num_trained = DataLabel.objects.filter(training_set=training_set).count()
+    datum = project.data_set.filter(datalabel__isnull=True).first()
+    train_and_save_model = utils_model.train_and_save_model
+
+    def train_then_label(project):
+        model = train_and_save_model(project)
+        # A label saved to the current set while the model trains
+        DataLabel.objects.create(data=datum, label=project.labels.first(), profile=test_profile,
+                                 training_set=training_set)
+        return model
+
+    monkeypatch.setattr(utils_model, 'train_and_save_model', train_then_label)
+    tasks.train_project(project.pk)
+
+    assert project.get_current_training_set().set_number == training_set.set_number + 1
+    assert DataLabel.objects.get(data=datum).training_set == project.get_current_training_set()
+    assert DataLabel.objects.filter(training_set=training_set).count() == num_trained
+
+
+def test_schedule_hyperparameter_searches(test_project_labeled_and_tfidf, test_redis):
+    project = test_project_labeled_and_tfidf
+    assert schedule_hyperparameter_searches() == []
+
+    project.hyperparameter_search = True
+    project.save()
+    assert schedule_hyperparameter_searches() == [project.pk]
+    project.refresh_from_db()
+    assert 'logistic regression' in project.classifier_params
+
+    # A project being trained is left for the next search
+    test_redis.set(redis_serialize_training_lock(project.pk), 'token')
+    assert training_in_progress(project.pk)
+    assert tasks.send_hyperparameter_search_task.delay(project.pk).get() is None
+
+
+def test_hyperparameter_search_holds_training_lock(test_project_labeled_and_tfidf, test_redis, monkeypatch):
+    project = test_project_labeled_and_tfidf
+    followups = []
+    monkeypatch.setattr(tasks.send_check_and_trigger_model_task, 'apply_async',
+                        lambda args, **options: followups.append(args))
+
+    def search(project):
+        # Training triggered during the search waits for it
+        assert training_in_progress(project.pk)
+        assert schedule_training(project) is None
+        return {}
+
+    monkeypatch.setattr(utils_model, 'search_hyperparameters', search)
+    assert tasks.send_hyperparameter_search_task.delay(project.pk).get() == {}
+    assert followups == [[project.pk]]
+    assert not training_in_progress(project.pk)
+
+
+def test_training_priority(test_project_labeled_and_tfidf):
+    project = test_project_labeled_and_tfidf
+    num_data = project.data_set.count()
+    assert training_priority(project) == min(9, len(str(num_data)) - 1)
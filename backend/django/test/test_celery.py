@@ -5,6 +5,7 @@ from core import tasks
 from core.models import Model, DataPrediction, Data, DataUncertainty, ProjectPermissions
 from core.utils.utils_annotate import label_data, assign_datum, get_assignments, batch_unassign
 from core.utils.utils_queue import fill_queue
+from core.utils.utils_model import TRAINING_STAGES
 from core.utils.utils_redis import get_ordered_data, redis_serialize_queue
 from core.utils.util import create_profile
 
@@ -33,9 +34,14 @@ def test_model_task(test_project_labeled_and_tfidf, test_queue_labeled, test_irr
     })
     model = Model.objects.get(project=project)
     assert os.path.isfile(model.pickle_path)
+    assert os.path.isdir(model.feature_path)
     assert model.pickle_path == os.path.join(str(model_path_temp), 'project_' + str(project.pk)
                                              + '_training_' + str(initial_training_set.set_number)
                                              + '.pkl')
+    # Every stage of the task was timed
+    assert set(model.timings) == set(TRAINING_STAGES)
+    assert all(seconds >= 0 for seconds in model.timings.values())
+    assert model.peak_rss > 0
 
     # Assert predictions created
     predictions = DataPrediction.objects.filter(data__project=project)
@@ -74,9 +80,9 @@ def test_tfidf_creation_task(test_project_data, tmpdir, settings):
 
     file = tasks.send_tfidf_creation_task.delay(project.pk).get()
 
-    assert os.path.isfile(file)
+    assert os.path.isdir(file)
     assert file == os.path.join(str(data_temp), 'project_'
-                                + str(test_project_data.pk) + '_tfidf_matrix.pkl')
+                                + str(test_project_data.pk) + '_tfidf_matrix')
 
 
 def test_model_task_redis_no_dupes_data_left_in_queue(test_project_labeled_and_tfidf, test_queue_labeled, test_irr_queue_labeled, test_admin_queue_labeled, test_redis, tmpdir, settings):
@@ -1,4 +1,5 @@
 import csv
+import billiard
 import pandas as pd
 
 from core.management.commands.seed import (SEED_USERNAME, SEED_PASSWORD,
@@ -43,6 +44,17 @@ def assert_redis_matches_db(test_redis):
             assert not test_redis.exists('set:' + str(q.pk))
 
 
+def assert_runs_in_daemon(func):
+    '''
+    Run func in a daemonic process, like a celery worker runs its tasks in,
+    and make sure it finishes without raising.
+    '''
+    process = billiard.Process(target=func, daemon=True)
+    process.start()
+    process.join()
+    assert process.exitcode == 0, "{} failed in a daemonic process".format(func)
+
+
 def read_test_data_api(file=SEED_FILE_PATH):
     '''
     Read the test data from its file and store as list of dicts.  Used for API
@@ -70,6 +70,12 @@ if (PROJECT_CLASSIFIER !== 'None') {
                     $("#model_metric_icon").attr("title", "Indicates how precise the"
                       + " active learning model is at correctly predicting the category"
                       + " in the test set. Formula:  True Positives/(True Positives + False Positives)");
+                } else if (choice === "timings") {
+                    $("#model_metrics").text("Model Metrics: Training Time ");
+                    $("#model_metrics").append(children);
+                    $("#model_metric_icon").attr("title", "The seconds spent in each"
+                      + " stage of training the model, loading features through"
+                      + " refilling the queue.");
                 } else {
                     $("#model_metrics").text("Model Metrics: Recall ");
                     $("#model_metrics").append(children);